@@ -0,0 +1,280 @@
+"""
+Module with functionality related to caching the downloaded audio files. The files are keyed by the id of the youtube
+video so a song that is played in several servers, or played again later, is only downloaded once.
+"""
+import os
+import time
+
+from collections import Counter, OrderedDict
+from file_lock import SharedJsonFile, remove_file
+from pathlib import Path
+
+
+class AudioCache:
+    """
+    Class representing a size bounded cache of downloaded audio files. When the total size of the files exceeds the
+    byte budget the least recently used files are removed, except files that are referenced by a song queue. The index
+    of the cache is saved to a json file in the cache folder so the cached files are reused after a restart.
+    """
+    def __init__(self, folder="audio_files/", max_bytes=2 * 1024 ** 3, load=True, shared=False):
+        """
+        :param folder: The folder containing the cached audio files.
+        :param max_bytes: The maximum total size of the cached audio files in bytes.
+        :param load: If false the index is not loaded until merge_index is called, e.g. from a background task.
+        :param shared: If true the folder is shared with other worker processes, see launcher.py, and the files they
+        added are merged into the index every time it is saved.
+        """
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.index_file = SharedJsonFile(folder + "index.json", shared, merge=self.merge_saved_index)
+
+        # In a shared folder each worker saves the video ids referenced by its queues to its own pin file, so the other
+        # workers do not evict the files of its queued songs.
+        self.pins_folder = folder + "pins/"
+        self.pins_file = None
+        if shared:
+            Path(self.pins_folder).mkdir(parents=True, exist_ok=True)
+            self.pins_file = SharedJsonFile(self.pins_folder + str(os.getpid()) + ".json")
+
+        # Dictionary from the video id to the cache entry of the video, ordered from least to most recently used. Each
+        # entry is a dictionary with the path and size of the file, the number of hits and when it was last used.
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+
+        # The number of queued songs that reference each video id. Referenced files are never evicted.
+        self.refcounts = Counter()
+
+        # The video ids that were removed since the entries were last copied to be saved, see on_index_saved.
+        self.removed_since_save = set()
+
+        Path(self.folder).mkdir(parents=True, exist_ok=True)
+
+        self.loaded = False
+        if load:
+            self.load_index()
+
+    def load_index(self):
+        """Loads the index from the index file, skipping entries where the file has been removed."""
+        self.merge_index(self.read_index())
+
+    def read_index(self):
+        """
+        Reads the index file without changing the cache, so it can be done on another thread.
+
+        :return: A list of (video id, entry) tuples ordered from least to most recently used, without the entries whose
+        file has been removed.
+        """
+        index = self.index_file.read({})
+
+        return [(video_id, entry) for video_id, entry in sorted(index.items(), key=lambda item: item[1]["last_used"])
+                if os.path.isfile(entry["path"])]
+
+    def merge_index(self, entries):
+        """
+        Adds the entries read from the index file to the cache. The entries are older than the files added since the bot
+        started, so they are placed before them in the least recently used order.
+
+        :param entries: The list of (video id, entry) tuples returned by read_index.
+        """
+        for video_id, entry in reversed(entries):
+            if video_id not in self.entries:
+                self.entries[video_id] = entry
+                self.entries.move_to_end(video_id, last=False)
+                self.total_bytes += entry["size"]
+
+        self.loaded = True
+        self.evict()
+        self.save_index()
+
+    def save_index(self):
+        """
+        Saves the index to the index file on a thread, so the event loop is not blocked while the file is written. If
+        the folder is shared, the files other workers added are merged into the cache once the index has been saved.
+        """
+        # Saving before the index file has been loaded would drop the entries that have not been loaded yet.
+        if not self.loaded:
+            return
+
+        self.index_file.save_in_background(self.copy_entries, self.on_index_saved if self.index_file.shared else None)
+
+    async def close(self):
+        """Saves the index and waits until it has been written, and removes the pin file of the worker if any."""
+        self.save_index()
+        await self.index_file.flush()
+
+        if self.pins_file is not None:
+            await self.pins_file.flush()
+            remove_file(self.pins_file.path)
+
+    def copy_entries(self):
+        """Returns a copy of the entries that can be saved on a thread while the cache keeps changing."""
+        self.removed_since_save.clear()
+
+        return {video_id: dict(entry) for video_id, entry in self.entries.items()}
+
+    @staticmethod
+    def merge_saved_index(entries, index):
+        """
+        Adds the files that other workers have added to the index file to the entries that are saved, and keeps the
+        latest use of the files that both know about. Called on the thread saving the index while the file is locked.
+
+        :param entries: The copy of the entries of the cache that is saved.
+        :param index: The entries read from the index file.
+        :return: The merged entries that are written to the index file.
+        """
+        for video_id, entry in index.items():
+            own_entry = entries.get(video_id)
+            if own_entry is not None:
+                own_entry["last_used"] = max(own_entry["last_used"], entry["last_used"])
+            elif os.path.isfile(entry["path"]):
+                # Files that were evicted are skipped since their file is gone.
+                entries[video_id] = entry
+
+        return entries
+
+    def on_index_saved(self, entries):
+        """
+        Adds the files that other workers added to the cache once the shared index has been saved. The files of other
+        workers count towards the budget of the whole folder, so old files are evicted by whichever worker goes over the
+        budget.
+
+        :param entries: The merged entries that were written to the index file.
+        """
+        for video_id, entry in entries.items():
+            own_entry = self.entries.get(video_id)
+            if own_entry is not None:
+                own_entry["last_used"] = max(own_entry["last_used"], entry["last_used"])
+            elif video_id not in self.removed_since_save:
+                # The files of other workers were added recently, so they are placed as the most recently used.
+                self.entries[video_id] = entry
+                self.total_bytes += entry["size"]
+
+        self.evict()
+
+    def get(self, video_id):
+        """
+        Returns the path of the cached audio file for the video, or None if it is not cached.
+
+        :param video_id: The id of the youtube video.
+        """
+        entry = self.entries.get(video_id)
+        if entry is None:
+            return None
+
+        # The file might have been removed by hand while the bot was running.
+        if not os.path.isfile(entry["path"]):
+            self.remove(video_id)
+            return None
+
+        entry["hits"] += 1
+        entry["last_used"] = time.time()
+        self.entries.move_to_end(video_id)
+
+        return entry["path"]
+
+    def add(self, video_id, path):
+        """
+        Adds the downloaded audio file to the cache and evicts old files if the cache is over budget.
+
+        :param video_id: The id of the youtube video.
+        :param path: The path of the downloaded audio file.
+        """
+        if video_id in self.entries:
+            self.total_bytes -= self.entries[video_id]["size"]
+
+        entry = {"path": path, "size": os.path.getsize(path), "hits": 0, "last_used": time.time()}
+        self.entries[video_id] = entry
+        self.entries.move_to_end(video_id)
+        self.total_bytes += entry["size"]
+
+        self.evict()
+        self.save_index()
+
+    def remove(self, video_id):
+        """Removes the video from the cache and deletes the file."""
+        entry = self.entries.pop(video_id, None)
+        if entry is not None:
+            self.total_bytes -= entry["size"]
+            self.removed_since_save.add(video_id)
+
+            if os.path.isfile(entry["path"]):
+                os.remove(entry["path"])
+
+    def evict(self):
+        """
+        Removes the least recently used files that are not referenced until the cache is within budget. In a shared
+        folder the files referenced by the queues of other workers are not removed either.
+        """
+        if self.total_bytes <= self.max_bytes:
+            return
+
+        shared_pins = self.read_shared_pins() if self.pins_file is not None else ()
+
+        for video_id in list(self.entries):
+            if self.total_bytes <= self.max_bytes:
+                break
+
+            if self.refcounts[video_id] == 0 and video_id not in shared_pins:
+                self.remove(video_id)
+
+    def acquire(self, video_id):
+        """Marks the video as referenced by a queued song, which prevents its file from being evicted."""
+        self.refcounts[video_id] += 1
+
+        if self.refcounts[video_id] == 1:
+            self.save_pins()
+
+    def release(self, video_id):
+        """Removes a reference to the video, making its file available for eviction when no references are left."""
+        self.refcounts[video_id] -= 1
+
+        if self.refcounts[video_id] <= 0:
+            del self.refcounts[video_id]
+            self.save_pins()
+
+            # The cache can be over budget if every file was referenced when the last file was added.
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+                self.save_index()
+
+    def save_pins(self):
+        """
+        Saves the video ids referenced by the queues of the worker to its pin file on a thread if the folder is shared.
+        A file that is queued by a worker right before another worker evicts it can still be removed, in which case the
+        song is downloaded again when it is played.
+        """
+        if self.pins_file is not None:
+            self.pins_file.save_in_background(lambda: list(self.refcounts))
+
+    def read_shared_pins(self):
+        """Returns the video ids referenced by the queues of the other workers that are running."""
+        shared_pins = set()
+        for name in os.listdir(self.pins_folder):
+            path = self.pins_folder + name
+            if path == self.pins_file.path or not name.endswith(".json"):
+                continue
+
+            # The pins of a worker that crashed are removed, since its queues are gone.
+            if not is_process_running(int(name[:-len(".json")])):
+                remove_file(path)
+                continue
+
+            shared_pins.update(SharedJsonFile(path).read([]))
+
+        return shared_pins
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def is_process_running(pid):
+    """Returns true if a process with the given id is running. Only used in shared folders, which require unix."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists but belongs to another user.
+        return True
+
+    return True
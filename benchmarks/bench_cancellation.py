@@ -0,0 +1,207 @@
+"""
+Benchmark of cancelling transcodes while they wait for the transcoder. Cancels waiting transcodes in bulk, reports how
+long the cancellations and the releases after them take, and checks that the cancelled transcodes leave no waiting
+entries and no held slots behind. Also shuffles, skips and clears song queues that share a download pipeline, with the
+stand-in for youtube from benchmarks/fakes.py, and checks that the songs that left the prefetch windows leave no
+pending transcodes behind. Exits with a non-zero status if a check fails.
+
+Usage: python -m benchmarks.bench_cancellation
+"""
+import asyncio
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks.fakes import FakeYoutube
+from download_pipeline import DownloadPipeline
+from song_queue import SongQueue
+from transcoder import PREFETCH, PLAYBACK, Transcoder
+
+# The names of the checks that failed.
+failures = []
+
+
+def check(label, condition):
+    """Prints the result of the check and remembers it if it failed."""
+    print("{:<60}{:>8}".format(label, "ok" if condition else "FAILED"))
+    if not condition:
+        failures.append(label)
+
+
+def timed(label, start):
+    print("{:<60}{:>8.2f} ms".format(label, (time.perf_counter() - start) * 1000))
+
+
+async def settle():
+    """Lets the cancelled tasks handle their cancellation."""
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+async def bench_cancel_then_release():
+    """A waiting transcode is cancelled and the running transcode releases its slot before the cancellation is done."""
+    audio_transcoder = Transcoder(max_transcodes=1)
+    await audio_transcoder.acquire()
+
+    waiter = asyncio.ensure_future(audio_transcoder.acquire(PREFETCH, key="cancelled"))
+    await settle()
+
+    # The release pops the cancelled entry before the waiter gets to remove it itself.
+    waiter.cancel()
+    audio_transcoder.release()
+    await settle()
+
+    check("cancel then release: no waiting transcodes", audio_transcoder.get_queue_depth() == 0)
+    check("cancel then release: slot is free", audio_transcoder.active == 0)
+
+    # The next transcode starts right away instead of waiting behind the cancelled entry.
+    await asyncio.wait_for(audio_transcoder.acquire(), 1)
+    check("cancel then release: next transcode starts", audio_transcoder.active == 1)
+
+
+async def bench_cancelled_entry_blocks_fast_path():
+    """A transcode requested while a cancelled entry is still in the heap is started when the entry is removed."""
+    audio_transcoder = Transcoder(max_transcodes=1)
+    await audio_transcoder.acquire()
+
+    waiter = asyncio.ensure_future(audio_transcoder.acquire(PREFETCH, key="cancelled"))
+    await settle()
+
+    waiter.cancel()
+    audio_transcoder.release()
+
+    # Requested before the cancelled waiter has removed its entry, so it queues up even though the slot is free.
+    late = asyncio.ensure_future(audio_transcoder.acquire(PLAYBACK, key="late"))
+    await settle()
+
+    check("cancelled entry in heap: later transcode starts", late.done() and not late.cancelled())
+    check("cancelled entry in heap: one slot held", audio_transcoder.active == 1)
+
+
+async def bench_bulk_cancellation(count):
+    """Many transcodes wait for a single slot and all of them are cancelled, e.g. after clearing every queue."""
+    audio_transcoder = Transcoder(max_transcodes=1)
+    await audio_transcoder.acquire()
+
+    waiters = [asyncio.ensure_future(audio_transcoder.acquire(PREFETCH, key=i)) for i in range(count)]
+    await settle()
+
+    start = time.perf_counter()
+    for waiter in waiters:
+        waiter.cancel()
+    await settle()
+    timed("cancel " + str(count) + " waiting transcodes", start)
+
+    start = time.perf_counter()
+    audio_transcoder.release()
+    timed("release after cancelling " + str(count), start)
+
+    check("bulk cancellation: no waiting transcodes", audio_transcoder.get_queue_depth() == 0)
+    check("bulk cancellation: slot is free", audio_transcoder.active == 0)
+
+
+def get_pending_transcodes(audio_transcoder):
+    """Returns the keys of the transcodes that are waiting for the transcoder and have not been cancelled."""
+    return [entry[3] for entry in audio_transcoder.waiting if not entry[2].done()]
+
+
+async def bench_song_queues(guilds, songs_per_guild):
+    """Many servers shuffle, skip and clear their queues while their prefetches wait for the transcoder."""
+    fake_youtube = FakeYoutube(download_latency=0.01, convert_latency=0.05)
+    fake_youtube.install()
+
+    audio_transcoder = Transcoder(max_transcodes=1)
+    pipeline = DownloadPipeline(audio_transcoder=audio_transcoder, target_loudness=None)
+
+    queues = []
+    for guild in range(guilds):
+        song_queue = SongQueue(pipeline, prefetch_depth=3, max_concurrent_downloads=3)
+        song_queue.extend([("Song " + str(i), "https://www.youtube.com/watch?v=" + str(guild).zfill(5) +
+                            str(i).zfill(6)) for i in range(songs_per_guild)])
+        queues.append(song_queue)
+
+    # Letting the downloads finish so their conversions wait for the single transcoder slot.
+    await asyncio.sleep(0.05)
+    print("{:<60}{:>8}".format("pending transcodes before shuffling", len(get_pending_transcodes(audio_transcoder))))
+
+    start = time.perf_counter()
+    for _ in range(5):
+        for song_queue in queues:
+            song_queue.shuffle()
+        await settle()
+    timed("shuffle " + str(guilds) + " queues 5 times", start)
+
+    windows = set()
+    for song_queue in queues:
+        windows.update(song_queue.downloads)
+
+    check("shuffle: only songs in the windows wait for the transcoder",
+          all(key in windows for key in get_pending_transcodes(audio_transcoder)))
+
+    # Skipping songs in every queue, where the songs are skipped right after they start playing.
+    async def skip(song_queue):
+        for _ in range(3):
+            await song_queue.pop_song()
+            song_queue.song_done()
+
+    await asyncio.gather(*[skip(song_queue) for song_queue in queues])
+
+    windows = set()
+    for song_queue in queues:
+        windows.update(song_queue.downloads)
+
+    check("skip: only songs in the windows wait for the transcoder",
+          all(key in windows for key in get_pending_transcodes(audio_transcoder)))
+
+    start = time.perf_counter()
+    for song_queue in queues:
+        song_queue.clear()
+    await settle()
+    timed("clear " + str(guilds) + " queues", start)
+
+    check("clear: no pending transcodes", not get_pending_transcodes(audio_transcoder))
+
+    # The conversion that was running when the queues were cleared keeps its slot until it is done.
+    await asyncio.sleep(fake_youtube.convert_latency * 2)
+    check("clear: no transcodes running", audio_transcoder.active == 0)
+    check("clear: no downloads left", not pipeline.active_downloads and not pipeline.download_waiters)
+
+    # The downloaded audio is named "<video id>.<process id>.<extension>" until it is converted.
+    leftover_files = [name for name in os.listdir(pipeline.save_folder) if name.count(".") > 1]
+    check("clear: no downloaded audio left behind", not leftover_files)
+
+    pipeline.shutdown()
+    await pipeline.http_session.close()
+
+
+async def bench_cancellation():
+    await bench_cancel_then_release()
+    await bench_cancelled_entry_blocks_fast_path()
+    await bench_bulk_cancellation(1000)
+    await bench_song_queues(20, 30)
+
+
+def main():
+    random.seed(0)
+
+    # Running in a temporary folder since the pipeline keeps its caches in the working directory.
+    working_directory = os.getcwd()
+    temporary_directory = tempfile.mkdtemp(prefix="ritmo-bench-cancellation-")
+    os.chdir(temporary_directory)
+
+    try:
+        asyncio.run(bench_cancellation())
+    finally:
+        os.chdir(working_directory)
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+
+    if failures:
+        print(str(len(failures)) + " checks failed")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Micro-benchmark of the cost of dispatching a chat message, comparing the command registry with the chain of
+"startswith" checks that "Ritmo.on_message" used before. Both ordinary chat messages and real commands are measured.
+
+Usage: python -m benchmarks.bench_dispatch
+"""
+import time
+
+from commands import CommandRegistry
+
+
+# The commands of Ritmo together with whether they take an argument.
+COMMANDS = [("hi", False), ("play", True), ("stop", False), ("pause", False), ("resume", False), ("skip", False),
+            ("shuffle", False), ("queue", False), ("np", False), ("create playlist", True),
+            ("delete playlist", True), ("list playlists", False), ("info", True), ("tracklist", True), ("help", False)]
+
+CHATTER = ["hey, is anyone up for some games tonight?", "lol", "did you see the match yesterday",
+           "https://www.youtube.com/watch?v=dQw4w9WgXcQ", "brb 5 min"]
+
+COMMAND_MESSAGES = ["!play never gonna give you up", "!skip", "!queue", "!create playlist spotify:playlist:abc",
+                    "!tracklist Road Trip", "!np"]
+
+
+class Message:
+    """Minimal stand-in for a discord message."""
+    def __init__(self, content):
+        self.content = content
+        self.guild = object()
+
+
+async def handler(*_args):
+    pass
+
+
+def run(coroutine):
+    """Runs a coroutine that never suspends without the overhead of an event loop."""
+    try:
+        coroutine.send(None)
+    except StopIteration as e:
+        return e.value
+
+
+async def legacy_dispatch(message):
+    """The sequential "startswith" chain, which checked every command for every message."""
+    content = message.content
+    if content == "!hi":
+        await handler(message)
+    for name, _takes_argument in COMMANDS[1:]:
+        if content.startswith("!" + name):
+            await handler(message, content[len(name) + 2:])
+
+
+def measure(dispatch, messages, iterations):
+    """Returns the average number of nanoseconds it takes to dispatch one of the messages."""
+    messages = [Message(content) for content in messages]
+
+    start = time.perf_counter_ns()
+    for _ in range(iterations):
+        for message in messages:
+            run(dispatch(message))
+
+    return (time.perf_counter_ns() - start) / (iterations * len(messages))
+
+
+def main(iterations=20000):
+    registry = CommandRegistry("!")
+    for name, takes_argument in COMMANDS:
+        registry.register(name, handler, argument_name="argument" if takes_argument else None)
+
+    print("Dispatch cost per message (ns):")
+    print("{:<12}{:>12}{:>12}".format("", "legacy", "registry"))
+    for label, messages in [("chatter", CHATTER), ("commands", COMMAND_MESSAGES)]:
+        legacy = measure(legacy_dispatch, messages, iterations)
+        registry_cost = measure(registry.dispatch, messages, iterations)
+        print("{:<12}{:>12.0f}{:>12.0f}".format(label, legacy, registry_cost))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Benchmark of extracting the videos from a youtube search results page. Compares building a BeautifulSoup tree of the
+whole page to find the first "yt-uix-tile-link", which is what the searches did before, with the streaming extractor
+that stops after the needed results, and with reading the results from the "ytInitialData" json of newer pages.
+
+The BeautifulSoup comparison needs the beautifulsoup4 package, which the searches no longer use. Install it with:
+pip install beautifulsoup4
+
+Usage: python -m benchmarks.bench_search_parsing
+"""
+import time
+
+from pathlib import Path
+from search_results import extract_search_results
+
+FIXTURES_PATH = Path(__file__).parent / "fixtures"
+
+
+def load_page(path):
+    """Returns the fixture page as bytes, like it is read from the network, with the placeholders filled in."""
+    page = path.read_text().replace("%QUERY_ID%", "dQw4w9WgXc").replace("%QUERY%", "Never Gonna Give You Up")
+    return page.encode("utf-8")
+
+
+def parse_with_beautiful_soup(html):
+    from bs4 import BeautifulSoup
+
+    video = BeautifulSoup(html, 'html.parser').find(class_='yt-uix-tile-link')
+    return video["title"], "https://www.youtube.com" + str(video["href"])
+
+
+def measure(label, function, *args, iterations=200):
+    """Prints the average number of milliseconds the function takes."""
+    function(*args)
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function(*args)
+
+    print("{:<44}{:>10.3f} ms".format(label, (time.perf_counter() - start) * 1000 / iterations))
+
+
+def main():
+    page = load_page(FIXTURES_PATH / "youtube_search.html")
+    initial_data_page = load_page(FIXTURES_PATH / "youtube_search_initial_data.html")
+
+    print("Time per search results page (" + str(len(page) // 1024) + " KB):")
+    try:
+        measure("BeautifulSoup tree, first result", parse_with_beautiful_soup, page)
+    except ImportError:
+        print("{:<44}{:>13}".format("BeautifulSoup tree, first result", "not installed"))
+
+    measure("streaming extractor, first result", extract_search_results, page, 1)
+    measure("streaming extractor, 5 results", extract_search_results, page, 5)
+    measure("streaming extractor, every result", extract_search_results, page, 100)
+
+    print("Time per ytInitialData page (" + str(len(initial_data_page) // 1024) + " KB):")
+    measure("json extractor, 5 results", extract_search_results, initial_data_page, 5)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Benchmark of the song queue operations on large queues. Measures pushing, popping, shuffling and membership checks on a
+queue of 10,000 songs as well as bulk and lazy enqueueing, and compares popping and membership checks with the list
+based queue that was used before.
+
+Usage: python -m benchmarks.bench_song_queue
+"""
+import asyncio
+import random
+import time
+
+from song_queue import SongQueue
+
+
+class StubCache:
+    """Stand-in for the audio cache that only counts references."""
+    def acquire(self, video_id):
+        pass
+
+    def release(self, video_id):
+        pass
+
+
+class StubPipeline:
+    """Stand-in for the download pipeline where every download finishes immediately."""
+    def __init__(self):
+        self.cache = StubCache()
+
+    def schedule_download(self, url, priority=None):
+        download = asyncio.get_event_loop().create_future()
+        download.set_result("audio_files/" + url[-11:] + ".mp3")
+        return download
+
+    def prioritize(self, url):
+        pass
+
+
+def make_songs(count):
+    return [("Song " + str(i), "https://www.youtube.com/watch?v=" + str(i).zfill(11)) for i in range(count)]
+
+
+def timed(label, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    print("{:<40}{:>10.2f} ms".format(label, (time.perf_counter() - start) * 1000))
+    return result
+
+
+async def bench_song_queue(songs):
+    song_queue = SongQueue(StubPipeline(), prefetch_depth=3, max_concurrent_downloads=2)
+
+    def push_all():
+        for song in songs:
+            song_queue.push_song(song)
+
+    def check_membership():
+        for _title, url in songs[::10]:
+            _ = url[-11:] in song_queue
+
+    timed("SongQueue: push " + str(len(songs)), push_all)
+    timed("SongQueue: str", str, song_queue)
+    timed("SongQueue: shuffle", song_queue.shuffle)
+    timed("SongQueue: " + str(len(songs) // 10) + " membership checks", check_membership)
+
+    start = time.perf_counter()
+    while song_queue.queue:
+        await song_queue.pop_song()
+    print("{:<40}{:>10.2f} ms".format("SongQueue: pop " + str(len(songs)), (time.perf_counter() - start) * 1000))
+
+    bulk_queue = SongQueue(StubPipeline(), prefetch_depth=3, max_concurrent_downloads=2)
+    timed("SongQueue: extend " + str(len(songs)), bulk_queue.extend, songs)
+
+    lazy_queue = SongQueue(StubPipeline(), prefetch_depth=3, max_concurrent_downloads=2)
+    timed("SongQueue: extend_lazy " + str(len(songs)), lazy_queue.extend_lazy, iter(songs), len(songs))
+
+
+def bench_list_queue(songs):
+    queue = []
+    downloaded_queue = []
+
+    def push_all():
+        for song in songs:
+            queue.append(song)
+            downloaded_queue.append("audio_files/" + song[1][-11:] + ".mp3")
+
+    def check_membership():
+        for _title, url in songs[::10]:
+            _ = "audio_files/" + url[-11:] + ".mp3" in downloaded_queue
+
+    def pop_all():
+        while queue:
+            del queue[0]
+            downloaded_queue.pop(0)
+
+    timed("list: push " + str(len(songs)), push_all)
+    timed("list: " + str(len(songs) // 10) + " membership checks", check_membership)
+    timed("list: pop " + str(len(songs)), pop_all)
+
+
+def main(count=10000):
+    random.seed(0)
+    songs = make_songs(count)
+
+    asyncio.run(bench_song_queue(songs))
+    bench_list_queue(songs)
+
+
+if __name__ == '__main__':
+    main()
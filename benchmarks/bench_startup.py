@@ -0,0 +1,291 @@
+"""
+Benchmark of the startup of the bot. It reports:
+
+- the import time of ritmo broken down by the modules it imports, measured with "python -X importtime", together with
+  the import time of the modules that are only imported on first use.
+- the time from starting the client until it is ready, against a local stub of the discord gateway, and the time until
+  the caches have been loaded in the background afterwards. The bot starts in a temporary folder with caches and a
+  playlist database of the given sizes.
+
+Usage: python -m benchmarks.bench_startup [--runs N] [--guilds N] [--cached-songs N] [--cached-searches N]
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from aiohttp import web
+from pathlib import Path
+
+ROOT_PATH = Path(__file__).parent.parent
+
+# The modules that are imported on first use instead of when the bot starts.
+DEFERRED_MODULES = ["youtube_dl", "spotipy"]
+
+
+def measure_import_times(statement):
+    """
+    Runs the statement in a new interpreter with "-X importtime".
+
+    :return: A list of (module, depth, cumulative microseconds) tuples in the order the imports finished.
+    """
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], cwd=str(ROOT_PATH),
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr.strip().splitlines()[-1])
+
+    import_times = []
+    for line in process.stderr.splitlines():
+        # The lines have the format "import time:       self |  cumulative |   package", where the package is indented
+        # by two spaces per level of nesting.
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+
+        _self_time, cumulative_time, module = line[len("import time:"):].split("|")
+        depth = (len(module) - len(module.lstrip()) - 1) // 2
+        import_times.append((module.strip(), depth, int(cumulative_time)))
+
+    return import_times
+
+
+def best_import_times(statement, runs):
+    """Returns a dictionary from each (module, depth) to its lowest cumulative import time in microseconds."""
+    best_times = {}
+    for _ in range(runs):
+        for module, depth, cumulative_time in measure_import_times(statement):
+            best_times[(module, depth)] = min(cumulative_time, best_times.get((module, depth), cumulative_time))
+
+    return best_times
+
+
+def print_import_breakdown(runs, top=12):
+    """Prints the import time of ritmo and of the modules it imports directly, and of the deferred modules."""
+    import_times = best_import_times("import ritmo", runs)
+
+    print("Import time of ritmo (best of " + str(runs) + " runs):")
+    print("{:<36}{:>10.1f} ms".format("ritmo", import_times[("ritmo", 0)] / 1000))
+
+    # The modules imported directly by ritmo are the ones at depth one.
+    direct_imports = sorted(((cumulative_time, module) for (module, depth), cumulative_time in import_times.items()
+                             if depth == 1), reverse=True)
+    for cumulative_time, module in direct_imports[:top]:
+        print("{:<36}{:>10.1f} ms".format("  " + module, cumulative_time / 1000))
+
+    print("Deferred until first use:")
+    for module in DEFERRED_MODULES:
+        try:
+            deferred_times = best_import_times("import ritmo; import " + module, runs)
+        except RuntimeError:
+            print("{:<36}{:>13}".format("  " + module, "not installed"))
+            continue
+
+        print("{:<36}{:>10.1f} ms".format("  " + module, deferred_times[(module, 0)] / 1000))
+
+
+class StubGateway:
+    """
+    Local stand-in for the discord api and gateway with just enough of the protocol for a client to log in and become
+    ready: the user and gateway endpoints, the hello, identify and heartbeat messages, and the READY and GUILD_CREATE
+    events for the given number of servers.
+    """
+    def __init__(self, guild_count):
+        self.guild_count = guild_count
+        self.runner = None
+        self.port = None
+
+        # Performance counter timestamp of when the READY event was sent.
+        self.ready_sent_at = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/api/v7/users/@me", self.handle_user)
+        app.router.add_get("/api/v7/gateway", self.handle_gateway_url)
+        app.router.add_get("/gateway", self.handle_gateway)
+
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    @staticmethod
+    def get_user():
+        return {"id": "1", "username": "Ritmo", "discriminator": "0001", "avatar": None, "bot": True}
+
+    @staticmethod
+    def json_response(data):
+        # Discord.py only decodes responses whose content type is exactly "application/json", without a charset.
+        return web.Response(body=json.dumps(data).encode("utf-8"), headers={"Content-Type": "application/json"})
+
+    async def handle_user(self, _request):
+        return self.json_response(self.get_user())
+
+    async def handle_gateway_url(self, _request):
+        return self.json_response({"url": "ws://127.0.0.1:" + str(self.port) + "/gateway"})
+
+    async def handle_gateway(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_json({"op": 10, "d": {"heartbeat_interval": 41250}})
+
+        async for message in ws:
+            if message.type != web.WSMsgType.TEXT:
+                continue
+
+            payload = json.loads(message.data)
+            if payload["op"] == 1:
+                await ws.send_json({"op": 11})
+            elif payload["op"] == 2:
+                await self.send_ready(ws)
+
+        return ws
+
+    async def send_ready(self, ws):
+        guild_ids = [str(guild_id) for guild_id in range(1, self.guild_count + 1)]
+
+        self.ready_sent_at = time.perf_counter()
+        await ws.send_json({"op": 0, "t": "READY", "s": 1, "d": {
+            "v": 6, "user": self.get_user(), "session_id": "stub", "private_channels": [], "relationships": [],
+            "guilds": [{"id": guild_id, "unavailable": True} for guild_id in guild_ids]}})
+
+        for sequence, guild_id in enumerate(guild_ids, 2):
+            await ws.send_json({"op": 0, "t": "GUILD_CREATE", "s": sequence, "d": {
+                "id": guild_id, "name": "Server " + guild_id, "owner_id": "2", "member_count": 1, "large": False,
+                "unavailable": False, "roles": [], "emojis": [], "features": [], "members": [], "channels": [],
+                "voice_states": [], "presences": []}})
+
+
+def create_state(guild_count, cached_songs, cached_searches):
+    """Creates the caches and the playlist database of a bot that has been running for a while."""
+    from playlist_store import PlaylistStore
+
+    Path("audio_files").mkdir()
+    index = {}
+    for i in range(cached_songs):
+        path = "audio_files/" + str(i).zfill(11) + ".mp3"
+        Path(path).touch()
+        index[str(i).zfill(11)] = {"path": path, "size": 100000, "hits": 1, "last_used": i}
+
+    with open("audio_files/index.json", "w") as f:
+        json.dump(index, f)
+
+    expires = time.time() + 24 * 60 * 60
+    with open("search_cache.json", "w") as f:
+        json.dump({"artist - song " + str(i): {"result": ["Song " + str(i), "https://www.youtube.com/watch?v=" +
+                                                          str(i).zfill(11)], "expires": expires}
+                   for i in range(cached_searches)}, f)
+
+    store = PlaylistStore()
+    for guild_id in range(1, guild_count + 1):
+        store.save_playlist(guild_id, "Playlist " + str(guild_id), None, "", 0, 10, True,
+                            [(position, "Song " + str(position), "https://www.youtube.com/watch?v=" +
+                              str(position).zfill(11), None, None) for position in range(10)])
+    store.close()
+
+
+async def measure_time_to_ready(guild_count):
+    """
+    Starts the bot against the stub gateway and measures how long each step of the startup takes.
+
+    :return: A tuple with a description of the state of the bot and a list of (step, seconds) tuples.
+    """
+    import discord
+
+    from benchmarks.fakes import wait_for
+    from download_pipeline import DownloadPipeline
+    from ritmo import Ritmo
+
+    gateway = StubGateway(guild_count)
+    await gateway.start()
+    discord.http.Route.BASE = "http://127.0.0.1:" + str(gateway.port) + "/api/v7"
+
+    # Loading the caches up front is what the bot did before the loading was moved to the background.
+    start = time.perf_counter()
+    DownloadPipeline().shutdown()
+    eager_load_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    client = Ritmo()
+    create_time = time.perf_counter() - start
+
+    # Performance counter timestamp of when the client became ready.
+    ready_at = []
+
+    async def on_ready():
+        ready_at.append(time.perf_counter())
+
+    client.on_ready = on_ready
+
+    start = time.perf_counter()
+    client_task = asyncio.ensure_future(client.start("stub-token"))
+
+    await wait_for(lambda: ready_at or client_task.done(), timeout=30)
+    if client_task.done():
+        client_task.result()
+
+    await wait_for(lambda: client.warmed_up, timeout=30)
+    warmed_up_at = time.perf_counter()
+
+    description = "Startup with " + str(guild_count) + " servers, " + str(len(client.pipeline.cache)) + \
+        " cached songs and " + str(len(client.pipeline.search_cache.entries)) + " cached searches:"
+    steps = [("loading the caches up front", eager_load_time), ("Ritmo()", create_time),
+             ("start until READY is sent", gateway.ready_sent_at - start),
+             ("start until on_ready", ready_at[0] - start), ("on_ready until warmed up", warmed_up_at - ready_at[0])]
+
+    await client.close()
+    await gateway.stop()
+
+    # Stopping the background tasks of the client so they are not destroyed while they are pending.
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    return description, steps
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the startup of Ritmo.")
+    parser.add_argument("--runs", type=int, default=5, help="The number of times each import is measured.")
+    parser.add_argument("--guilds", type=int, default=100, help="The number of servers the bot is in.")
+    parser.add_argument("--cached-songs", type=int, default=5000, help="The number of songs in the audio cache.")
+    parser.add_argument("--cached-searches", type=int, default=50000, help="The number of searches in the cache.")
+    args = parser.parse_args()
+
+    print_import_breakdown(args.runs)
+    print()
+
+    # Running in a temporary folder since the bot keeps its caches and database in the working directory.
+    working_directory = os.getcwd()
+    temporary_directory = tempfile.mkdtemp(prefix="ritmo-startup-")
+    os.chdir(temporary_directory)
+
+    try:
+        create_state(args.guilds, args.cached_songs, args.cached_searches)
+
+        # The output of the bot itself is hidden so it does not get mixed up with the results.
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            description, steps = loop.run_until_complete(measure_time_to_ready(args.guilds))
+        loop.close()
+
+        print(description)
+        for step, seconds in steps:
+            print("{:<36}{:>10.1f} ms".format(step, seconds * 1000))
+    finally:
+        os.chdir(working_directory)
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,318 @@
+"""
+Local stand-ins for the services Ritmo talks to, so the benchmarks can drive the bot without a network. The stand-ins
+replace the discord objects the bot receives (messages, channels and voice clients), the youtube search page and
+download, and the spotify client, while everything in between is the real code of the bot.
+"""
+import asyncio
+import hashlib
+import html
+import os
+import threading
+import time
+import urllib.parse
+
+from http_session import HttpSession
+from pathlib import Path
+
+import loudness
+import youtube
+
+FIXTURE_PATH = Path(__file__).parent / "fixtures" / "youtube_search.html"
+
+
+class FakeAudioSource:
+    """Stand-in for an ffmpeg audio source that only records its options and whether it was cleaned up."""
+    def __init__(self, source, gain=None, start=None):
+        self.source = source
+        self.gain = gain
+        self.start = start
+        self.cleaned_up = False
+
+    def cleanup(self):
+        self.cleaned_up = True
+
+
+class FakeVoiceClient:
+    """
+    Stand-in for a discord voice client. A song "plays" for a fixed number of seconds and the after callback is then
+    called from another thread, like the audio thread of discord.py does.
+    """
+    def __init__(self, channel, song_seconds):
+        self.channel = channel
+        self.song_seconds = song_seconds
+        self.source = None
+        self.after = None
+        self.timer = None
+        self.paused = False
+        self.connected = True
+
+        # Performance counter timestamps of every call to play, used to measure the time to first audio.
+        self.play_times = []
+
+    def play(self, source, after=None):
+        self.source = source
+        self.after = after
+        self.paused = False
+        self.play_times.append(time.perf_counter())
+
+        self.timer = threading.Timer(self.song_seconds, self.finish, args=(source,))
+        self.timer.daemon = True
+        self.timer.start()
+
+    def finish(self, source):
+        """Called from the timer thread when the song is done, unless another song has been started since."""
+        if self.source is not source:
+            return
+
+        after = self.after
+        self.source = None
+        self.after = None
+        self.end(source, after)
+
+    @staticmethod
+    def end(source, after):
+        """Cleans up the source and calls the after callback, which is what discord.py does when a song ends."""
+        source.cleanup()
+        if after is not None:
+            after(None)
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+
+        # Like discord.py the voice client stops playing right away while the after callback is called from another
+        # thread.
+        source, after = self.source, self.after
+        self.source = None
+        self.after = None
+
+        if source is not None:
+            threading.Thread(target=self.end, args=(source, after), daemon=True).start()
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    def is_playing(self):
+        return self.source is not None and not self.paused
+
+    def is_paused(self):
+        return self.source is not None and self.paused
+
+    def is_connected(self):
+        return self.connected
+
+    async def disconnect(self):
+        self.connected = False
+        if self.timer is not None:
+            self.timer.cancel()
+        self.source = None
+
+
+class FakeVoiceChannel:
+    """Stand-in for a discord voice channel that hands out fake voice clients."""
+    def __init__(self, channel_id, song_seconds=0.05):
+        self.id = channel_id
+        self.song_seconds = song_seconds
+        self.voice_clients = []
+
+    async def connect(self):
+        voice_client = FakeVoiceClient(self, self.song_seconds)
+        self.voice_clients.append(voice_client)
+        return voice_client
+
+
+class FakeSentMessage:
+    """Stand-in for a message sent by the bot, which can be edited."""
+    def __init__(self, content):
+        self.content = content
+
+    async def edit(self, content=None):
+        self.content = content
+
+
+class FakeTextChannel:
+    """Stand-in for a discord text channel that keeps the messages the bot sends."""
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, content):
+        message = FakeSentMessage(content)
+        self.sent.append(message)
+        return message
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+
+class FakeVoiceState:
+    def __init__(self, channel):
+        self.channel = channel
+
+
+class FakeMember:
+    def __init__(self, member_id, voice_channel):
+        self.id = member_id
+        self.voice = FakeVoiceState(voice_channel)
+
+
+class FakeMessage:
+    """Stand-in for a message sent by a user in a server."""
+    def __init__(self, content, author, guild, channel):
+        self.content = content
+        self.author = author
+        self.guild = guild
+        self.channel = channel
+        self.reactions = []
+
+    async def add_reaction(self, emoji):
+        self.reactions.append(emoji)
+
+
+class FakeServer:
+    """A server with a text channel, a voice channel and a member in the voice channel, used to create messages."""
+    def __init__(self, guild_id, song_seconds=0.05):
+        self.guild = FakeGuild(guild_id)
+        self.text_channel = FakeTextChannel()
+        self.voice_channel = FakeVoiceChannel(guild_id, song_seconds)
+        self.member = FakeMember(guild_id, self.voice_channel)
+
+    def message(self, content):
+        return FakeMessage(content, self.member, self.guild, self.text_channel)
+
+
+class FakeYoutube:
+    """
+    Stand-in for youtube. Searches return the canned search page with video ids derived from the search query, and
+    downloads write a file of silence with the size of a 192 kbps mp3 of the given length, which the conversion renames
+    to the mp3 file. Searches, downloads and conversions take a fixed amount of time to simulate the network and
+    ffmpeg. Like the connection pool of the http session, at most "limit_per_host" searches of each session are sent at
+    the same time. The loudness analysis of the downloaded files returns a fixed loudness.
+    """
+    def __init__(self, search_latency=0.05, download_latency=0.2, song_seconds=200, convert_latency=0.0):
+        self.search_latency = search_latency
+        self.download_latency = download_latency
+        self.convert_latency = convert_latency
+        self.song_bytes = song_seconds * 192 * 1000 // 8
+        self.page = FIXTURE_PATH.read_text()
+
+        self.searches = 0
+        self.downloads = 0
+        self.lock = threading.Lock()
+
+        # Dictionary from each http session to the semaphore bounding its concurrent searches.
+        self.connection_limits = {}
+
+    def install(self):
+        """Replaces the network calls of the youtube module and the http sessions with the stand-ins."""
+        fake_youtube = self
+
+        async def get_bytes(http_session, url):
+            return await fake_youtube.get_bytes(http_session, url)
+
+        HttpSession.get_bytes = get_bytes
+        youtube.download_audio = self.download_audio
+        youtube.convert_to_mp3 = self.convert_to_mp3
+        loudness.measure_loudness = self.measure_loudness
+
+    async def get_bytes(self, http_session, url):
+        if http_session not in self.connection_limits:
+            self.connection_limits[http_session] = asyncio.Semaphore(http_session.limit_per_host)
+
+        async with self.connection_limits[http_session]:
+            await asyncio.sleep(self.search_latency)
+
+        http_session.requests += 1
+        self.searches += 1
+
+        query = urllib.parse.unquote(url.split("search_query=", 1)[1])
+        query_id = hashlib.sha1(query.encode("utf-8")).hexdigest()[:10]
+
+        page = self.page.replace("%QUERY_ID%", query_id).replace("%QUERY%", html.escape(query))
+        return page.encode("utf-8")
+
+    def download_audio(self, url, save_folder):
+        Path(save_folder).mkdir(parents=True, exist_ok=True)
+        filepath = save_folder + youtube.get_video_id(url) + ".mp3"
+
+        if os.path.isfile(filepath):
+            return filepath, None
+
+        time.sleep(self.download_latency)
+        downloaded_path = filepath[:-len(".mp3")] + "." + str(os.getpid()) + ".webm"
+        with open(downloaded_path, "wb") as f:
+            f.truncate(self.song_bytes)
+
+        with self.lock:
+            self.downloads += 1
+
+        return filepath, downloaded_path
+
+    def convert_to_mp3(self, downloaded_path, filepath, bitrate=192, threads=1):
+        time.sleep(self.convert_latency)
+        os.replace(downloaded_path, filepath)
+        return filepath
+
+    @staticmethod
+    def measure_loudness(path, threads=1):
+        return -11.5, -0.4
+
+
+class FakeSpotify:
+    """
+    Stand-in for the spotipy client that serves generated playlists, 100 tracks per page, with a fixed latency per
+    request. Every tenth track is by two artists and every hundredth track is no longer available.
+    """
+    def __init__(self, track_count=1000, latency=0.1, page_size=100):
+        self.track_count = track_count
+        self.latency = latency
+        self.page_size = page_size
+        self.requests = 0
+
+    def playlist(self, playlist_uri):
+        time.sleep(self.latency)
+        self.requests += 1
+
+        return {"uri": playlist_uri, "name": "Playlist " + playlist_uri.rsplit(":", 1)[-1],
+                "description": "Generated playlist", "tracks": self.get_page(playlist_uri, 0, self.page_size)}
+
+    def playlist_tracks(self, playlist_uri, limit=100, offset=0):
+        time.sleep(self.latency)
+        self.requests += 1
+
+        return self.get_page(playlist_uri, offset, limit)
+
+    def get_page(self, playlist_uri, offset, limit):
+        positions = range(offset, min(offset + limit, self.track_count))
+        return {"items": [{"track": self.get_track(playlist_uri, position)} for position in positions],
+                "limit": limit, "offset": offset, "total": self.track_count}
+
+    @staticmethod
+    def get_track(playlist_uri, position):
+        if position % 100 == 99:
+            return None
+
+        artists = [{"name": "Artist " + str(position % 37)}]
+        if position % 10 == 0:
+            artists.append({"name": "Featured " + str(position % 11)})
+
+        return {"name": "Song " + str(position) + " of " + playlist_uri, "artists": artists,
+                "duration_ms": 150000 + position % 120 * 1000}
+
+
+def install_fake_audio(client):
+    """Makes the players of the bot create fake audio sources instead of starting ffmpeg."""
+    client.pipeline.transcoder.create_audio_source = FakeAudioSource
+
+
+async def wait_for(predicate, timeout=30, interval=0.01):
+    """Waits until the predicate is true or the timeout has passed, returning the result of the predicate."""
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        await asyncio.sleep(interval)
+
+    return predicate()
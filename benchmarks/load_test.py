@@ -0,0 +1,274 @@
+"""
+Load test of the bot with local stand-ins for discord, youtube and spotify, see benchmarks/fakes.py. It drives the real
+command handling, song queues and playlist imports at scale and reports the throughput and latency percentiles of each
+scenario:
+
+- commands: bursts of chat messages and commands from many servers sent through Ritmo.on_message.
+- queues: many servers queueing a large playlist and playing through the start of it.
+- import: importing a large spotify playlist, including every youtube search.
+
+The bot runs in a temporary folder so its caches and database start empty and are removed afterwards.
+
+The output of the bot itself is hidden unless "--verbose" is given.
+
+Usage: python -m benchmarks.load_test [--guilds N] [--messages N] [--playlist-size N] [--scenario NAME] [--verbose]
+"""
+import argparse
+import asyncio
+import contextlib
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks.fakes import FakeServer, FakeSpotify, FakeYoutube, install_fake_audio, wait_for
+from collections import defaultdict
+from download_pipeline import DownloadPipeline
+from playlist_import import PlaylistImport
+from playlist_store import PlaylistStore
+from ritmo import Ritmo
+from song_queue import SongQueue
+from spotify_playlist import SpotifyPlaylist
+
+# The share of each kind of message in the command traffic. Most messages in a server are ordinary chat.
+MESSAGE_MIX = [("chatter", 50), ("!play", 20), ("!queue", 10), ("!np", 10), ("!skip", 5), ("!shuffle", 5)]
+
+# The results are written to the original stdout since the output of the bot is redirected while the scenarios run.
+REPORT_FILE = sys.stdout
+
+
+def report(line=""):
+    print(line, file=REPORT_FILE, flush=True)
+
+
+def percentile(sorted_values, fraction):
+    """Returns the value at the fraction of the sorted values using the nearest rank method."""
+    if not sorted_values:
+        return 0.0
+
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))]
+
+
+def print_latencies(label, latencies):
+    """Prints the count and the percentiles of the latencies, which are in seconds, in milliseconds."""
+    latencies = sorted(latencies)
+    report("{:<28}{:>8}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}".format(
+        label, len(latencies), percentile(latencies, 0.5) * 1000, percentile(latencies, 0.9) * 1000,
+        percentile(latencies, 0.99) * 1000, (latencies[-1] if latencies else 0.0) * 1000))
+
+
+def print_latency_header(title):
+    report()
+    report(title)
+    report("{:<28}{:>8}{:>10}{:>10}{:>10}{:>10}".format("", "count", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+
+
+def make_message_content(rng, song_count):
+    """Returns the content of a random message following the message mix."""
+    kind = rng.choices([kind for kind, _weight in MESSAGE_MIX], [weight for _kind, weight in MESSAGE_MIX])[0]
+
+    if kind == "chatter":
+        return rng.choice(["lol", "did you see the match yesterday", "brb 5 min", "hey, anyone up for some games?"])
+    if kind == "!play":
+        return "!play Artist " + str(rng.randrange(37)) + " - Song " + str(rng.randrange(song_count))
+
+    return kind
+
+
+async def bench_commands(guilds, messages, burst_size, song_seconds):
+    """Sends bursts of random messages from every server through Ritmo.on_message."""
+    fake_youtube = FakeYoutube(search_latency=0.05, download_latency=0.1)
+    fake_youtube.install()
+
+    client = Ritmo(prefetch_depth=3, max_concurrent_downloads=2)
+    install_fake_audio(client)
+
+    rng = random.Random(0)
+    servers = [FakeServer(guild_id, song_seconds) for guild_id in range(1, guilds + 1)]
+
+    # Every server starts out with a song playing so the playback commands have something to work on.
+    contents = [(server, "!play Artist 0 - Song " + str(server.guild.id)) for server in servers]
+    contents += [(rng.choice(servers), make_message_content(rng, messages)) for _ in range(messages)]
+
+    latencies = defaultdict(list)
+
+    # Performance counter timestamp of the first message of each server, used to measure the time to first audio.
+    first_message_times = {}
+
+    async def send(server, content):
+        message = server.message(content)
+        start = time.perf_counter()
+        first_message_times.setdefault(server.guild.id, start)
+        await client.on_message(message)
+        latencies[content.split(" ", 1)[0] if content.startswith("!") else "chatter"].append(
+            time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(0, len(contents), burst_size):
+        await asyncio.gather(*[send(server, content) for server, content in contents[i:i + burst_size]])
+    elapsed = time.perf_counter() - start
+
+    # The time to first audio is measured from the first message of each server to the first song it played.
+    await wait_for(lambda: all(server.voice_channel.voice_clients and server.voice_channel.voice_clients[0].play_times
+                               for server in servers), timeout=10)
+
+    print_latency_header("Commands: " + str(len(contents)) + " messages from " + str(guilds) +
+                         " servers in bursts of " + str(burst_size))
+    for kind in sorted(latencies):
+        print_latencies(kind, latencies[kind])
+
+    print_latencies("time to first audio", [server.voice_channel.voice_clients[0].play_times[0] -
+                                            first_message_times[server.guild.id]
+                                            for server in servers if server.voice_channel.voice_clients and
+                                            server.voice_channel.voice_clients[0].play_times])
+
+    report("{:<28}{:>8.0f} messages/s".format("throughput", len(contents) / elapsed))
+    report("{:<28}{:>8} searches, {} downloads".format("youtube", fake_youtube.searches, fake_youtube.downloads))
+
+    for guild_id in list(client.sessions.sessions):
+        await client.sessions.remove(guild_id)
+
+
+async def bench_queues(guilds, playlist_size, songs_played, song_seconds):
+    """Queues a large playlist in every server and pops the first songs from every queue at the same time."""
+    fake_youtube = FakeYoutube(download_latency=0.05)
+    fake_youtube.install()
+
+    pipeline = DownloadPipeline()
+    songs = [("Song " + str(i), "https://www.youtube.com/watch?v=" + str(i).zfill(11)) for i in range(playlist_size)]
+
+    queues = [SongQueue(pipeline, prefetch_depth=3, max_concurrent_downloads=2) for _ in range(guilds)]
+
+    start = time.perf_counter()
+    for song_queue in queues:
+        song_queue.extend_lazy(iter(songs), len(songs))
+    extend_time = time.perf_counter() - start
+
+    pop_latencies = []
+
+    async def play_queue(song_queue):
+        for _ in range(songs_played):
+            pop_start = time.perf_counter()
+            await song_queue.pop_song()
+            pop_latencies.append(time.perf_counter() - pop_start)
+
+            # Letting the song "play" so the prefetch of the following songs can catch up.
+            await asyncio.sleep(song_seconds)
+            song_queue.song_done()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[play_queue(song_queue) for song_queue in queues])
+    elapsed = time.perf_counter() - start
+
+    print_latency_header("Queues: " + str(guilds) + " servers queueing " + str(playlist_size) + " songs and playing " +
+                         str(songs_played))
+    print_latencies("pop_song", pop_latencies)
+    report("{:<28}{:>8.2f} ms".format("extend_lazy (all servers)", extend_time * 1000))
+    report("{:<28}{:>8.0f} songs/s".format("throughput", len(pop_latencies) / elapsed))
+
+    for song_queue in queues:
+        song_queue.clear()
+    pipeline.shutdown()
+    await pipeline.http_session.close()
+
+
+async def bench_import(playlist_size, parallelism):
+    """Retrieves and imports a large spotify playlist, searching for every song on the fake youtube."""
+    fake_youtube = FakeYoutube(search_latency=0.05)
+    fake_youtube.install()
+    fake_spotify = FakeSpotify(track_count=playlist_size, latency=0.05)
+
+    # Iterating through the search queries on their own measures the paging of the playlist.
+    start = time.perf_counter()
+    query_count = sum(1 for _ in SpotifyPlaylist("spotify:playlist:paging", 1, fake_spotify).iter_search_queries())
+    paging_time = time.perf_counter() - start
+
+    store = PlaylistStore()
+    pipeline = DownloadPipeline()
+    server = FakeServer(1)
+
+    search_latencies = []
+    search_candidates = pipeline.search_candidates
+
+    async def timed_search(query):
+        search_start = time.perf_counter()
+        try:
+            return await search_candidates(query)
+        finally:
+            search_latencies.append(time.perf_counter() - search_start)
+
+    pipeline.search_candidates = timed_search
+
+    playlist = SpotifyPlaylist("spotify:playlist:import", 1, fake_spotify)
+    playlist_import = PlaylistImport(playlist, store, pipeline, server.text_channel, parallelism)
+
+    start = time.perf_counter()
+    await playlist_import.run()
+    elapsed = time.perf_counter() - start
+
+    print_latency_header("Import: " + str(playlist_size) + " tracks with " + str(parallelism) + " concurrent searches")
+    print_latencies("search", search_latencies)
+    report("{:<28}{:>8.0f} tracks/s ({} queries in {:.2f} s)".format("spotify paging", query_count / paging_time,
+                                                                    query_count, paging_time))
+    report("{:<28}{:>8.0f} tracks/s ({:.2f} s)".format("import throughput", playlist_size / elapsed, elapsed))
+    report("{:<28}{:>8} songs saved".format("result", store.get_playlist(1, playlist.name).song_count))
+
+    store.close()
+    pipeline.shutdown()
+    await pipeline.http_session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of Ritmo with local stand-ins for every service.")
+    parser.add_argument("--guilds", type=int, default=100, help="The number of servers using the bot.")
+    parser.add_argument("--messages", type=int, default=5000, help="The number of messages sent in total.")
+    parser.add_argument("--burst-size", type=int, default=200, help="The number of messages sent at the same time.")
+    parser.add_argument("--playlist-size", type=int, default=2000, help="The number of tracks in the playlists.")
+    parser.add_argument("--songs-played", type=int, default=10, help="The number of songs played in each queue.")
+    parser.add_argument("--song-seconds", type=float, default=0.05, help="The length of each song in seconds.")
+    parser.add_argument("--parallelism", type=int, default=8, help="The number of concurrent searches of an import.")
+    parser.add_argument("--scenario", choices=["commands", "queues", "import"], action="append",
+                        help="Only runs the given scenario. Can be given several times.")
+    parser.add_argument("--verbose", action="store_true", help="Shows the output of the bot.")
+    args = parser.parse_args()
+    scenarios = args.scenario or ["commands", "queues", "import"]
+
+    # Running in a temporary folder since the bot keeps its caches and database in the working directory.
+    working_directory = os.getcwd()
+    temporary_directory = tempfile.mkdtemp(prefix="ritmo-load-test-")
+    os.chdir(temporary_directory)
+
+    # The client creates its tasks on the event loop it finds when it is created, so every scenario runs on that loop.
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    bot_output = sys.stdout if args.verbose else open(os.devnull, "w")
+
+    try:
+        with contextlib.redirect_stdout(bot_output):
+            if "commands" in scenarios:
+                loop.run_until_complete(bench_commands(args.guilds, args.messages, args.burst_size, args.song_seconds))
+            if "queues" in scenarios:
+                loop.run_until_complete(bench_queues(args.guilds, args.playlist_size, args.songs_played,
+                                                     args.song_seconds))
+            if "import" in scenarios:
+                loop.run_until_complete(bench_import(args.playlist_size, args.parallelism))
+
+            # Stopping the background tasks of the client so they are not destroyed while they are pending.
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            loop.close()
+    finally:
+        if bot_output is not sys.stdout:
+            bot_output.close()
+
+        os.chdir(working_directory)
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Module with functionality related to dispatching chat commands to their handlers. Every message in every channel the bot
+can see is checked for a command, so messages without the command prefix are rejected with a single string comparison
+and commands are found with a dictionary lookup instead of testing every command in turn.
+"""
+import metrics
+import time
+
+
+class Command:
+    """Class representing a chat command and the handler that executes it."""
+    __slots__ = ("name", "handler", "argument_name", "guild_only", "duration")
+
+    def __init__(self, name, handler, argument_name=None, guild_only=True):
+        """
+        :param name: The name of the command without the prefix, e.g. "play" or "create playlist".
+        :param handler: Coroutine function that executes the command. It is called with the message, and with the
+        argument as well if the command takes an argument.
+        :param argument_name: The name of the argument shown in the usage message, or None if there is no argument.
+        :param guild_only: If true the command can only be used in a server and not in direct messages.
+        """
+        self.name = name
+        self.handler = handler
+        self.argument_name = argument_name
+        self.guild_only = guild_only
+
+        # The histogram of the time spent handling the command, looked up once so dispatching does not have to.
+        self.duration = metrics.COMMAND_DURATION.labels(command=name)
+
+
+class CommandRegistry:
+    """
+    Class containing the available commands. A command name consists of one or two words, e.g. "play" and
+    "create playlist". Commands are looked up by their first word, and by their first two words if the first word is
+    only used by two word commands.
+    """
+    def __init__(self, prefix="!"):
+        """
+        :param prefix: The prefix that every command starts with.
+        """
+        self.prefix = prefix
+        self.prefix_length = len(prefix)
+
+        # Dictionary from the command name to the command. Two word commands are keyed by both words.
+        self.commands = {}
+
+        # The first words of the two word commands, e.g. "create" for "create playlist".
+        self.two_word_prefixes = set()
+
+    def register(self, name, handler, argument_name=None, guild_only=True):
+        """Adds a command to the registry. See Command for the parameters."""
+        self.commands[name] = Command(name, handler, argument_name, guild_only)
+
+        if " " in name:
+            self.two_word_prefixes.add(name.split(" ", 1)[0])
+
+    def parse(self, content):
+        """
+        Finds the command in the message content and splits off its argument.
+
+        :param content: The content of the message.
+        :return: A tuple with the command and the stripped argument, or None if the message is not a command.
+        """
+        # Rejecting ordinary chat messages before doing any other work.
+        if not content.startswith(self.prefix):
+            return None
+
+        name, _, argument = content[self.prefix_length:].partition(" ")
+
+        if name in self.two_word_prefixes:
+            second_word, _, argument = argument.partition(" ")
+            name += " " + second_word
+
+        command = self.commands.get(name)
+        if command is None:
+            return None
+
+        return command, argument.strip()
+
+    async def dispatch(self, message):
+        """
+        Executes the command in the message if it contains one.
+
+        :param message: The message that might contain a command.
+        :return: True if the message contained a command, false otherwise.
+        """
+        parsed = self.parse(message.content)
+        if parsed is None:
+            return False
+
+        command, argument = parsed
+
+        start = time.perf_counter()
+        try:
+            if command.guild_only and message.guild is None:
+                await message.channel.send("```That command can only be used in a server.```")
+            elif command.argument_name is None:
+                await command.handler(message)
+            elif not argument:
+                await message.channel.send("```Usage: " + self.prefix + command.name + " *" + command.argument_name +
+                                           "*```")
+            else:
+                await command.handler(message, argument)
+        finally:
+            command.duration.observe(time.perf_counter() - start)
+
+        return True
@@ -0,0 +1,30 @@
+"""
+Module with functionality related to reading the config file. The file is read the first time a setting is needed and
+shared by every module afterwards, instead of being read again by every module that needs a setting.
+"""
+import json
+import threading
+
+CONFIG_PATH = "config.json"
+
+# The settings from the config file, read on first use.
+_config = None
+_config_lock = threading.Lock()
+
+
+def get_config():
+    """
+    Returns the dictionary of settings from the config file, reading the file the first time.
+
+    :return: The settings, e.g. {"token": "...", "prefetch depth": 3}.
+    :raises FileNotFoundError: If there is no config file.
+    """
+    global _config
+
+    # The lock keeps two threads, e.g. the bot and a playlist import, from reading the file at the same time.
+    with _config_lock:
+        if _config is None:
+            with open(CONFIG_PATH, "r") as config_file:
+                _config = json.load(config_file)
+
+        return _config
@@ -0,0 +1,358 @@
+"""
+Module with functionality related to running the youtube searches and downloads without blocking the event loop.
+Downloading is done with youtube_dl which blocks while waiting for the network, so the downloads are run on a bounded
+thread pool and awaited from the event loop instead. Searches are requested through the shared http session and only
+the parsing of the search results is run on a thread pool.
+"""
+import asyncio
+import loudness
+import metrics
+import transcoder
+import youtube
+
+from audio_cache import AudioCache
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from file_lock import remove_file
+from http_session import HttpSession
+from search_cache import SearchCache
+from search_results import pick_closest_duration
+
+
+class DownloadPipeline:
+    """
+    Class that runs youtube searches and downloads with bounded concurrency. The pipeline is shared between every
+    server so the total number of concurrent searches and downloads is bounded no matter how many servers use the bot.
+    Searches are bounded by the connection limit of the http session and parsed on their own thread pool, so large
+    playlist imports can not delay the downloads of songs being played.
+    """
+    def __init__(self, max_workers=4, save_folder="audio_files/", streaming=False, cache_max_bytes=2 * 1024 ** 3,
+                 max_search_workers=8, audio_transcoder=None, http_session=None, target_loudness=-16.0,
+                 load_state=True, shared_state=False):
+        """
+        :param max_workers: The maximum number of downloads that can run at the same time.
+        :param save_folder: The folder to which the downloaded audio files are saved.
+        :param streaming: If true the songs are streamed directly from youtube instead of being downloaded first.
+        :param cache_max_bytes: The maximum total size of the cached audio files in bytes.
+        :param max_search_workers: The maximum number of search results pages that can be parsed at the same time.
+        :param audio_transcoder: The Transcoder that bounds the number of songs converted to mp3 at the same time.
+        :param http_session: The HttpSession the searches are requested through.
+        :param target_loudness: The loudness in LUFS the downloaded songs are normalised to, or None to play the songs
+        as they are.
+        :param load_state: If false the caches are empty until load_state is awaited, which reads them in the
+        background so the bot can start without waiting for them.
+        :param shared_state: If true the audio files and the caches are shared with other worker processes, see
+        launcher.py.
+        """
+        self.save_folder = save_folder
+        self.streaming = streaming
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="download")
+        self.search_executor = ThreadPoolExecutor(max_workers=max_search_workers, thread_name_prefix="search")
+        self.cache = AudioCache(save_folder, cache_max_bytes, load=load_state, shared=shared_state)
+        self.search_cache = SearchCache(load=load_state, shared=shared_state)
+        self.transcoder = audio_transcoder if audio_transcoder is not None else transcoder.Transcoder()
+
+        # The conversions and analyses run on their own thread pool with a thread for every transcoder slot, so a
+        # transcode that holds a slot never waits for a thread behind the downloads.
+        self.transcode_executor = ThreadPoolExecutor(max_workers=self.transcoder.max_transcodes,
+                                                     thread_name_prefix="transcode")
+        self.http_session = http_session if http_session is not None else HttpSession()
+
+        # The loudness of each downloaded file is analysed once and kept as long as the file is in the cache.
+        self.loudness = None
+        if target_loudness is not None:
+            self.loudness = loudness.LoudnessIndex(save_folder, target_loudness, load=load_state, shared=shared_state)
+            if load_state:
+                self.loudness.prune(self.cache.entries)
+
+        # Dictionary from the video id to the task analysing the loudness of the video, and the video ids of the files
+        # that could not be analysed, which are not analysed again.
+        self.active_analyses = {}
+        self.failed_analyses = set()
+
+        # Dictionary from the video id to the task downloading it, so a song that is requested by several servers at
+        # the same time is only downloaded once.
+        self.active_downloads = {}
+
+        # The number of songs waiting for the download of each video id, so the download can be stopped when no song
+        # is waiting for it anymore.
+        self.download_waiters = Counter()
+
+    async def load_state(self):
+        """
+        Loads the audio cache index, the search cache and the loudness index in the background. The files are read on
+        the thread pool and merged into the caches on the event loop, so the caches can be used while they are read.
+        """
+        loop = asyncio.get_event_loop()
+        readers = [loop.run_in_executor(self.executor, self.cache.read_index),
+                   loop.run_in_executor(self.executor, self.search_cache.read)]
+        if self.loudness is not None:
+            readers.append(loop.run_in_executor(self.executor, self.loudness.read_index))
+
+        entries = await asyncio.gather(*readers)
+
+        self.cache.merge_index(entries[0])
+        self.search_cache.merge(entries[1])
+        if self.loudness is not None:
+            self.loudness.merge_index(entries[2])
+            self.loudness.prune(self.cache.entries)
+
+    async def save_state(self):
+        """
+        Saves the audio cache index, the search cache and the loudness index and waits until they have been written,
+        e.g. when the bot is closed.
+        """
+        await self.cache.close()
+        await self.search_cache.close()
+        if self.loudness is not None:
+            await self.loudness.close()
+
+    async def search(self, query):
+        """
+        Searches for the query on youtube without blocking the event loop. Searches that have been done before are
+        answered by the search cache without contacting youtube.
+
+        :param query: The search query that will be used to search for the video on youtube.
+        :return: A tuple consisting of the title and URL of the first video found.
+        :raises youtube.VideoNotFoundError: If the search did not find a video.
+        :raises youtube.SearchFailedError: If youtube could not be reached. The failure is not cached.
+        """
+        cached = self.search_cache.get(query)
+        if cached is not None:
+            if cached["result"] is None:
+                raise youtube.VideoNotFoundError("Could not find a URL for: " + query)
+            return cached["result"]
+
+        try:
+            title_url = await youtube.get_video_title_url(query, self.http_session, executor=self.search_executor)
+        except youtube.VideoNotFoundError:
+            self.search_cache.put(query, None)
+            raise
+
+        self.search_cache.put(query, title_url)
+        return title_url
+
+    async def search_candidates(self, query, max_results=5):
+        """
+        Searches for the query on youtube without blocking the event loop and returns the first videos found. The
+        candidates are cached like the results of the other searches.
+
+        :param query: The search query that will be used to search for the video on youtube.
+        :param max_results: The maximum number of videos that are returned.
+        :return: A non-empty list of SearchResults in the order youtube ranked them.
+        :raises youtube.VideoNotFoundError: If the search did not find a video.
+        :raises youtube.SearchFailedError: If youtube could not be reached. The failure is not cached.
+        """
+        cached = self.search_cache.get(query)
+        if cached is not None:
+            if cached["result"] is None:
+                raise youtube.VideoNotFoundError("Could not find a URL for: " + query)
+            if cached["candidates"] is not None:
+                return cached["candidates"]
+
+        try:
+            candidates = await youtube.search_videos(query, self.http_session, max_results,
+                                                     executor=self.search_executor)
+        except youtube.VideoNotFoundError:
+            self.search_cache.put(query, None)
+            raise
+
+        self.search_cache.put(query, (candidates[0].title, candidates[0].url), candidates)
+        return candidates
+
+    async def resolve(self, query, duration_ms=None):
+        """
+        Finds the video for a song with a known duration, picking the search result with the closest duration instead
+        of the first result. Without a duration the first result is picked.
+
+        :param query: The search query that will be used to search for the video on youtube.
+        :param duration_ms: The duration of the song in milliseconds, or None if it is unknown.
+        :return: The SearchResult of the chosen video.
+        :raises youtube.VideoNotFoundError: If the search did not find a video.
+        :raises youtube.SearchFailedError: If youtube could not be reached.
+        """
+        candidates = await self.search_candidates(query)
+        if not duration_ms:
+            return candidates[0]
+
+        return pick_closest_duration(candidates, duration_ms / 1000)
+
+    async def download(self, url, priority=transcoder.PREFETCH):
+        """
+        Downloads the audio from the youtube url without blocking the event loop. If the audio is already in the cache
+        the cached file is used instead.
+
+        :param url: The youtube url of the video from which the audio will be downloaded.
+        :param priority: The transcoding priority of the download, either transcoder.PLAYBACK or transcoder.PREFETCH.
+        :return: The filename of the downloaded audio file.
+        """
+        video_id = youtube.get_video_id(url)
+
+        filepath = self.cache.get(video_id)
+        if filepath is not None:
+            # Files cached before the loudness was analysed are analysed the first time they are used.
+            self.schedule_analysis(video_id, filepath)
+            return filepath
+
+        if video_id not in self.active_downloads:
+            self.active_downloads[video_id] = asyncio.ensure_future(self.download_to_cache(video_id, url, priority))
+        elif priority == transcoder.PLAYBACK:
+            # The song is already being downloaded for a prefetch but is now needed for playback.
+            self.transcoder.promote(video_id)
+
+        # Shielding the shared download so cancelling one of the songs waiting for it does not cancel the others.
+        download = self.active_downloads[video_id]
+        self.download_waiters[video_id] += 1
+        try:
+            return await asyncio.shield(download)
+        except asyncio.CancelledError:
+            # The download is stopped when the last song waiting for it is cancelled, e.g. when the song falls out of
+            # the prefetch window after a shuffle or a skip, so it does not keep its place in the transcoder queue.
+            if self.download_waiters[video_id] == 1 and not download.done():
+                # Songs that request the video while the download is stopping start a new download instead.
+                del self.active_downloads[video_id]
+                download.cancel()
+            raise
+        finally:
+            self.download_waiters[video_id] -= 1
+            if self.download_waiters[video_id] <= 0:
+                del self.download_waiters[video_id]
+
+    async def download_to_cache(self, video_id, url, priority):
+        """
+        Downloads the audio from the youtube url, converts it to mp3 and adds the mp3 file to the cache. Only the
+        conversion waits for the transcoder, since the download itself mostly waits for the network.
+        """
+        try:
+            download = self.executor.submit(youtube.download_audio, url, self.save_folder)
+            try:
+                filepath, downloaded_path = await asyncio.wrap_future(download)
+            except asyncio.CancelledError:
+                # A download that already started keeps running on the thread pool, so its audio is removed when it is
+                # done. A download that had not started yet is cancelled along with the future.
+                download.add_done_callback(self.remove_abandoned_download)
+                raise
+
+            if downloaded_path is not None:
+                try:
+                    await self.transcoder.acquire(priority, video_id)
+                except asyncio.CancelledError:
+                    # The conversion never started, so the downloaded audio is removed here. A conversion that was
+                    # started removes the audio itself when it is done, even if the song stops waiting for it.
+                    remove_file(downloaded_path)
+                    raise
+
+                await asyncio.shield(self.transcoder.start(self.transcode_executor, youtube.convert_to_mp3,
+                                                           downloaded_path, filepath, self.transcoder.bitrate,
+                                                           self.transcoder.threads))
+
+            self.cache.add(video_id, filepath)
+            self.schedule_analysis(video_id, filepath)
+
+            return filepath
+        finally:
+            # A download that was stopped was already removed, and a new download of the video may have started since.
+            if self.active_downloads.get(video_id) is asyncio.current_task():
+                del self.active_downloads[video_id]
+
+    @staticmethod
+    def remove_abandoned_download(download):
+        """Removes the audio of a download that was done after the song stopped waiting for it."""
+        if not download.cancelled() and download.exception() is None:
+            _filepath, downloaded_path = download.result()
+            if downloaded_path is not None:
+                remove_file(downloaded_path)
+
+    def schedule_analysis(self, video_id, filepath):
+        """
+        Starts analysing the loudness of the downloaded file in the background unless it has already been analysed. The
+        song does not wait for the analysis, so a song that is played right after it is downloaded is played as it is.
+        """
+        if self.loudness is None or video_id in self.loudness or video_id in self.active_analyses or \
+                video_id in self.failed_analyses:
+            return
+
+        self.active_analyses[video_id] = asyncio.ensure_future(self.analyze_loudness(video_id, filepath))
+
+    async def analyze_loudness(self, video_id, filepath):
+        """Analyses the loudness of the downloaded file and adds the result to the loudness index."""
+        try:
+            # The analysis decodes the whole file, so it waits for the transcoder like the conversions to mp3 do.
+            measured_loudness, peak = await self.transcoder.run(self.transcode_executor, loudness.measure_loudness,
+                                                                filepath, self.transcoder.threads,
+                                                                priority=transcoder.PREFETCH)
+        except (OSError, ValueError) as e:
+            print("Could not analyse the loudness of " + filepath + ": " + str(e))
+            self.failed_analyses.add(video_id)
+            metrics.LOUDNESS_ANALYSES.inc(result="error")
+        else:
+            self.loudness.add(video_id, measured_loudness, peak)
+            metrics.LOUDNESS_ANALYSES.inc(result="analyzed")
+        finally:
+            del self.active_analyses[video_id]
+
+    def get_gain(self, url, source):
+        """
+        Returns the gain in dB that normalises the loudness of the song, or None if the song should be played as it is.
+        Only downloaded songs are normalised since streams are not analysed.
+
+        :param url: The youtube url of the song.
+        :param source: Either the filename of the downloaded song or the audio stream of the song.
+        """
+        if self.loudness is None or isinstance(source, youtube.AudioStream):
+            return None
+
+        return self.loudness.get_gain(youtube.get_video_id(url))
+
+    async def resolve_stream(self, url):
+        """
+        Resolves the direct url to the audio stream of the youtube video without blocking the event loop.
+
+        :param url: The youtube url of the video from which the audio will be streamed.
+        :return: An AudioStream with the direct url and codec of the audio stream.
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, youtube.get_audio_stream, url)
+
+    async def prepare(self, url, priority=transcoder.PREFETCH):
+        """
+        Prepares the song so it is ready to be played. In streaming mode the audio stream is resolved and if that fails,
+        or streaming is disabled, the audio is downloaded instead.
+
+        :param url: The youtube url of the song.
+        :param priority: The transcoding priority of the download, either transcoder.PLAYBACK or transcoder.PREFETCH.
+        :return: Either an AudioStream or the filename of the downloaded audio file.
+        """
+        # Cached files are played directly since that requires no network access at all.
+        if self.streaming and self.cache.get(youtube.get_video_id(url)) is None:
+            try:
+                return await self.resolve_stream(url)
+            except Exception as e:
+                print("Could not stream " + url + ", downloading instead: " + str(e))
+
+        return await self.download(url, priority)
+
+    def schedule_download(self, url, priority=transcoder.PREFETCH):
+        """
+        Starts preparing the song in the background, either by resolving its audio stream or by downloading it.
+
+        :param url: The youtube url of the video from which the audio will be downloaded.
+        :param priority: The transcoding priority of the download, either transcoder.PLAYBACK or transcoder.PREFETCH.
+        :return: A task that resolves to either an AudioStream or the filename of the downloaded audio file.
+        """
+        return asyncio.ensure_future(self.prepare(url, priority))
+
+    def prioritize(self, url):
+        """Gives the download of the song playback priority if it is still waiting for the transcoder."""
+        self.transcoder.promote(youtube.get_video_id(url))
+
+    def shutdown(self):
+        """Stops the thread pools without waiting for the searches and downloads that are currently running."""
+        # The downloads and analyses are cancelled first, since they would fail when they submit their next step to a
+        # thread pool that is shut down.
+        for task in list(self.active_downloads.values()) + list(self.active_analyses.values()):
+            task.cancel()
+
+        self.executor.shutdown(wait=False)
+        self.transcode_executor.shutdown(wait=False)
+        self.search_executor.shutdown(wait=False)
@@ -0,0 +1,154 @@
+"""
+Module with functionality related to locking the files that are shared by the worker processes of a sharded bot, see
+launcher.py. The caches are saved by reading the file, merging it with the entries of the process and writing it back,
+which is only safe if no other process saves the same file in between.
+"""
+import asyncio
+import functools
+import json
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # File locks are only available on unix, where the sharded mode is supported.
+    fcntl = None
+
+
+class FileLock:
+    """
+    Exclusive lock on a lock file that is held for the duration of a "with" block. The lock is released by the operating
+    system if the process crashes, so a crashed worker can not leave the shared files locked.
+    """
+    def __init__(self, path):
+        """
+        :param path: The path of the lock file, e.g. the path of the locked file with ".lock" appended.
+        """
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, "a")
+
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Closing the file releases the lock.
+        self.file.close()
+        self.file = None
+
+
+def remove_file(path):
+    """Removes the file if it exists."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def merge_missing(entries, saved_entries):
+    """Adds the saved entries that are not in the entries, keeping the entries where both have the same key."""
+    saved_entries.update(entries)
+    return saved_entries
+
+
+class SharedJsonFile:
+    """
+    Class representing a json file that a cache is saved to. The file is replaced atomically so a crash can not corrupt
+    it. If the file is shared with other worker processes, the entries they saved are read and merged with the entries
+    of this process while holding the lock of the file, so no other worker saves the file between the read and the
+    write. The file can be saved on a thread, so writing a large file does not block the event loop.
+    """
+    def __init__(self, path, shared=False, merge=merge_missing):
+        """
+        :param path: The path of the json file.
+        :param shared: If true the file is shared with other worker processes.
+        :param merge: Function that is given the entries that are saved and the entries read from the file when the
+        file is shared, and returns the entries that are written. By default the entries of other workers are added.
+        """
+        self.path = path
+        self.shared = shared
+        self.merge = merge
+
+        # The future of the save that is running on a thread, if any, and the save that was requested while it ran.
+        self.saving = None
+        self.next_save = None
+
+    def read(self, default=None):
+        """Returns the contents of the file, or the default if the file does not exist or is not valid json."""
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return default
+
+    def write(self, entries):
+        """Writes the entries to a temporary file that atomically replaces the file."""
+        # The temporary file is unique to the process and thread, so two saves can not write to the same one.
+        tmp_path = self.path + "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entries, f)
+
+        os.replace(tmp_path, self.path)
+
+    def save(self, entries):
+        """
+        Saves the entries to the file, merging them with the entries other workers saved if the file is shared.
+
+        :param entries: The entries that are saved.
+        :return: The entries that were written.
+        """
+        if not self.shared:
+            self.write(entries)
+            return entries
+
+        with FileLock(self.path + ".lock"):
+            saved_entries = self.read()
+            if saved_entries is not None:
+                entries = self.merge(entries, saved_entries)
+
+            self.write(entries)
+
+        return entries
+
+    def save_in_background(self, get_entries, on_saved=None):
+        """
+        Saves the entries on a thread. A save that is requested while another save is running is started once that save
+        is done, replacing the saves requested before it, so a burst of changes is written at most twice.
+
+        :param get_entries: Function that returns the entries that are saved. It is called on the event loop when the
+        save starts and must return entries that are not changed while they are saved, e.g. a copy.
+        :param on_saved: Function that is called on the event loop with the entries that were written, or None.
+        """
+        if self.saving is not None:
+            self.next_save = (get_entries, on_saved)
+            return
+
+        self.saving = asyncio.get_event_loop().run_in_executor(None, self.save, get_entries())
+        self.saving.add_done_callback(functools.partial(self.on_background_save_done, on_saved))
+
+    def on_background_save_done(self, on_saved, future):
+        """Called on the event loop when a save on a thread is done, which starts the save requested after it."""
+        self.saving = None
+
+        try:
+            entries = future.result()
+        except Exception as e:
+            print("Could not save " + self.path + ": " + str(e))
+        else:
+            if on_saved is not None:
+                on_saved(entries)
+
+        if self.next_save is not None:
+            get_entries, on_saved = self.next_save
+            self.next_save = None
+            self.save_in_background(get_entries, on_saved)
+
+    async def flush(self):
+        """Waits until the save running on a thread and the save requested after it are done."""
+        while self.saving is not None:
+            await asyncio.wait([self.saving])
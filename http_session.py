@@ -0,0 +1,66 @@
+"""
+Module with functionality related to the outbound http requests of the bot. Every request goes through one long-lived
+aiohttp session whose connection pool keeps the connections alive between requests, so large playlist imports reuse a
+few connections to youtube instead of paying a TCP and TLS handshake for every search.
+"""
+import aiohttp
+
+
+class HttpSession:
+    """
+    Class wrapping the aiohttp session that is shared by every server. The number of connections to each host is
+    bounded, so requests beyond the limit wait for a free connection instead of opening new ones.
+    """
+    def __init__(self, limit=32, limit_per_host=8, keepalive_timeout=60, timeout=15):
+        """
+        :param limit: The maximum number of open connections in total.
+        :param limit_per_host: The maximum number of open connections to a single host, e.g. to youtube.
+        :param keepalive_timeout: The number of seconds an idle connection is kept open for reuse.
+        :param timeout: The number of seconds a request is allowed to take in total.
+        """
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+
+        # The session is created on first use since aiohttp sessions have to be created inside the event loop.
+        self.session = None
+
+        # Counters that show how often the connections are reused.
+        self.requests = 0
+        self.connections_created = 0
+
+    def get_session(self):
+        """Returns the aiohttp session, creating it if it has not been created yet or has been closed."""
+        if self.session is None or self.session.closed:
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_connection_create_end.append(self.on_connection_created)
+
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                             keepalive_timeout=self.keepalive_timeout, ttl_dns_cache=300)
+            self.session = aiohttp.ClientSession(connector=connector, trace_configs=[trace_config],
+                                                 timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+        return self.session
+
+    async def on_connection_created(self, _session, _context, _params):
+        self.connections_created += 1
+
+    async def get_bytes(self, url):
+        """
+        Requests the url and returns the body of the response.
+
+        :param url: The url that is requested.
+        :return: The body of the response as bytes.
+        :raises aiohttp.ClientError: If the request failed or the response has an error status.
+        :raises asyncio.TimeoutError: If the request took longer than the timeout.
+        """
+        self.requests += 1
+        async with self.get_session().get(url) as response:
+            response.raise_for_status()
+            return await response.read()
+
+    async def close(self):
+        """Closes the session and every pooled connection."""
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
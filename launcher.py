@@ -0,0 +1,207 @@
+"""
+Script that runs Ritmo as several worker processes, so the audio work of the servers is spread over every core of the
+host instead of competing for a single interpreter. The connection to discord is split into shards, where each server
+belongs to the shard (server id >> 22) % shard count, and each worker connects with its own subset of the shards and
+only handles the servers of those shards. The supervisor restarts the workers that stop unexpectedly.
+
+The workers share the audio files, the search cache and the loudness index, whose index files are merged under a file
+lock every time they are saved, and the playlist database, which uses write-ahead logging. Each worker saves its song
+queues to its own journal, "queue_journal.<worker>.jsonl", so the queues are only resumed after a restart if the
+number of workers and shards stays the same.
+
+Usage: python launcher.py [--workers N] [--shards N]
+"""
+import argparse
+import asyncio
+import discord
+import multiprocessing
+import os
+import signal
+import time
+
+from config import get_config
+from playlist_store import PlaylistStore
+from ritmo import Ritmo, create_client
+
+# Discord only accepts one shard identifying itself every five seconds.
+IDENTIFY_INTERVAL = 5
+
+# The exit code of a worker that could not log in, in which case the other workers would fail in the same way.
+EXIT_LOGIN_FAILED = 3
+
+
+class ShardedRitmo(Ritmo, discord.AutoShardedClient):
+    """
+    Class representing the bot run by a worker. The sharded client connects with every shard in "shard_ids" from the
+    same process, so the worker handles the servers of all its shards.
+    """
+
+
+def get_recommended_shard_count(token):
+    """Returns the number of shards discord recommends for the bot, which depends on the number of servers it is in."""
+    async def request_shard_count():
+        http = discord.http.HTTPClient()
+        try:
+            await http.static_login(token, bot=True)
+            shard_count, _gateway = await http.get_bot_gateway()
+            return shard_count
+        finally:
+            await http.close()
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(request_shard_count())
+    finally:
+        loop.close()
+
+
+def run_worker(worker_index, shard_ids, shard_count):
+    """
+    Runs the bot with the given shards until the worker is stopped. This is the entry point of the worker processes.
+
+    :param worker_index: The index of the worker, used to give the worker its own journal and metrics.
+    :param shard_ids: The ids of the shards that the worker connects with.
+    :param shard_count: The total number of shards of the bot.
+    """
+    config_dict = get_config()
+
+    # The metrics of each worker are served on their own port and written to their own file.
+    metrics_port = config_dict.get("metrics port")
+    metrics_file = config_dict.get("metrics file")
+
+    client = create_client(config_dict, ShardedRitmo, shard_ids=shard_ids, shard_count=shard_count, shared_state=True,
+                           journal_path="queue_journal." + str(worker_index) + ".jsonl",
+                           metrics_port=metrics_port + worker_index if metrics_port is not None else None,
+                           metrics_file=metrics_file + "." + str(worker_index) if metrics_file is not None else None)
+
+    print("Worker " + str(worker_index) + " running shards " + ", ".join(str(shard_id) for shard_id in shard_ids))
+    try:
+        client.run(config_dict["token"])
+    except discord.LoginFailure as e:
+        print("Worker " + str(worker_index) + " could not log in: " + str(e))
+        raise SystemExit(EXIT_LOGIN_FAILED)
+
+
+class Supervisor:
+    """
+    Class that starts a process for each worker and restarts the workers that stop while the supervisor is running.
+    The workers are started one at a time, since discord only accepts one shard identifying itself at a time.
+    """
+    def __init__(self, worker_count, shard_count, restart_delay=5):
+        """
+        :param worker_count: The number of worker processes.
+        :param shard_count: The total number of shards, which are divided evenly between the workers.
+        :param restart_delay: The number of seconds to wait before restarting a worker that stopped.
+        """
+        self.shard_count = shard_count
+        self.restart_delay = restart_delay
+
+        # The shards of each worker, e.g. [[0, 2], [1, 3]] for two workers and four shards.
+        self.worker_shards = [list(range(worker_index, shard_count, worker_count)) for worker_index in
+                              range(worker_count)]
+
+        # Dictionary from the index of each worker to its process.
+        self.processes = {}
+
+        # The workers are started with a fresh interpreter instead of a copy of the supervisor.
+        self.context = multiprocessing.get_context("spawn")
+        self.stopping = False
+
+    def start_worker(self, worker_index):
+        """Starts the process of the worker with the given index."""
+        process = self.context.Process(target=run_worker, name="ritmo-worker-" + str(worker_index),
+                                       args=(worker_index, self.worker_shards[worker_index], self.shard_count))
+        process.start()
+
+        self.processes[worker_index] = process
+
+    def wait(self, seconds):
+        """Waits for the given number of seconds, or until the supervisor is stopped."""
+        deadline = time.monotonic() + seconds
+        while not self.stopping and time.monotonic() < deadline:
+            time.sleep(0.2)
+
+    def run(self):
+        """Starts every worker and restarts the workers that stop, until the supervisor is stopped."""
+        signal.signal(signal.SIGINT, self.on_signal)
+        signal.signal(signal.SIGTERM, self.on_signal)
+
+        for worker_index, shard_ids in enumerate(self.worker_shards):
+            if self.stopping:
+                break
+
+            self.start_worker(worker_index)
+
+            # The next worker waits until every shard of this worker has had its turn to identify.
+            self.wait(IDENTIFY_INTERVAL * len(shard_ids))
+
+        while not self.stopping:
+            self.wait(1)
+
+            for worker_index, process in list(self.processes.items()):
+                if self.stopping or process.is_alive():
+                    continue
+
+                if process.exitcode == EXIT_LOGIN_FAILED:
+                    print("Stopping since the bot could not log in.")
+                    self.stopping = True
+                    break
+
+                print("Worker " + str(worker_index) + " stopped with exit code " + str(process.exitcode) +
+                      ", restarting in " + str(self.restart_delay) + " seconds.")
+                self.wait(self.restart_delay)
+
+                if not self.stopping:
+                    self.start_worker(worker_index)
+
+        self.stop_workers()
+
+    def on_signal(self, _signal_number, _frame):
+        """Called when the supervisor is asked to stop, e.g. with ctrl+c."""
+        self.stopping = True
+
+    def stop_workers(self, timeout=30):
+        """
+        Asks every worker to stop, which lets them close their connections and save their song queues, and kills the
+        workers that have not stopped within the timeout.
+        """
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+
+        deadline = time.monotonic() + timeout
+        for process in self.processes.values():
+            process.join(max(deadline - time.monotonic(), 0))
+
+            if process.is_alive():
+                process.kill()
+                process.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs Ritmo as several worker processes that share the shards.")
+    parser.add_argument("--workers", type=int, help="The number of worker processes, by default the number of cores.")
+    parser.add_argument("--shards", type=int, help="The total number of shards, by default the number recommended by "
+                                                   "discord or the number of workers if that is higher.")
+    args = parser.parse_args()
+
+    config_dict = get_config()
+    worker_count = args.workers or config_dict.get("workers") or os.cpu_count() or 1
+
+    shard_count = args.shards or config_dict.get("shard count")
+    if shard_count is None:
+        shard_count = max(get_recommended_shard_count(config_dict["token"]), worker_count)
+
+    # A worker without shards would have nothing to do.
+    worker_count = min(worker_count, shard_count)
+
+    # Creating the playlist database and adding missing columns before the workers start, so the workers do not change
+    # the schema at the same time.
+    PlaylistStore().close()
+
+    print("Starting " + str(worker_count) + " workers with " + str(shard_count) + " shards")
+    Supervisor(worker_count, shard_count).run()
+
+
+if __name__ == '__main__':
+    main()
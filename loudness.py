@@ -0,0 +1,140 @@
+"""
+Module with functionality related to normalising the loudness of the downloaded songs. Each downloaded file is analysed
+once with a single ffmpeg pass and the gain needed to reach the target loudness is saved to an index next to the
+cached files, so playing a song only adds a fixed volume filter instead of a two-pass loudness normalisation.
+"""
+import json
+import math
+import subprocess
+
+from file_lock import SharedJsonFile
+from pathlib import Path
+
+
+class LoudnessIndex:
+    """
+    Class representing the index of the loudness of the cached audio files. The index is saved to a json file in the
+    cache folder and maps the id of each analysed video to its integrated loudness, true peak and gain.
+    """
+    def __init__(self, folder="audio_files/", target=-16.0, max_peak=-1.0, load=True, shared=False):
+        """
+        :param folder: The folder containing the cached audio files.
+        :param target: The integrated loudness in LUFS that the songs are normalised to.
+        :param max_peak: The highest true peak in dBTP allowed after the gain is applied, which keeps quiet songs with
+        loud peaks from clipping.
+        :param load: If false the index is not loaded until merge_index is called, e.g. from a background task.
+        :param shared: If true the index is shared with other worker processes, see launcher.py, and the analyses they
+        saved are merged into the index every time it is saved.
+        """
+        self.folder = folder
+        self.target = target
+        self.max_peak = max_peak
+        self.index_file = SharedJsonFile(folder + "loudness.json", shared)
+
+        # Dictionary from the video id to a dictionary with the integrated loudness, true peak and gain of the video.
+        self.entries = {}
+
+        Path(self.folder).mkdir(parents=True, exist_ok=True)
+
+        self.loaded = False
+        if load:
+            self.load_index()
+
+    def load_index(self):
+        """Loads the index from the index file."""
+        self.merge_index(self.read_index())
+
+    def read_index(self):
+        """Reads the entries from the index file without changing the index."""
+        return self.index_file.read({})
+
+    def merge_index(self, entries):
+        """Adds the entries read from the index file, keeping the analyses done since the bot started."""
+        entries.update(self.entries)
+        self.entries = entries
+        self.loaded = True
+
+    def save_index(self):
+        """
+        Saves the index to the index file on a thread, so the event loop is not blocked while the file is written. If
+        the index is shared, the analyses other workers saved are merged into the index once it has been saved.
+        """
+        # Saving before the index file has been loaded would drop the entries that have not been loaded yet.
+        if not self.loaded:
+            return
+
+        # The entries are replaced rather than changed, so a shallow copy can be saved while the index keeps changing.
+        self.index_file.save_in_background(lambda: dict(self.entries),
+                                           self.merge_index if self.index_file.shared else None)
+
+    async def close(self):
+        """Saves the index and waits until it has been written, e.g. when the bot is closed."""
+        self.save_index()
+        await self.index_file.flush()
+
+    def get_gain(self, video_id):
+        """
+        Returns the gain in dB that normalises the video to the target loudness, or None if it has not been analysed.
+
+        :param video_id: The id of the youtube video.
+        """
+        entry = self.entries.get(video_id)
+        return entry["gain"] if entry is not None else None
+
+    def add(self, video_id, loudness, peak):
+        """
+        Adds the result of the analysis of the video to the index.
+
+        :param video_id: The id of the youtube video.
+        :param loudness: The integrated loudness of the audio file in LUFS.
+        :param peak: The true peak of the audio file in dBTP.
+        """
+        gain = min(self.target - loudness, self.max_peak - peak)
+
+        # Silent files have an infinitely low loudness, so they are played as they are.
+        if not math.isfinite(gain):
+            gain = 0.0
+
+        self.entries[video_id] = {"loudness": loudness, "peak": peak, "gain": round(gain, 2)}
+        self.save_index()
+
+    def prune(self, video_ids):
+        """Removes the videos that are not in the given video ids, e.g. because their files were evicted."""
+        removed_video_ids = [video_id for video_id in self.entries if video_id not in video_ids]
+        for video_id in removed_video_ids:
+            del self.entries[video_id]
+
+        if removed_video_ids:
+            self.save_index()
+
+    def __contains__(self, video_id):
+        return video_id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def measure_loudness(path, threads=1):
+    """
+    Measures the integrated loudness and true peak of the audio file with the loudnorm filter of ffmpeg. The file is
+    decoded once and nothing is written.
+
+    :param path: The path of the audio file.
+    :param threads: The number of threads ffmpeg is allowed to use.
+    :return: A tuple with the integrated loudness in LUFS and the true peak in dBTP.
+    :raises OSError: If ffmpeg could not be started.
+    :raises ValueError: If ffmpeg could not analyse the file.
+    """
+    command = ["ffmpeg", "-hide_banner", "-nostats", "-threads", str(threads), "-i", path, "-vn",
+               "-af", "loudnorm=print_format=json", "-f", "null", "-"]
+    process = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    output = process.stderr.decode("utf-8", errors="replace")
+
+    # The loudnorm filter prints the measurements as a json object at the end of the output.
+    start = output.rfind("{")
+    end = output.rfind("}")
+    if process.returncode != 0 or start == -1 or end < start:
+        raise ValueError("Could not analyse the loudness of " + path + ": " + output[-200:].strip())
+
+    measurements = json.loads(output[start:end + 1])
+    return float(measurements["input_i"]), float(measurements["input_tp"])
@@ -0,0 +1,315 @@
+"""
+Module with functionality related to collecting metrics about the bot, e.g. how long commands, searches and downloads
+take. The metrics are exposed in the Prometheus text format, either through an http endpoint or by regularly writing
+them to a file, so regressions can be found in production.
+"""
+import asyncio
+import bisect
+import os
+import threading
+import time
+
+from aiohttp import web
+
+# The default upper bounds of the histogram buckets in seconds.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class Metric:
+    """
+    Base class of the metrics. A metric has a value for each combination of label values, or a single value if it has
+    no labels. Instead of being updated a metric can have a function that returns its current value when it is
+    collected. Metrics are updated from the download threads as well as the event loop so every update is done under a
+    lock.
+    """
+    type_name = None
+
+    def __init__(self, name, description, label_names=(), function=None):
+        """
+        :param name: The name of the metric, e.g. "ritmo_searches_total".
+        :param description: The description shown in the help line of the metric.
+        :param label_names: The names of the labels of the metric, e.g. ("command",).
+        :param function: Function that returns the current value of the metric when it is collected, either a number, a
+        dictionary from a tuple of label values to a number, or None if the metric currently has no value.
+        """
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.function = function
+
+        # Dictionary from a tuple of label values to the value of the metric with those labels.
+        self.values = {}
+        self.lock = threading.Lock()
+
+        REGISTRY.register(self)
+
+    def get_label_values(self, labels):
+        """Returns the values of the given labels in the order of the label names."""
+        return tuple(str(labels[label_name]) for label_name in self.label_names)
+
+    def get_label_str(self, label_values, extra_labels=()):
+        """Returns the labels in the Prometheus text format, e.g. '{command="play"}', or an empty string."""
+        labels = list(zip(self.label_names, label_values)) + list(extra_labels)
+        if not labels:
+            return ""
+
+        return "{" + ",".join(name + '="' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+                              for name, value in labels) + "}"
+
+    def get_values(self):
+        """Returns a copy of the values of the metric, calling the function of the metric if it has one."""
+        if self.function is None:
+            with self.lock:
+                return dict(self.values)
+
+        value = self.function()
+        if isinstance(value, dict):
+            return {tuple(str(label_value) for label_value in label_values): label_values_value
+                    for label_values, label_values_value in value.items()}
+
+        return {(): value} if value is not None else {}
+
+    def render(self):
+        """Returns the lines of the metric in the Prometheus text format."""
+        lines = ["# HELP " + self.name + " " + self.description, "# TYPE " + self.name + " " + self.type_name]
+        for label_values, value in sorted(self.get_values().items()):
+            lines.append(self.name + self.get_label_str(label_values) + " " + format_value(value))
+
+        return lines
+
+
+class Counter(Metric):
+    """Class representing a metric that only increases, e.g. the number of searches."""
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        """Increases the counter with the given labels by the amount."""
+        label_values = self.get_label_values(labels)
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    """Class representing a metric that can increase and decrease, e.g. the number of active sessions."""
+    type_name = "gauge"
+
+    def set(self, value, **labels):
+        """Sets the gauge with the given labels to the value."""
+        label_values = self.get_label_values(labels)
+        with self.lock:
+            self.values[label_values] = value
+
+    def inc(self, amount=1, **labels):
+        """Increases the gauge with the given labels by the amount."""
+        label_values = self.get_label_values(labels)
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        """Decreases the gauge with the given labels by the amount."""
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """
+    Class representing the distribution of a measurement, e.g. the latency of the searches. Each observation is counted
+    in the first bucket whose upper bound it does not exceed, and the counts are accumulated when the histogram is
+    rendered, so percentiles can be estimated from the bucket counts.
+    """
+    type_name = "histogram"
+
+    def __init__(self, name, description, label_names=(), buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets: The upper bounds of the buckets in increasing order.
+        """
+        super().__init__(name, description, label_names)
+        self.buckets = tuple(buckets)
+
+    def get_histogram(self, label_values):
+        """Returns the list with the counts of the histogram with the label values, creating it if it is missing."""
+        # Each histogram value is a list with the count of each bucket, a count of the values above every bucket, the
+        # sum and the total count.
+        histogram = self.values.get(label_values)
+        if histogram is None:
+            histogram = self.values[label_values] = [0] * (len(self.buckets) + 3)
+
+        return histogram
+
+    def observe(self, value, **labels):
+        """Adds the value to the histogram with the given labels."""
+        label_values = self.get_label_values(labels)
+        with self.lock:
+            histogram = self.get_histogram(label_values)
+            histogram[bisect.bisect_left(self.buckets, value)] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def labels(self, **labels):
+        """
+        Returns the histogram with the given labels, which observes values on the event loop without looking up its
+        labels every time. Used on hot paths, e.g. the histogram of each command is looked up once when the command is
+        registered.
+        """
+        label_values = self.get_label_values(labels)
+        with self.lock:
+            return HistogramChild(self, self.get_histogram(label_values))
+
+    def time(self, **labels):
+        """Returns a context manager that observes the number of seconds spent inside it."""
+        return Timer(self, labels)
+
+    def get_values(self):
+        with self.lock:
+            return {label_values: list(histogram) for label_values, histogram in self.values.items()}
+
+    def render(self):
+        lines = ["# HELP " + self.name + " " + self.description, "# TYPE " + self.name + " " + self.type_name]
+        for label_values, histogram in sorted(self.get_values().items()):
+            cumulative_count = 0
+            for upper_bound, count in zip(self.buckets, histogram):
+                cumulative_count += count
+                bucket_labels = [("le", format_value(upper_bound))]
+                lines.append(self.name + "_bucket" + self.get_label_str(label_values, bucket_labels) + " " +
+                             str(cumulative_count))
+
+            lines.append(self.name + "_bucket" + self.get_label_str(label_values, [("le", "+Inf")]) + " " +
+                         str(histogram[-1]))
+            lines.append(self.name + "_sum" + self.get_label_str(label_values) + " " + format_value(histogram[-2]))
+            lines.append(self.name + "_count" + self.get_label_str(label_values) + " " + str(histogram[-1]))
+
+        return lines
+
+
+class HistogramChild:
+    """
+    Class representing the histogram of a single combination of label values, see Histogram.labels. The values are
+    added without taking the lock of the histogram, so a child must only be observed from the event loop. Rendering the
+    histogram on another thread at the same time can at most see a value in the bucket counts before it is in the sum.
+    """
+    __slots__ = ("histogram", "counts")
+
+    def __init__(self, histogram, counts):
+        """
+        :param histogram: The Histogram the values are added to.
+        :param counts: The list with the counts of the histogram with the label values.
+        """
+        self.histogram = histogram
+        self.counts = counts
+
+    def observe(self, value):
+        """Adds the value to the histogram."""
+        counts = self.counts
+        counts[bisect.bisect_left(self.histogram.buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+
+class Timer:
+    """Context manager that observes the number of seconds spent inside it in a histogram."""
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Registry:
+    """Class containing every metric, used to render all of them at once."""
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        """Returns every metric in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                # A broken metric function should not stop the other metrics from being exposed.
+                print("Could not collect metric " + metric.name + ": " + str(e))
+
+        return "\n".join(lines) + "\n"
+
+    def write_file(self, path):
+        """Writes every metric to the file, replacing the old file atomically so readers never see a partial file."""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.render())
+
+        os.replace(tmp_path, path)
+
+    async def start_http_server(self, port, host="0.0.0.0"):
+        """
+        Starts an http server on the event loop that exposes the metrics on "/metrics" for Prometheus to scrape.
+
+        :param port: The port the server listens on.
+        :param host: The address the server listens on.
+        :return: The runner of the server, which can be used to stop it.
+        """
+        async def handle_metrics(_request):
+            return web.Response(body=self.render().encode("utf-8"),
+                                headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle_metrics)
+
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+
+        return runner
+
+    async def write_file_periodically(self, path, interval=60):
+        """Background task that writes every metric to the file every interval seconds."""
+        while True:
+            try:
+                self.write_file(path)
+            except OSError as e:
+                print("Could not write metrics to " + path + ": " + str(e))
+
+            await asyncio.sleep(interval)
+
+
+def format_value(value):
+    """Formats the number in the Prometheus text format, writing whole numbers without a decimal point."""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+
+    return str(value)
+
+
+REGISTRY = Registry()
+
+# Commands.
+COMMAND_DURATION = Histogram("ritmo_command_duration_seconds", "Time spent handling each command.", ["command"])
+
+# Youtube searches and downloads.
+SEARCH_DURATION = Histogram("ritmo_search_duration_seconds", "Time spent searching youtube.")
+SEARCHES = Counter("ritmo_searches_total", "Youtube searches by result (found, not_found or error).", ["result"])
+DOWNLOAD_DURATION = Histogram("ritmo_download_duration_seconds", "Time spent downloading the audio of a song.")
+DOWNLOAD_BYTES = Counter("ritmo_download_bytes_total", "Size of the downloaded audio files.")
+DOWNLOADS = Counter("ritmo_downloads_total", "Song downloads by result (downloaded, existing or error).", ["result"])
+LOUDNESS_ANALYSES = Counter("ritmo_loudness_analyses_total", "Loudness analyses by result (analyzed or error).",
+                            ["result"])
+
+# Playback.
+TIME_TO_FIRST_AUDIO = Histogram("ritmo_time_to_first_audio_seconds",
+                                "Time from starting an idle player until the first song is playing.")
+QUEUE_WAIT = Histogram("ritmo_queue_wait_seconds", "Time spent waiting for the download of a popped song.")
+SONG_GAP = Histogram("ritmo_song_gap_seconds", "Time from the end of a song until the next song is playing.",
+                     buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+
+# Playlist imports.
+IMPORT_DURATION = Histogram("ritmo_import_duration_seconds", "Time spent importing a spotify playlist.",
+                            buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
+IMPORTED_TRACKS = Counter("ritmo_imported_tracks_total",
+                          "Imported playlist tracks by result (found, not_found or error).", ["result"])
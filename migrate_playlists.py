@@ -0,0 +1,59 @@
+"""
+Script that migrates the playlists that were saved as pickle files in "playlists/<server id>/" to the playlist store.
+
+Usage: python migrate_playlists.py [--delete]
+
+With "--delete" the pickle files are removed after they have been migrated.
+"""
+import os
+import pickle
+import sys
+
+from playlist_store import PlaylistStore
+
+
+def migrate_playlists(store, playlists_folder="playlists/", delete=False):
+    """
+    Saves every pickled playlist in the playlists folder to the playlist store.
+
+    :param store: The PlaylistStore the playlists are saved to.
+    :param playlists_folder: The folder containing a folder with pickled playlists for each server.
+    :param delete: If true the pickle files are removed after they have been migrated.
+    :return: The number of playlists that were migrated.
+    """
+    migrated = 0
+
+    for server_id in os.listdir(playlists_folder):
+        server_folder = playlists_folder + server_id + "/"
+        if not server_id.isdigit() or not os.path.isdir(server_folder):
+            continue
+
+        for filename in os.listdir(server_folder):
+            if not filename.endswith(".pickle"):
+                continue
+
+            # Unpickling requires the spotify_playlist module since the pickles contain SpotifyPlaylist objects.
+            with open(server_folder + filename, "rb") as f:
+                playlist = pickle.load(f)
+
+            # The old playlists did not keep the URI separately but it is part of the raw spotify playlist object.
+            uri = getattr(playlist, "uri", None) or playlist.playlist.get("uri")
+            tracks = [(position, title, url, None, None) for position, (title, url) in enumerate(playlist.tracklist)]
+
+            store.save_playlist(int(server_id), playlist.name, uri, playlist.description, playlist.duration_ms,
+                                len(tracks), True, tracks)
+            migrated += 1
+            print("Migrated " + playlist.name + " (" + str(len(tracks)) + " songs) for server " + server_id)
+
+            if delete:
+                os.remove(server_folder + filename)
+
+    return migrated
+
+
+if __name__ == '__main__':
+    playlist_store = PlaylistStore()
+    count = migrate_playlists(playlist_store, delete="--delete" in sys.argv[1:])
+    playlist_store.close()
+
+    print("Migrated " + str(count) + " playlists.")
@@ -1,10 +1,17 @@
+import asyncio
 import discord
+import metrics
 import os
+import time
+import transcoder
+import youtube
 
 
 class Player:
     """
-    Class that handles functionality related to playing audio in a discord voice channel.
+    Class that handles functionality related to playing audio in a discord voice channel. In gapless mode the audio
+    source of the next song is opened while the current song is playing, so ffmpeg has already started and buffered the
+    beginning of the next song when the current song ends.
     """
     def __init__(self):
         self.voice_channel = None
@@ -12,15 +19,32 @@ class Player:
         self.song_queue = None
         self.voice_client = None
         self.current = None
+        self.current_title = None
+        self.loop = None
+        self.gapless = True
+
+        # The number of seconds into the next song that is started to play from, used when resuming after a restart.
+        self.start_position = None
+
+        # The next song and its opened audio source in gapless mode, and the task that is opening it.
+        self.preopened = None
+        self.preopen_task = None
+
+        # Performance counter timestamp of the end of the last song, used to measure the gap before the next song.
+        self.song_ended_at = None
+
+        # Lock that makes sure only one song is started at a time, since starting a song might wait for a download.
+        self.play_lock = asyncio.Lock()
 
     @classmethod
-    async def create(cls, voice_channel, user, song_queue):
+    async def create(cls, voice_channel, user, song_queue, gapless=True):
         """
         Initializing the attributes of the Player object using the factory pattern.
 
         :param voice_channel: The voice channel that the person that typed the "!play" command is in.
         :param user: The user representing the bot itself.
         :param song_queue: The queue that contains the currently queued songs.
+        :param gapless: If true the audio source of the next song is opened before the current song is done.
         :return: The fully initialized object.
         """
         self = Player()
@@ -28,46 +52,227 @@ class Player:
         self.voice_channel = voice_channel
         self.user = user
         self.song_queue = song_queue
+        self.loop = asyncio.get_event_loop()
+        self.gapless = gapless
 
         self.voice_client = await self.voice_channel.connect()
+        self.song_queue.record("join", voice=voice_channel.id)
 
         return self
 
-    def play(self, error=None):
+    async def play(self):
         """Iteratively plays every song in the song queue."""
-        # Needed by discord.py internal design when this function is called recursively in after=self.play.
-        if error:
-            raise Exception(str(error))
+        started_at = time.perf_counter()
+
+        async with self.play_lock:
+            if self.voice_client.is_playing() or self.voice_client.is_paused():
+                # The queue might have been empty when the current song started, so the next song is opened now.
+                self.schedule_preopen()
+                return
+
+            # The next song is started below, so a source that is still being opened would arrive too late.
+            if self.preopen_task is not None:
+                self.preopen_task.cancel()
+                self.preopen_task = None
 
-        if not self.voice_client.is_playing():
-            # Deleting the previously played song if there is one and if it isn't being played again shortly.
-            if self.current is not None and self.current not in self.song_queue.downloaded_queue:
-                os.remove(self.current)
+            # Letting the queue delete the previously played song if there is one and if it isn't being played again
+            # shortly.
+            self.song_queue.song_done()
+            self.current = None
+            self.current_title = None
+
+            # Only the first song that is started continues from the start position.
+            start_position = self.start_position
+            self.start_position = None
 
             # If there are any songs in the queue we play the song that is first in the queue.
-            if self.song_queue.queue:
-                self.current = self.song_queue.pop_song()
-                # Recursively calls the Player.play function after the song is done to iterate through the queue.
-                self.voice_client.play(discord.FFmpegPCMAudio(self.current), after=self.play)
+            while self.song_queue:
+                try:
+                    track, self.current = await self.song_queue.pop_song()
+                    audio_source = self.take_preopened_source(track)
+                    if audio_source is None:
+                        audio_source = await self.create_audio_source(track.url, self.current, start_position)
+                except Exception as e:
+                    # Skipping songs that could not be downloaded instead of stopping the whole queue. The song is done,
+                    # so it releases its reference in the audio cache.
+                    print("Could not download song: " + str(e))
+                    self.song_queue.song_done()
+                    self.current = None
+                    start_position = None
+                    continue
+
+                # The player can have been disconnected, e.g. by "!stop", while waiting for the download.
+                if not self.voice_client.is_connected():
+                    audio_source.cleanup()
+                    self.song_queue.song_done()
+                    self.current = None
+                    return
+
+                self.current_title = track.title
+
+                # Calls the Player.after_play function after the song is done to iterate through the queue.
+                self.voice_client.play(audio_source, after=self.after_play)
+                self.record_start(started_at)
+
+                if start_position:
+                    self.song_queue.record("seek", position=start_position)
+
+                self.schedule_preopen()
+                break
+            else:
+                # The queue ran out, so the next song that is started is measured from the play call, not as a gap.
+                self.song_ended_at = None
+
+    def record_start(self, started_at):
+        """
+        Records how long it took to start the song that was just started. Songs that follow another song are recorded as
+        the gap between the songs, otherwise the time since the play call is recorded.
+
+        :param started_at: Performance counter timestamp of the play call that started the song.
+        """
+        now = time.perf_counter()
+
+        if self.song_ended_at is None:
+            metrics.TIME_TO_FIRST_AUDIO.observe(now - started_at)
+            return
+
+        metrics.SONG_GAP.observe(now - self.song_ended_at)
+        self.song_ended_at = None
+
+    def schedule_preopen(self):
+        """Starts opening the audio source of the next song in the background if gapless mode is enabled."""
+        if not self.gapless or self.preopened is not None or self.preopen_task is not None:
+            return
+
+        if self.song_queue.peek() is not None:
+            self.preopen_task = self.loop.create_task(self.preopen_next())
+
+    async def preopen_next(self):
+        """
+        Waits for the download of the next song and opens its audio source, which starts ffmpeg so the beginning of the
+        song is buffered before the current song is done.
+        """
+        try:
+            track = self.song_queue.peek()
+            download = self.song_queue.downloads.get(track.video_id) if track is not None else None
+
+            # If the song is not downloading yet it is outside the prefetch window and opened the normal way instead.
+            if download is None:
+                return
 
-                # Pre-download the first 2 songs on in the queue and add them to the download queue.
-                self.song_queue.update_downloaded_queue()
+            try:
+                source = await asyncio.shield(download)
+            except (asyncio.CancelledError, Exception):
+                return
+
+            # The queue can have been changed by a skip or a shuffle while waiting for the download.
+            if self.song_queue.peek() is not track or not self.voice_client.is_connected():
+                return
+
+            try:
+                self.preopened = (track, await self.create_audio_source(track.url, source))
+            except Exception as e:
+                print("Could not open the next song: " + str(e))
+        finally:
+            if self.preopen_task is asyncio.current_task():
+                self.preopen_task = None
+
+    def take_preopened_source(self, track):
+        """
+        Returns the opened audio source if it belongs to the given track, which is the song that is about to be played.
+        Sources opened for songs that are no longer next are closed.
+        """
+        if self.preopened is None:
+            return None
+
+        preopened_track, audio_source = self.preopened
+        self.preopened = None
+
+        if preopened_track is track:
+            return audio_source
+
+        audio_source.cleanup()
+        return None
+
+    def discard_preopened_source(self):
+        """Stops opening the next song and closes its audio source if it is already open."""
+        if self.preopen_task is not None:
+            self.preopen_task.cancel()
+            self.preopen_task = None
+
+        if self.preopened is not None:
+            self.preopened[1].cleanup()
+            self.preopened = None
+
+    async def create_audio_source(self, url, source, start=None):
+        """
+        Creates the audio source that is played in the voice channel with the ffmpeg options of the transcoder. If the
+        audio stream can not be opened the song is downloaded and played from the file instead. Downloaded songs are
+        played with the gain that normalises their loudness.
+
+        :param url: The youtube url of the song.
+        :param source: Either the filename of the downloaded song or the audio stream of the song.
+        :param start: The number of seconds into the song to start playing from, or None to play it from the start.
+        :return: The audio source that can be played by the voice client.
+        """
+        pipeline = self.song_queue.pipeline
+        audio_transcoder = pipeline.transcoder
+
+        if isinstance(source, youtube.AudioStream):
+            try:
+                return audio_transcoder.create_audio_source(source, start=start)
+            except discord.ClientException as e:
+                print("Could not open audio stream, downloading instead: " + str(e))
+                source = await pipeline.download(url, transcoder.PLAYBACK)
+        elif not os.path.isfile(source):
+            # The file can have been evicted by another worker sharing the audio cache since it was downloaded.
+            source = await pipeline.download(url, transcoder.PLAYBACK)
+
+        return audio_transcoder.create_audio_source(source, pipeline.get_gain(url, source), start)
+
+    def after_play(self, error=None):
+        """
+        Called by discord.py from the audio thread when a song is done. Schedules the next song on the event loop since
+        the queue can only be used from the event loop.
+        """
+        # Needed by discord.py internal design when this function is called in after=self.after_play.
+        if error:
+            print("Error while playing song: " + str(error))
+
+        self.song_ended_at = time.perf_counter()
+
+        if self.voice_client.is_connected():
+            asyncio.run_coroutine_threadsafe(self.play(), self.loop)
 
     async def stop(self, message):
         """Stops the audio and disconnects the bot from the voice channel."""
         # Only works if the message is from a user that is in the same voice channel as the bot.
         if message.author.voice.channel.id == self.voice_channel.id:
+            await self.disconnect()
+
+    async def disconnect(self):
+        """Disconnects the bot from the voice channel regardless of who asked for it."""
+        self.discard_preopened_source()
+        self.song_queue.record("leave")
+
+        if self.voice_client.is_connected():
             await self.voice_client.disconnect()
 
+    def is_active(self):
+        """Returns true if the player is connected and currently playing or paused."""
+        return self.voice_client.is_connected() and (self.voice_client.is_playing() or self.voice_client.is_paused())
+
     def pause(self):
         """Pauses the audio playing if it is playing."""
         if self.voice_client.is_playing():
             self.voice_client.pause()
+            self.song_queue.record("pause")
 
     def resume(self):
         """Resumes the audio playing if it is paused."""
         if self.voice_client.is_paused():
             self.voice_client.resume()
+            self.song_queue.record("resume")
 
     def skip(self):
         """Skips the currently playing song."""
@@ -76,6 +281,6 @@ class Player:
     async def now_playing(self, message):
         """Sends a message displaying the currently playing song."""
         if self.voice_client and self.voice_client.is_playing():
-            await message.channel.send("```Now playing:\n" + self.current[24:-4] + "```")
+            await message.channel.send("```Now playing:\n" + self.current_title + "```")
         else:
             await message.channel.send("```Currently not playing anything.```")
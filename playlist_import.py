@@ -0,0 +1,221 @@
+"""
+Module with functionality related to importing spotify playlists in the background. Every song in the playlist has to
+be found on youtube, which takes minutes for large playlists, so the songs are searched for concurrently while the bot
+keeps responding to other commands.
+"""
+import asyncio
+import metrics
+import time
+import youtube
+
+from spotify_playlist import SpotifyPlaylist
+
+
+class PlaylistImport:
+    """
+    Class representing the import of a spotify playlist. The songs are searched for concurrently and the partially
+    imported playlist is saved regularly so an interrupted import can be resumed by creating the playlist again.
+    """
+    def __init__(self, playlist, store, pipeline, channel, parallelism=8, save_every=25, progress_interval=5):
+        """
+        :param playlist: The SpotifyPlaylist that is being imported.
+        :param store: The PlaylistStore the playlist is saved to.
+        :param pipeline: The download pipeline used to search for the songs on youtube.
+        :param channel: The channel that the progress of the import is reported to.
+        :param parallelism: The maximum number of songs that are searched for at the same time.
+        :param save_every: The number of songs that are found between each save of the partially imported playlist.
+        :param progress_interval: The minimum number of seconds between each update of the progress message.
+        """
+        self.playlist = playlist
+        self.store = store
+        self.pipeline = pipeline
+        self.channel = channel
+        self.parallelism = parallelism
+        self.save_every = save_every
+        self.progress_interval = progress_interval
+
+        self.progress_message = None
+        self.last_progress_update = 0
+
+        # The positions of the songs that have been resolved since the playlist was last saved.
+        self.unsaved_positions = []
+
+        # The number of songs whose search could not reach youtube. The import is not complete if any search failed.
+        self.failed_searches = 0
+
+        # Generator of the search queries of the playlist. It fetches the pages of the playlist lazily so it is advanced
+        # off the event loop, by one worker at a time.
+        self.search_queries = playlist.iter_search_queries()
+        self.search_queries_lock = asyncio.Lock()
+
+        # Condition that is notified every time a song is resolved, used by listeners waiting for songs in order.
+        self.track_resolved = asyncio.Condition()
+
+    @classmethod
+    async def create(cls, playlist_uri, server_id, store, pipeline, channel, parallelism=8):
+        """
+        Retrieves the playlist from spotify and prepares the import using the factory pattern. If an earlier import of
+        the same playlist was interrupted the songs it found are reused.
+
+        :param playlist_uri: The spotify URI of the playlist.
+        :param server_id: The id of the server that the playlist is saved to.
+        :param store: The PlaylistStore the playlist is saved to.
+        :param pipeline: The download pipeline used to search for the songs on youtube.
+        :param channel: The channel that the progress of the import is reported to.
+        :param parallelism: The maximum number of songs that are searched for at the same time.
+        :return: The import, ready to be run.
+        """
+        loop = asyncio.get_event_loop()
+        playlist = await loop.run_in_executor(None, SpotifyPlaylist, playlist_uri, server_id)
+
+        saved_playlist = store.get_playlist(server_id, playlist.name)
+        if saved_playlist is not None:
+            playlist.resume_from(saved_playlist, store.get_resolved_tracks(saved_playlist.id))
+
+            # If the saved playlist is not resumed it is replaced so no songs from the old version are left behind.
+            if not playlist.resolved_tracks:
+                store.delete_playlist(server_id, playlist.name)
+
+        return cls(playlist, store, pipeline, channel, parallelism)
+
+    @property
+    def name(self):
+        return self.playlist.name
+
+    def is_resolved(self, position):
+        """Returns true if the song at the position has been searched for, whether or not it was found."""
+        return position in self.playlist.resolved_tracks
+
+    async def run(self):
+        """Searches for every song that has not been found yet and saves the playlist when every song is resolved."""
+        start = time.perf_counter()
+        self.playlist.save_playlist(self.store)
+        await self.report_progress(force=True)
+
+        # Every worker searches for the next unresolved song until there are no songs left, so at most "parallelism"
+        # searches are running at the same time.
+        workers = [asyncio.ensure_future(self.resolve_worker()) for _ in range(self.parallelism)]
+        complete = False
+        try:
+            await asyncio.gather(*workers)
+            complete = self.failed_searches == 0
+        finally:
+            # If a worker failed, e.g. because a page of the playlist could not be fetched from spotify, or the import
+            # was cancelled, the other workers are stopped as well.
+            for worker in workers:
+                worker.cancel()
+
+            # The playlist can have changed on spotify since the first page was fetched, so songs that were never
+            # returned are marked as not found to release the listeners waiting for them. They are only saved as not
+            # found if the import is complete, so an import that failed searches for them when it is resumed.
+            async with self.track_resolved:
+                for position in range(self.playlist.track_count):
+                    if not self.is_resolved(position):
+                        self.playlist.resolved_tracks[position] = None
+                        if complete:
+                            self.unsaved_positions.append(position)
+                self.track_resolved.notify_all()
+
+            self.playlist.complete = complete
+            self.save_progress()
+
+        await self.report_progress(force=True)
+
+        metrics.IMPORT_DURATION.observe(time.perf_counter() - start)
+
+    async def next_search_query(self):
+        """Returns the next position and search query of the playlist, or None when every song has been returned."""
+        async with self.search_queries_lock:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(None, next, self.search_queries, None)
+
+    async def resolve_worker(self):
+        """Searches for the songs of the playlist that have not been resolved until there are no songs left."""
+        while True:
+            position_query = await self.next_search_query()
+            if position_query is None:
+                return
+
+            position, search_query, duration_ms = position_query
+            if self.is_resolved(position):
+                continue
+
+            # The video with the duration closest to the duration on spotify is chosen among the first search results,
+            # so music videos with long intros and hour long loops are skipped.
+            search_failed = False
+            try:
+                result = await self.pipeline.resolve(search_query, duration_ms) if search_query is not None else None
+            except youtube.VideoNotFoundError as e:
+                print(str(e))
+                result = None
+            except youtube.SearchFailedError as e:
+                print(str(e))
+                result = None
+                search_failed = True
+
+            title_url = (result.title, result.url) if result is not None else None
+            if result is not None:
+                video_duration_ms = result.duration * 1000 if result.duration is not None else None
+                self.playlist.track_durations[position] = (duration_ms, video_duration_ms)
+
+            async with self.track_resolved:
+                self.playlist.resolved_tracks[position] = title_url
+                self.track_resolved.notify_all()
+
+            # Songs whose search could not reach youtube are skipped by the listeners but not saved as not found, so
+            # they are searched for again when the import is resumed.
+            if search_failed:
+                metrics.IMPORTED_TRACKS.inc(result="error")
+                self.failed_searches += 1
+                continue
+
+            metrics.IMPORTED_TRACKS.inc(result="found" if title_url is not None else "not_found")
+
+            # Saving the partial results regularly so an interrupted import does not have to start over.
+            self.unsaved_positions.append(position)
+            if len(self.unsaved_positions) >= self.save_every:
+                self.save_progress()
+
+            await self.report_progress()
+
+    def save_progress(self):
+        """Saves the playlist information and the songs resolved since the last save to the playlist store."""
+        self.playlist.save_playlist(self.store, self.unsaved_positions)
+        self.unsaved_positions = []
+
+    async def iter_tracks(self):
+        """
+        Asynchronously yields the songs of the playlist in order, waiting for each song to be resolved. This makes it
+        possible to start playing the playlist before the import is done.
+        """
+        for position in range(self.playlist.track_count):
+            async with self.track_resolved:
+                await self.track_resolved.wait_for(lambda: self.is_resolved(position))
+
+            title_url = self.playlist.resolved_tracks[position]
+            if title_url is not None:
+                yield title_url
+
+    async def report_progress(self, force=False):
+        """Sends or updates a message in the channel with the number of songs that have been searched for so far."""
+        if not force and time.monotonic() - self.last_progress_update < self.progress_interval:
+            return
+        self.last_progress_update = time.monotonic()
+
+        resolved = len(self.playlist.resolved_tracks)
+        total = self.playlist.track_count
+        status = "Imported" if self.playlist.complete else "Importing"
+
+        progress_str = "```" + status + " " + self.name + ": " + str(resolved) + "/" + str(total) + " songs"
+
+        # The songs whose search failed are searched for again when the playlist is created again.
+        if self.failed_searches:
+            progress_str += " (" + str(self.failed_searches) + " could not be searched for, create the playlist " + \
+                "again to retry them)"
+
+        progress_str += "```"
+
+        if self.progress_message is None:
+            self.progress_message = await self.channel.send(progress_str)
+        else:
+            await self.progress_message.edit(content=progress_str)
@@ -0,0 +1,195 @@
+"""
+Module with functionality related to keeping the saved playlists in memory. The playlist metadata of each server is
+indexed and the songs of recently used playlists are cached, so repeated "!play", "!info", "!tracklist" and
+"!list playlists" commands are answered without reading from the database.
+"""
+import os
+import time
+
+from collections import OrderedDict
+
+
+class PlaylistIndex:
+    """
+    Class that wraps a PlaylistStore with an in-memory index of the playlists of each server and a size bounded LRU
+    cache of the songs of the playlists. Changes made through the index invalidate the affected entries, and the whole
+    index is invalidated when the database files are changed by another process, e.g. the migration script.
+    """
+    def __init__(self, store, max_cached_songs=50000, check_interval=1):
+        """
+        :param store: The PlaylistStore containing the playlists.
+        :param max_cached_songs: The maximum total number of songs that are kept in the song cache.
+        :param check_interval: The minimum number of seconds between each check of the database modification times.
+        """
+        self.store = store
+        self.max_cached_songs = max_cached_songs
+        self.check_interval = check_interval
+
+        # Dictionary from the server id to a dictionary from playlist name to the SavedPlaylist with that name.
+        self.guild_indexes = {}
+
+        # Dictionary from the playlist id to the list of songs in the playlist, ordered from least to most recently used.
+        self.songs = OrderedDict()
+        self.cached_songs = 0
+
+        # The ids of the playlists with more songs than fit in the song cache, whose pages are read from the store.
+        self.uncached_playlist_ids = set()
+
+        # Modification times of the database files, used to notice changes made by other processes.
+        self.paths = [store.path, store.path + "-wal"]
+        self.mtimes = self.get_mtimes()
+        self.last_check = time.monotonic()
+
+    def get_mtimes(self):
+        """Returns the modification times of the database files, with None for files that do not exist."""
+        mtimes = []
+        for path in self.paths:
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except FileNotFoundError:
+                mtimes.append(None)
+
+        return mtimes
+
+    def check_for_changes(self):
+        """Invalidates everything if the database files have been modified since they were last checked."""
+        if time.monotonic() - self.last_check < self.check_interval:
+            return
+        self.last_check = time.monotonic()
+
+        mtimes = self.get_mtimes()
+        if mtimes != self.mtimes:
+            self.mtimes = mtimes
+            self.invalidate()
+
+    def invalidate(self, guild_id=None, playlist_id=None):
+        """
+        Removes entries from the index and the song cache. With no arguments everything is removed.
+
+        :param guild_id: The id of the server whose playlist index should be removed.
+        :param playlist_id: The id of the playlist whose songs should be removed from the song cache.
+        """
+        if guild_id is None and playlist_id is None:
+            self.guild_indexes = {}
+            self.songs = OrderedDict()
+            self.cached_songs = 0
+            self.uncached_playlist_ids = set()
+            return
+
+        if guild_id is not None:
+            self.guild_indexes.pop(guild_id, None)
+
+        if playlist_id is not None:
+            self.uncached_playlist_ids.discard(playlist_id)
+            if playlist_id in self.songs:
+                self.cached_songs -= len(self.songs.pop(playlist_id))
+
+    def get_guild_index(self, guild_id):
+        """Returns the dictionary from playlist name to SavedPlaylist of the server, loading it if needed."""
+        self.check_for_changes()
+
+        guild_index = self.guild_indexes.get(guild_id)
+        if guild_index is None:
+            guild_index = {playlist.name: playlist for playlist in self.store.list_playlists(guild_id)}
+            self.guild_indexes[guild_id] = guild_index
+
+        return guild_index
+
+    def warm(self, guild_ids):
+        """
+        Loads the playlist indexes of the servers with a single query, so the first playlist command in each server
+        does not have to read from the database. Servers that are already indexed are left as they are.
+
+        :param guild_ids: The ids of the servers whose playlists should be indexed.
+        """
+        self.check_for_changes()
+
+        guild_indexes = {guild_id: {} for guild_id in guild_ids}
+        for playlist in self.store.list_all_playlists():
+            if playlist.guild_id in guild_indexes:
+                guild_indexes[playlist.guild_id][playlist.name] = playlist
+
+        for guild_id, guild_index in guild_indexes.items():
+            self.guild_indexes.setdefault(guild_id, guild_index)
+
+    def get_playlist(self, guild_id, name):
+        """Returns the SavedPlaylist with the given name from the server, or None if there is no such playlist."""
+        return self.get_guild_index(guild_id).get(name)
+
+    def list_playlists(self, guild_id):
+        """Returns the SavedPlaylists of the server ordered by name."""
+        return sorted(self.get_guild_index(guild_id).values(), key=lambda playlist: playlist.name)
+
+    def get_songs(self, playlist_id, limit=-1, offset=0):
+        """
+        Returns a page of the songs in the playlist that were found on youtube, in the order of the playlist. The songs
+        of the playlist are cached unless the playlist is too large to fit in the cache.
+
+        :param playlist_id: The id of the playlist.
+        :param limit: The maximum number of songs to return, or -1 to return every song after the offset.
+        :param offset: The number of found songs to skip.
+        :return: A list of tuples with the format: (song title, youtube URL).
+        """
+        self.check_for_changes()
+
+        # Only the requested page of a playlist that is too large to cache is read, instead of every song in it.
+        if playlist_id in self.uncached_playlist_ids:
+            return self.store.get_songs(playlist_id, limit, offset)
+
+        songs = self.songs.get(playlist_id)
+        if songs is None:
+            # Reading one song more than fits in the cache tells whether the playlist is too large without reading it.
+            songs = self.store.get_songs(playlist_id, self.max_cached_songs + 1)
+
+            if len(songs) > self.max_cached_songs:
+                self.uncached_playlist_ids.add(playlist_id)
+                return self.store.get_songs(playlist_id, limit, offset)
+
+            self.songs[playlist_id] = songs
+            self.cached_songs += len(songs)
+            self.evict()
+        else:
+            self.songs.move_to_end(playlist_id)
+
+        return songs[offset:] if limit < 0 else songs[offset:offset + limit]
+
+    def iter_songs(self, playlist_id):
+        """Yields the songs in the playlist from the song cache if they are cached, otherwise from the store."""
+        self.check_for_changes()
+
+        songs = self.songs.get(playlist_id)
+        if songs is not None:
+            self.songs.move_to_end(playlist_id)
+            return iter(songs)
+
+        return self.store.iter_songs(playlist_id)
+
+    def evict(self):
+        """Removes the songs of the least recently used playlists until the song cache is within its size bound."""
+        while self.cached_songs > self.max_cached_songs:
+            _playlist_id, songs = self.songs.popitem(last=False)
+            self.cached_songs -= len(songs)
+
+    def save_playlist(self, guild_id, name, *args, **kwargs):
+        """Saves the playlist to the store and invalidates the index of the server and the songs of the playlist."""
+        playlist_id = self.store.save_playlist(guild_id, name, *args, **kwargs)
+        self.invalidate(guild_id, playlist_id)
+
+        # Our own changes are already handled, so they should not invalidate the whole index on the next check.
+        self.mtimes = self.get_mtimes()
+
+        return playlist_id
+
+    def delete_playlist(self, guild_id, name):
+        """Deletes the playlist from the store and invalidates the index of the server and the songs of the playlist."""
+        playlist = self.get_playlist(guild_id, name)
+
+        deleted = self.store.delete_playlist(guild_id, name)
+        self.invalidate(guild_id, playlist.id if playlist is not None else None)
+        self.mtimes = self.get_mtimes()
+
+        return deleted
+
+    def get_resolved_tracks(self, playlist_id):
+        """Returns every track of the playlist that has been searched for. Only used when resuming, so not cached."""
+        return self.store.get_resolved_tracks(playlist_id)
@@ -0,0 +1,240 @@
+"""
+Module with functionality related to storing the playlists of the servers in an SQLite database. The metadata of the
+playlists is kept in its own table so listing the playlists of a server and showing information about a playlist are
+single indexed queries, and the tracklists are read a page at a time.
+"""
+import sqlite3
+
+from pathlib import Path
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS playlists (
+    id INTEGER PRIMARY KEY,
+    guild_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    uri TEXT,
+    description TEXT NOT NULL DEFAULT '',
+    duration_ms INTEGER NOT NULL DEFAULT 0,
+    track_count INTEGER NOT NULL DEFAULT 0,
+    song_count INTEGER NOT NULL DEFAULT 0,
+    complete INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (guild_id, name)
+);
+
+CREATE TABLE IF NOT EXISTS tracks (
+    playlist_id INTEGER NOT NULL REFERENCES playlists (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    title TEXT,
+    url TEXT,
+    duration_ms INTEGER,
+    video_duration_ms INTEGER,
+    PRIMARY KEY (playlist_id, position)
+) WITHOUT ROWID;
+"""
+
+# Columns added to the tables after they were first created, with their definitions. Databases created by older versions
+# are upgraded by adding the missing columns.
+ADDED_COLUMNS = {
+    "tracks": [("duration_ms", "INTEGER"), ("video_duration_ms", "INTEGER")],
+}
+
+
+class SavedPlaylist:
+    """Class representing the metadata of a playlist that is saved in the playlist store."""
+    def __init__(self, row):
+        """
+        :param row: The row from the playlists table.
+        """
+        self.id = row["id"]
+        self.guild_id = row["guild_id"]
+        self.name = row["name"]
+        self.uri = row["uri"]
+        self.description = row["description"]
+        self.duration_ms = row["duration_ms"]
+
+        # The number of tracks in the spotify playlist and the number of those that were found on youtube.
+        self.track_count = row["track_count"]
+        self.song_count = row["song_count"]
+        self.complete = bool(row["complete"])
+
+    def get_info_str(self, verbose=True):
+        """
+        Returns a prettified string containing information about the playlist.
+
+        :param verbose: Bool that decides whether or not to add the description to the info string.
+        """
+        # Converting the duration from ms to hours and minutes.
+        duration_mins = int((self.duration_ms / (1000 * 60)) % 60)
+        duration_hours = int((self.duration_ms / (1000 * 60 * 60)) % 24)
+
+        info_str = self.name + " - " + str(self.song_count) + " songs - " + str(duration_hours) + " hr " + \
+                   str(duration_mins) + " min"
+        if verbose:
+            info_str += "\n\n" + self.description
+
+        return info_str
+
+    @staticmethod
+    def get_tracklist_str(songs, start_index):
+        """
+        Creates a prettified string containing the given page of songs from the tracklist.
+
+        :param songs: The songs on the page, each a tuple with the format: (song title, youtube URL).
+        :param start_index: The index of the first song on the page in the tracklist.
+        :return: The prettified string containing the songs.
+        """
+        songs_str = ""
+        for counter, song in enumerate(songs):
+            songs_str += str(counter + start_index + 1) + ". " + song[0] + "\n"
+
+        return songs_str
+
+
+class PlaylistStore:
+    """Class representing the SQLite database containing the saved playlists of every server."""
+    def __init__(self, path="playlists/playlists.db", busy_timeout=30):
+        """
+        :param path: The path of the SQLite database file.
+        :param busy_timeout: The number of seconds a write waits for another process to unlock the database before it
+        fails, e.g. another worker of a sharded bot, see launcher.py.
+        """
+        self.path = path
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+        self.connection = sqlite3.connect(path, timeout=busy_timeout)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA foreign_keys = ON")
+
+        # Write-ahead logging lets readers and the writer work at the same time.
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.executescript(SCHEMA)
+        self.add_missing_columns()
+
+    def add_missing_columns(self):
+        """Adds the columns that are missing from tables created by older versions of the schema."""
+        with self.connection:
+            for table, columns in ADDED_COLUMNS.items():
+                existing_columns = {row["name"] for row in self.connection.execute("PRAGMA table_info(" + table + ")")}
+
+                for name, definition in columns:
+                    if name not in existing_columns:
+                        self.connection.execute("ALTER TABLE " + table + " ADD COLUMN " + name + " " + definition)
+
+    def get_playlist(self, guild_id, name):
+        """Returns the SavedPlaylist with the given name from the server, or None if there is no such playlist."""
+        row = self.connection.execute("SELECT * FROM playlists WHERE guild_id = ? AND name = ?",
+                                      (guild_id, name)).fetchone()
+
+        return SavedPlaylist(row) if row is not None else None
+
+    def list_playlists(self, guild_id):
+        """Returns the SavedPlaylists of the server ordered by name."""
+        rows = self.connection.execute("SELECT * FROM playlists WHERE guild_id = ? ORDER BY name", (guild_id,))
+
+        return [SavedPlaylist(row) for row in rows]
+
+    def list_all_playlists(self):
+        """Returns the SavedPlaylists of every server ordered by server and name."""
+        rows = self.connection.execute("SELECT * FROM playlists ORDER BY guild_id, name")
+
+        return [SavedPlaylist(row) for row in rows]
+
+    def save_playlist(self, guild_id, name, uri, description, duration_ms, track_count, complete, tracks):
+        """
+        Creates or updates the playlist and saves the given tracks in a single transaction.
+
+        :param guild_id: The id of the server that the playlist belongs to.
+        :param name: The name of the playlist.
+        :param uri: The spotify URI of the playlist.
+        :param description: The description of the playlist.
+        :param duration_ms: The total duration of the playlist in milliseconds.
+        :param track_count: The number of tracks in the spotify playlist.
+        :param complete: True if every track in the playlist has been searched for.
+        :param tracks: Iterable of tuples with the format: (position, song title, youtube URL, spotify duration in ms,
+        youtube duration in ms). The title and URL are None for tracks that could not be found, and the durations are
+        None if they are unknown.
+        :return: The id of the playlist.
+        """
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO playlists (guild_id, name, uri, description, duration_ms, track_count, complete) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (guild_id, name) DO UPDATE SET uri = excluded.uri, "
+                "description = excluded.description, duration_ms = excluded.duration_ms, "
+                "track_count = excluded.track_count, complete = excluded.complete",
+                (guild_id, name, uri, description, duration_ms, track_count, int(complete)))
+
+            playlist_id = self.connection.execute("SELECT id FROM playlists WHERE guild_id = ? AND name = ?",
+                                                  (guild_id, name)).fetchone()["id"]
+
+            self.connection.executemany("INSERT OR REPLACE INTO tracks (playlist_id, position, title, url, "
+                                        "duration_ms, video_duration_ms) VALUES (?, ?, ?, ?, ?, ?)",
+                                        ((playlist_id,) + tuple(track) for track in tracks))
+
+            # Keeping the number of found songs in the metadata so listing the playlists does not touch the tracks.
+            self.connection.execute("UPDATE playlists SET song_count = (SELECT COUNT(*) FROM tracks WHERE "
+                                    "playlist_id = ? AND url IS NOT NULL) WHERE id = ?", (playlist_id, playlist_id))
+
+        return playlist_id
+
+    def delete_playlist(self, guild_id, name):
+        """
+        Deletes the playlist and its tracks.
+
+        :return: True if the playlist existed, false otherwise.
+        """
+        with self.connection:
+            cursor = self.connection.execute("DELETE FROM playlists WHERE guild_id = ? AND name = ?", (guild_id, name))
+
+        return cursor.rowcount > 0
+
+    def get_songs(self, playlist_id, limit=-1, offset=0):
+        """
+        Returns a page of the songs in the playlist that were found on youtube, in the order of the playlist.
+
+        :param playlist_id: The id of the playlist.
+        :param limit: The maximum number of songs to return, or -1 to return every song after the offset.
+        :param offset: The number of found songs to skip.
+        :return: A list of tuples with the format: (song title, youtube URL).
+        """
+        rows = self.connection.execute("SELECT title, url FROM tracks WHERE playlist_id = ? AND url IS NOT NULL "
+                                       "ORDER BY position LIMIT ? OFFSET ?", (playlist_id, limit, offset))
+
+        return [(row["title"], row["url"]) for row in rows]
+
+    def iter_songs(self, playlist_id, batch_size=500):
+        """
+        Yields the songs in the playlist that were found on youtube, in the order of the playlist. The songs are read in
+        batches, continuing from the position of the last song, so only one batch is in memory at a time.
+
+        :param playlist_id: The id of the playlist.
+        :param batch_size: The number of songs read from the database at a time.
+        :return: A generator of tuples with the format: (song title, youtube URL).
+        """
+        last_position = -1
+        while True:
+            rows = self.connection.execute("SELECT position, title, url FROM tracks WHERE playlist_id = ? AND "
+                                           "position > ? AND url IS NOT NULL ORDER BY position LIMIT ?",
+                                           (playlist_id, last_position, batch_size)).fetchall()
+
+            for row in rows:
+                yield row["title"], row["url"]
+
+            if len(rows) < batch_size:
+                return
+
+            last_position = rows[-1]["position"]
+
+    def get_resolved_tracks(self, playlist_id):
+        """
+        Returns every track of the playlist that has been searched for, used to resume an interrupted import.
+
+        :return: A dictionary from the position of each track to a tuple with the format: (song title, youtube URL), or
+        None if the track could not be found.
+        """
+        rows = self.connection.execute("SELECT position, title, url FROM tracks WHERE playlist_id = ?", (playlist_id,))
+
+        return {row["position"]: (row["title"], row["url"]) if row["url"] is not None else None for row in rows}
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,328 @@
+"""
+Module with functionality related to persisting the song queues of the servers, so the bot can resume playing after a
+crash or a restart. Every change to a queue is appended to a journal file as a single json line, which is cheap enough
+to do for every command. The journal is compacted regularly by replacing it with one snapshot of the state of each
+server, which keeps the file small no matter how long the bot has been running. The snapshot is written on a thread, so
+compacting the queues of many servers does not block the event loop.
+"""
+import asyncio
+import json
+import os
+import time
+
+
+def create_state():
+    """
+    Returns the state of a server without queued songs. The queued songs are kept as a list of segments in the order
+    they are played, where each segment is either ["songs", [[title, url], ...]] or ["playlist", playlist id, offset,
+    count] for songs read from a saved playlist, so queueing a large playlist only adds a small record to the journal.
+    """
+    return {"voice": None, "current": None, "position": 0.0, "playing_since": None, "segments": []}
+
+
+def get_position(state, now):
+    """
+    Returns the number of seconds of the current song that had been played at the given time.
+
+    :param state: The state of the server.
+    :param now: The unix timestamp the position is computed for.
+    """
+    if state["playing_since"] is None:
+        return state["position"]
+
+    return state["position"] + max(now - state["playing_since"], 0.0)
+
+
+class QueueJournal:
+    """
+    Class representing the journal of the changes to the song queues. The journal keeps the state of every server in
+    memory by applying each record as it is appended, which is the same thing that is done when the file is read, so
+    the state can be written as a snapshot at any time without looking at the live queues.
+    """
+    def __init__(self, path="queue_journal.jsonl", compact_interval=60, max_records=5000):
+        """
+        :param path: The path of the journal file.
+        :param compact_interval: The number of seconds between each compaction of the journal.
+        :param max_records: The number of records appended since the last compaction that triggers a compaction right
+        away, so a burst of commands can not make the file grow until the next periodic compaction.
+        """
+        self.path = path
+        self.compact_interval = compact_interval
+        self.max_records = max_records
+
+        # Dictionary from the server id to the state of the queue of that server, see create_state.
+        self.states = {}
+
+        # Records made before the journal file is loaded, which are appended once it has been loaded.
+        self.buffered = []
+        self.loaded = False
+
+        self.file = None
+        self.records_since_compaction = 0
+
+        # The compaction that is writing a snapshot on a thread, if any, and the lines appended to the journal since the
+        # snapshot was taken, which are appended to the snapshot before it replaces the journal.
+        self.compaction = None
+        self.lines_since_snapshot = []
+
+    def load(self):
+        """
+        Reads the state of every server from the journal file and compacts it. Servers that already changed their
+        queue before the journal was loaded start from those changes instead of the saved state, since their session
+        was already created from scratch.
+
+        :return: The dictionary from the server id to the state read from the file.
+        """
+        self.states = {}
+        last_timestamp = None
+        try:
+            with open(self.path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        self.apply(record)
+                        last_timestamp = record["t"]
+                    except (ValueError, KeyError, IndexError, TypeError):
+                        # The last line can be incomplete if the bot crashed while writing it.
+                        print("Skipping invalid record in the queue journal: " + line.strip()[:100])
+        except FileNotFoundError:
+            pass
+
+        # Nothing was played while the bot was stopped, so the songs are resumed where they were at the last record.
+        for state in self.states.values():
+            if state["playing_since"] is not None:
+                state.update(position=get_position(state, last_timestamp), playing_since=None)
+
+        saved_states = dict(self.states)
+
+        for record in self.buffered:
+            saved_states.pop(record["g"], None)
+            self.states.pop(record["g"], None)
+
+        for record in self.buffered:
+            self.apply(record)
+        self.buffered = []
+
+        self.loaded = True
+        self.compact()
+
+        return saved_states
+
+    def record(self, guild_id, op, **fields):
+        """
+        Appends a change to the queue of a server to the journal and applies it to the state of the server.
+
+        :param guild_id: The id of the server.
+        :param op: The kind of change, e.g. "push", "pop" or "shuffle", see apply.
+        :param fields: The data of the change, e.g. the songs that were pushed.
+        """
+        record = {"g": guild_id, "op": op, "t": time.time()}
+        record.update(fields)
+
+        if not self.loaded:
+            self.buffered.append(record)
+            return
+
+        self.apply(record)
+
+        self.write_line(json.dumps(record, separators=(",", ":")) + "\n")
+
+        self.records_since_compaction += 1
+        if self.records_since_compaction >= self.max_records:
+            self.compact_in_background()
+
+    def record_time(self):
+        """
+        Appends a record that only contains the current time. The positions of the playing songs are computed from the
+        time of the last record when the journal is read, so this keeps them up to date without rewriting the journal.
+        """
+        if self.loaded:
+            self.write_line(json.dumps({"g": None, "op": "time", "t": time.time()}, separators=(",", ":")) + "\n")
+
+    def write_line(self, line):
+        """Appends the line to the journal file, and to the snapshot that is being written if there is one."""
+        # Flushing every record means only the record being written is lost if the bot crashes.
+        self.file.write(line)
+        self.file.flush()
+
+        if self.compaction is not None:
+            self.lines_since_snapshot.append(line)
+
+    def apply(self, record):
+        """Applies a record from the journal to the state of its server."""
+        guild_id = record["g"]
+        op = record["op"]
+        timestamp = record["t"]
+
+        if op == "snapshot":
+            self.states[guild_id] = record["state"]
+            return
+
+        # The record only marks the time, see record_time.
+        if op == "time":
+            return
+
+        # The session of the server was removed, so there is nothing to resume.
+        if op == "close":
+            self.states.pop(guild_id, None)
+            return
+
+        state = self.states.setdefault(guild_id, create_state())
+        segments = state["segments"]
+
+        if op == "join":
+            state["voice"] = record["voice"]
+        elif op == "leave":
+            state.update(voice=None, current=None, position=0.0, playing_since=None)
+        elif op == "push":
+            # Consecutive pushes are merged into one segment to keep the snapshots small.
+            if segments and segments[-1][0] == "songs":
+                segments[-1][1].extend(record["songs"])
+            else:
+                segments.append(["songs", record["songs"]])
+        elif op == "playlist":
+            segments.append(["playlist", record["id"], record["offset"], record["count"]])
+        elif op == "pop":
+            self.pop_segment(segments)
+            state.update(current=record["song"], position=0.0, playing_since=timestamp)
+        elif op == "done":
+            state.update(current=None, position=0.0, playing_since=None)
+        elif op == "clear":
+            state.update(current=None, position=0.0, playing_since=None, segments=[])
+        elif op == "shuffle":
+            state["segments"] = [["songs", record["songs"]]] if record["songs"] else []
+        elif op == "pause":
+            state.update(position=get_position(state, timestamp), playing_since=None)
+        elif op == "resume":
+            state["playing_since"] = timestamp
+        elif op == "seek":
+            state.update(position=record["position"], playing_since=timestamp)
+        else:
+            raise ValueError("Unknown operation: " + str(op))
+
+    @staticmethod
+    def pop_segment(segments):
+        """Removes the first song from the first segment of the queue."""
+        if not segments:
+            return
+
+        segment = segments[0]
+        if segment[0] == "songs":
+            segment[1].pop(0)
+            remaining = len(segment[1])
+        else:
+            segment[2] += 1
+            segment[3] -= 1
+            remaining = segment[3]
+
+        if remaining <= 0:
+            segments.pop(0)
+
+    def take_snapshot(self):
+        """
+        Returns the time and a copy of the state of every server that is not changed by the records applied after it.
+        The positions of the playing songs are saved as of now, so a song that keeps playing without changes to the
+        queue is resumed close to where it was when the bot stopped.
+        """
+        now = time.time()
+        snapshot = []
+        for guild_id, state in self.states.items():
+            if state["playing_since"] is not None:
+                state.update(position=get_position(state, now), playing_since=now)
+
+            # Only the lists that the records change in place are copied, since the songs themselves are never changed.
+            segments = [[segment[0], list(segment[1])] if segment[0] == "songs" else list(segment)
+                        for segment in state["segments"]]
+            snapshot.append((guild_id, dict(state, segments=segments)))
+
+        return now, snapshot
+
+    @staticmethod
+    def write_snapshot(path, now, snapshot):
+        """Writes the snapshot taken by take_snapshot to the file as one snapshot record for each server."""
+        with open(path, "w") as f:
+            for guild_id, state in snapshot:
+                f.write(json.dumps({"g": guild_id, "op": "snapshot", "t": now, "state": state},
+                                   separators=(",", ":")) + "\n")
+
+    def replace_file(self, tmp_path):
+        """Atomically replaces the journal file with the file at the temporary path and appends to it from now on."""
+        if self.file is not None:
+            self.file.close()
+
+        os.replace(tmp_path, self.path)
+        self.file = open(self.path, "a")
+
+    def compact(self):
+        """
+        Replaces the journal file with a snapshot of the state of every server. The snapshot is written to a new file
+        that atomically replaces the old one, so a crash while compacting leaves the old journal intact. Blocks until
+        the snapshot is written, see compact_in_background.
+        """
+        if not self.loaded:
+            return
+
+        tmp_path = self.path + ".tmp"
+        self.write_snapshot(tmp_path, *self.take_snapshot())
+        self.replace_file(tmp_path)
+        self.records_since_compaction = 0
+
+    def compact_in_background(self):
+        """
+        Compacts the journal like compact, but writes the snapshot on a thread. Records that are appended while the
+        snapshot is written are added to the journal as well as to the snapshot once it is written.
+        """
+        if not self.loaded or self.compaction is not None:
+            return
+
+        self.lines_since_snapshot = []
+        self.compaction = asyncio.get_event_loop().run_in_executor(None, self.write_snapshot, self.path + ".tmp",
+                                                                   *self.take_snapshot())
+        self.compaction.add_done_callback(self.on_compaction_done)
+
+    def on_compaction_done(self, future):
+        """Called on the event loop when the snapshot has been written, which replaces the journal with it."""
+        self.compaction = None
+        lines, self.lines_since_snapshot = self.lines_since_snapshot, []
+
+        tmp_path = self.path + ".tmp"
+        try:
+            future.result()
+
+            # The records appended while the snapshot was written are few, so they are appended on the event loop.
+            with open(tmp_path, "a") as f:
+                f.writelines(lines)
+            self.replace_file(tmp_path)
+        except Exception as e:
+            # The old journal still contains every record, so it is compacted again later.
+            print("Could not compact the queue journal: " + str(e))
+            return
+
+        self.records_since_compaction = len(lines)
+
+    async def compact_periodically(self):
+        """
+        Runs forever, compacting the journal every compact interval seconds if records were appended. If only songs
+        are playing the time is recorded instead, so the journal is not rewritten just because time passed.
+        """
+        while True:
+            await asyncio.sleep(self.compact_interval)
+
+            if not self.loaded:
+                continue
+
+            if self.records_since_compaction > 0:
+                self.compact_in_background()
+            elif any(state["playing_since"] is not None for state in self.states.values()):
+                self.record_time()
+
+    async def close(self):
+        """Waits for the compaction that is running, compacts the journal and closes the journal file."""
+        while self.compaction is not None:
+            await asyncio.wait([self.compaction])
+
+        if self.file is not None:
+            self.compact()
+            self.file.close()
+            self.file = None
+            self.loaded = False
@@ -3,14 +3,25 @@
 The discord bot is implemented using a class based design with the "discord.Client" superclass from the
 "discord" python package.
 """
-import json
+import asyncio
 import discord
-import os
+import importlib
+import metrics
+import time
 import youtube
 
-from song_queue import SongQueue
+from commands import CommandRegistry
+from config import get_config
+from download_pipeline import DownloadPipeline
+from http_session import HttpSession
+from itertools import islice
 from player import Player
-from spotify_playlist import SpotifyPlaylist
+from playlist_import import PlaylistImport
+from playlist_index import PlaylistIndex
+from playlist_store import PlaylistStore
+from queue_journal import QueueJournal
+from session_manager import SessionManager
+from transcoder import Transcoder
 
 
 class Ritmo(discord.Client):
@@ -18,10 +29,73 @@ class Ritmo(discord.Client):
     Class representing a discord bot object. The function "on_message" from the super class
     "discord.Clint" is overwritten to implement the functionality of the available commands.
     """
-    def __init__(self, **options):
-        self.song_queue = SongQueue()
+    def __init__(self, prefetch_depth=3, max_concurrent_downloads=2, streaming=False, cache_max_bytes=2 * 1024 ** 3,
+                 import_parallelism=8, gapless=True, max_transcodes=2, bitrate=192, ffmpeg_threads=1, reconnect=True,
+                 metrics_port=None, metrics_file=None, metrics_interval=60, max_connections_per_host=8,
+                 target_loudness=-16.0, resume_sessions=True, journal_path="queue_journal.jsonl", shared_state=False,
+                 **options):
+        """
+        :param prefetch_depth: The number of songs at the front of each queue that are downloaded before they are played.
+        :param max_concurrent_downloads: The maximum number of songs that are downloaded at once for each queue.
+        :param streaming: If true the songs are streamed directly from youtube instead of being downloaded first.
+        :param cache_max_bytes: The maximum total size of the cached audio files in bytes.
+        :param import_parallelism: The maximum number of songs searched for at the same time when importing a playlist.
+        :param gapless: If true the next song is opened while the current song is playing to avoid gaps between songs.
+        :param max_transcodes: The maximum number of songs that are converted to mp3 at the same time.
+        :param bitrate: The bitrate in kbps of the mp3 files and of the audio that is encoded to opus.
+        :param ffmpeg_threads: The number of threads each ffmpeg process is allowed to use.
+        :param reconnect: If true ffmpeg reconnects to audio streams that are dropped by youtube.
+        :param metrics_port: The port of the http endpoint that exposes the metrics, or None to disable the endpoint.
+        :param metrics_file: The file the metrics are written to regularly, or None to disable writing the metrics.
+        :param metrics_interval: The number of seconds between each time the metrics are written to the file.
+        :param max_connections_per_host: The maximum number of connections to youtube used for searches at once.
+        :param target_loudness: The loudness in LUFS the downloaded songs are normalised to, or None to disable the
+        normalisation.
+        :param resume_sessions: If true the song queues are saved to a journal and resumed when the bot is restarted.
+        :param journal_path: The path of the journal the song queues are saved to.
+        :param shared_state: If true the audio files and the caches are shared with other worker processes, see
+        launcher.py.
+        """
         super().__init__(**options)
-        self.player = None
+
+        # The transcoder is shared by every server so the number of ffmpeg conversions is bounded for the whole bot.
+        self.transcoder = Transcoder(max_transcodes, bitrate, ffmpeg_threads, reconnect)
+
+        # Every outbound request goes through one pool of kept-alive connections. The attribute is not named "http"
+        # since discord.Client uses that name for its own http client.
+        self.http_session = HttpSession(limit_per_host=max_connections_per_host)
+
+        # Each server gets its own song queue and player, which are kept in a session owned by the session manager. The
+        # caches of the pipeline are loaded in the background once the bot is connected, see warm_up.
+        self.pipeline = DownloadPipeline(streaming=streaming, cache_max_bytes=cache_max_bytes,
+                                         audio_transcoder=self.transcoder, http_session=self.http_session,
+                                         target_loudness=target_loudness, load_state=False, shared_state=shared_state)
+
+        # The changes to the queues are journaled so the sessions can be resumed after a crash or a restart. The
+        # journal is loaded once the bot is connected, see restore_sessions.
+        self.journal = QueueJournal(journal_path) if resume_sessions else None
+        self.sessions = SessionManager(self.pipeline, prefetch_depth, max_concurrent_downloads, journal=self.journal)
+        self.gapless = gapless
+        self.loop.create_task(self.evict_idle_sessions())
+
+        # The saved playlists are indexed in memory so repeated playlist commands do not read from the database.
+        self.store = PlaylistIndex(PlaylistStore())
+
+        # Dictionary from (server id, playlist name) to the imports that are currently running.
+        self.import_parallelism = import_parallelism
+        self.imports = {}
+
+        self.commands = CommandRegistry("!")
+        self.register_commands()
+
+        self.metrics_port = metrics_port
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
+        self.register_metrics()
+        self.loop.create_task(self.export_metrics())
+
+        self.warmed_up = False
+        self.loop.create_task(self.warm_up())
 
     async def on_ready(self):
         """Displaying information about the bot and setting the activity when it is ready to run."""
@@ -32,120 +106,327 @@ class Ritmo(discord.Client):
 
         # Setting the activity to "listening to !help" to make it easier for people to learn how Ritmo works.
         activity = discord.Activity(name='!help', type=discord.ActivityType.listening)
-        await client.change_presence(activity=activity)
+        await self.change_presence(activity=activity)
+
+    async def close(self):
+        """
+        Closes the pooled connections of the outbound requests and the queue journal together with the connection to
+        discord, and saves the caches of the pipeline. The journal is closed first, so the sessions are resumed in their
+        voice channels after a restart.
+        """
+        if self.journal is not None:
+            await self.journal.close()
+
+        await self.pipeline.save_state()
+
+        await self.http_session.close()
+        await super().close()
 
     async def on_message(self, message):
         """
         This method is called every time a message is sent and if the message contains
         a command then that command is executed via another class method.
         """
-
         # Ignore if the message is from the bot itself.
         if message.author == self.user:
             return
 
-        if message.content == "!hi":
-            await message.channel.send("Hi!")
+        await self.commands.dispatch(message)
+
+    def register_commands(self):
+        """Registers the available commands together with the methods that execute them."""
+        self.commands.register("hi", self.say_hi, guild_only=False)
+        self.commands.register("play", self.play, argument_name="Song or Playlist")
+        self.commands.register("stop", self.stop)
+        self.commands.register("pause", self.pause)
+        self.commands.register("resume", self.resume)
+        self.commands.register("skip", self.skip)
+        self.commands.register("shuffle", self.shuffle)
+        self.commands.register("queue", self.display_queue)
+        self.commands.register("np", self.now_playing)
+        self.commands.register("create playlist", self.create_playlist, argument_name="Spotify playlist URI")
+        self.commands.register("delete playlist", self.delete_playlist, argument_name="Playlist name")
+        self.commands.register("list playlists", self.display_playlists)
+        self.commands.register("info", self.display_playlist_info, argument_name="Playlist name")
+        self.commands.register("tracklist", self.display_tracklist, argument_name="Playlist name")
+        self.commands.register("help", self.display_help, guild_only=False)
+
+    @staticmethod
+    async def say_hi(message):
+        await message.channel.send("Hi!")
 
-        if message.content.startswith("!play"):
-            await self.play(message)
+    async def play(self, message, request):
+        """
+        Adds the request to the queue and starts playing songs from the queue. If the request is the name of a saved
+        playlist then we put every song from that playlist in the queue. Creates a player if there is none.
+        """
+        session = self.sessions.get(message.guild.id)
 
-        if message.content.startswith("!stop"):
-            if self.player is not None:
-                await self.stop(message)
+        # Creating a player for the server if there currently is none.
+        if session.player is None:
+            voice_channel = message.author.voice.channel
+            session.player = await Player.create(voice_channel, self.user, session.song_queue, self.gapless)
 
-        if message.content.startswith("!pause"):
-            if self.player is not None:
-                self.player.pause()
+        # If the playlist is still being imported we push the songs in the background as soon as they are found.
+        playlist_import = self.imports.get((message.guild.id, request))
+        if playlist_import is not None:
+            self.loop.create_task(self.push_imported_songs(playlist_import, session))
+            return
 
-        if message.content.startswith("!resume"):
-            if self.player is not None:
-                self.player.resume()
+        # If the content following "!play" is the name of a saved playlist then we push every song from the playlist.
+        playlist = self.store.get_playlist(message.guild.id, request)
+        if playlist is not None:
+            # The songs are queued as a cursor over the saved playlist and read from the store as they are needed.
+            session.song_queue.extend_lazy(self.store.iter_songs(playlist.id), playlist.song_count, playlist.id)
+        else:
+            # Appending the requested song to the song queue. The search is run off the event loop so other commands
+            # and servers are not blocked while waiting for youtube.
+            try:
+                session.song_queue.push_song(await self.pipeline.search(request))
+            except youtube.VideoNotFoundError:
+                await message.channel.send("```Could not find a song with that name.```")
+                return
+            except youtube.SearchFailedError:
+                await message.channel.send("```Could not reach youtube, please try again later.```")
+                return
+
+        await session.player.play()
 
-        if message.content.startswith("!skip"):
-            if self.player is not None:
-                self.player.skip()
+    @staticmethod
+    async def push_imported_songs(playlist_import, session):
+        """Pushes the songs of a playlist that is being imported to the song queue as soon as they are found."""
+        async for song in playlist_import.iter_tracks():
+            # Stopping if the bot was stopped or left the voice channel while waiting for the import.
+            if session.player is None:
+                return
 
-        if message.content.startswith("!shuffle"):
-            self.song_queue.shuffle()
+            session.song_queue.push_song(song)
+            await session.player.play()
 
-        if message.content.startswith("!queue"):
-            await message.channel.send(str(self.song_queue))
+    async def create_playlist(self, message, playlist_uri):
+        """
+        Retrieves the spotify playlist and imports it in the background, reporting the progress in the channel. If the
+        playlist was partially imported before it is resumed.
+        """
+        playlist_import = await PlaylistImport.create(playlist_uri, message.guild.id, self.store,
+                                                      self.pipeline, message.channel, self.import_parallelism)
 
-        if message.content.startswith("!np"):
-            await self.player.now_playing(message)
+        key = (message.guild.id, playlist_import.name)
+        if key in self.imports:
+            await message.channel.send("```That playlist is already being imported.```")
+            return
 
-        if message.content.startswith("!create playlist"):
-            SpotifyPlaylist(message.content[17:], message.guild.id)
+        self.imports[key] = playlist_import
+        try:
+            await playlist_import.run()
             await message.add_reaction("\N{THUMBS UP SIGN}")
+        finally:
+            del self.imports[key]
 
-        if message.content.startswith("!delete playlist"):
-            await self.delete_playlist(message)
+    async def stop(self, message):
+        """Stops the audio and disconnects the bot from the voice channel."""
+        session = self.sessions.peek(message.guild.id)
+        if session is None or session.player is None:
+            return
+
+        await session.player.stop(message)
+        session.player = None
 
-        if message.content.startswith("!list playlists"):
-            await self.display_playlists(message)
+    async def pause(self, message):
+        if self.get_player(message) is not None:
+            self.get_player(message).pause()
 
-        if message.content.startswith("!info"):
-            await self.display_playlist_info(message)
+    async def resume(self, message):
+        if self.get_player(message) is not None:
+            self.get_player(message).resume()
 
-        if message.content.startswith("!tracklist"):
-            await self.display_tracklist(message)
+    async def skip(self, message):
+        if self.get_player(message) is not None:
+            self.get_player(message).skip()
 
-        if message.content.startswith("!help"):
-            await self.display_help(message)
+    async def shuffle(self, message):
+        self.sessions.get(message.guild.id).song_queue.shuffle()
 
-    async def play(self, message):
+    async def display_queue(self, message):
+        await message.channel.send(str(self.sessions.get(message.guild.id).song_queue))
+
+    async def now_playing(self, message):
+        if self.get_player(message) is not None:
+            await self.get_player(message).now_playing(message)
+        else:
+            await message.channel.send("```Currently not playing anything.```")
+
+    def get_player(self, message):
+        """Returns the player of the server that the message was sent in, or None if there is no active player."""
+        session = self.sessions.peek(message.guild.id)
+        if session is None:
+            return None
+
+        session.touch()
+        return session.player
+
+    async def warm_up(self):
         """
-        Adds the request to the queue and starts playing songs from the queue. If the request is the name of a saved
-        playlist then we put every song from that playlist in the queue. Creates a player if there is none.
+        Background task that loads the state that is not needed to connect to discord once the bot is ready, so the bot
+        is back online as fast as possible after a restart. The caches are loaded, the playlists of the servers are
+        indexed and youtube_dl is imported so the first song does not have to wait for it. The sessions that were active
+        when the bot stopped are resumed afterwards, so their songs are played from the loaded audio cache.
         """
-        # Creating a player if there currently is none.
-        if self.player is None:
-            voice_channel = message.author.voice.channel
-            self.player = await Player.create(voice_channel, self.user, self.song_queue)
+        await self.wait_until_ready()
+        start = time.perf_counter()
 
-        # Getting the playlist names for the specific server by finding the filenames and removing ".pickle".
-        playlist_names = [playlist_name[:-7] for playlist_name in os.listdir("playlists/" + str(message.guild.id))]
+        try:
+            await self.pipeline.load_state()
+            self.store.warm([guild.id for guild in self.guilds])
 
-        # If the content following "!play" is the name of a saved playlist then we push every song from the playlist.
-        if message.content[6:] in playlist_names:
-            playlist = await SpotifyPlaylist.load_playlist(message.content[6:], message.guild.id, message.channel)
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, importlib.import_module, "youtube_dl")
+        except Exception as e:
+            # The caches start out empty if they could not be loaded, which only makes the first songs slower.
+            print("Could not warm up: " + str(e))
 
-            for song in playlist.tracklist:
-                self.song_queue.push_song(song)
-        else:
-            # Appending the requested song to the song queue.
-            self.song_queue.push_song(youtube.get_video_title_url(message.content[6:]))
+        if self.journal is not None:
+            try:
+                await self.restore_sessions()
+            except Exception as e:
+                print("Could not resume the sessions: " + str(e))
 
-        self.player.play()
+            self.loop.create_task(self.journal.compact_periodically())
 
-    async def stop(self, message):
-        """Stops the audio and disconnects the bot from the voice channel."""
-        await self.player.stop(message)
-        self.player = None
+        self.warmed_up = True
+        print("Warmed up in " + str(round((time.perf_counter() - start) * 1000)) + " ms")
+
+    async def restore_sessions(self):
+        """Loads the queue journal and resumes the session of every server that had songs queued or was playing."""
+        saved_states = self.journal.load()
+
+        await asyncio.gather(*(self.restore_session(guild_id, state) for guild_id, state in saved_states.items()))
+
+        if saved_states:
+            print("Resumed " + str(len(saved_states)) + " sessions")
+
+    async def restore_session(self, guild_id, state):
+        """
+        Rebuilds the song queue of the server in a new session from the state saved in the journal. If the bot was in
+        a voice channel it rejoins the channel and continues the current song from where it was.
+
+        :param guild_id: The id of the server.
+        :param state: The state of the server read from the journal, see queue_journal.create_state.
+        """
+        session = self.sessions.get(guild_id)
+        song_queue = session.song_queue
+
+        # The queue is recorded again as it is rebuilt, so the records of the old queue are dropped first. Nothing is
+        # awaited until the queue is rebuilt, so no other change to the queue can be recorded in between.
+        self.journal.record(guild_id, "close")
+
+        if state["current"] is not None:
+            song_queue.push_song(state["current"])
+
+        for segment in state["segments"]:
+            if segment[0] == "songs":
+                song_queue.extend(segment[1])
+            else:
+                _, playlist_id, offset, count = segment
+                song_queue.extend_lazy(islice(self.store.iter_songs(playlist_id), offset, None), count, playlist_id,
+                                       offset)
+
+        voice_channel = self.get_channel(state["voice"]) if state["voice"] is not None else None
+        if voice_channel is None or not song_queue:
+            return
 
-    @staticmethod
-    async def delete_playlist(message):
         try:
-            os.remove("playlists/" + str(message.guild.id) + "/" + message.content[17:] + ".pickle")
+            session.player = await Player.create(voice_channel, self.user, song_queue, self.gapless)
+        except Exception as e:
+            print("Could not rejoin the voice channel: " + str(e))
+            return
+
+        if state["current"] is not None:
+            session.player.start_position = state["position"]
+
+        # The songs are started in the background since the first song might have to be downloaded.
+        self.loop.create_task(session.player.play())
+
+    async def evict_idle_sessions(self):
+        """Background task that removes the sessions of servers where the bot has not been used for a while."""
+        await self.wait_until_ready()
+        await self.sessions.evict_idle_sessions()
+
+    def register_metrics(self):
+        """Registers the metrics that are read from the state of the bot every time the metrics are collected."""
+        search_cache = self.pipeline.search_cache
+        audio_cache = self.pipeline.cache
+
+        metrics.Gauge("ritmo_active_sessions", "Servers with a playback session.", function=lambda: len(self.sessions))
+        metrics.Gauge("ritmo_queued_songs", "Songs in the queues of every server.",
+                      function=lambda: sum(len(session.song_queue) for session in self.sessions.sessions.values()))
+        metrics.Gauge("ritmo_active_imports", "Playlist imports that are running.", function=lambda: len(self.imports))
+
+        metrics.Gauge("ritmo_audio_cache_bytes", "Size of the cached audio files.",
+                      function=lambda: audio_cache.total_bytes)
+        metrics.Gauge("ritmo_audio_cache_files", "Number of cached audio files.", function=lambda: len(audio_cache))
+        metrics.Gauge("ritmo_search_cache_entries", "Number of cached searches.",
+                      function=lambda: len(search_cache.entries))
+        metrics.Counter("ritmo_search_cache_lookups_total", "Search cache lookups by result.", ["result"],
+                        function=lambda: {("hit",): search_cache.hits, ("negative_hit",): search_cache.negative_hits,
+                                          ("miss",): search_cache.misses})
+
+        metrics.Gauge("ritmo_transcodes_running", "Transcodes that are running.",
+                      function=lambda: self.transcoder.active)
+        metrics.Gauge("ritmo_transcode_queue_depth", "Transcodes waiting to be started.",
+                      function=self.transcoder.get_queue_depth)
+        metrics.Counter("ritmo_transcodes_total", "Transcodes that are done.",
+                        function=lambda: self.transcoder.completed)
+
+        # The CPU time is only available on unix, elsewhere the metric has no value.
+        metrics.Counter("ritmo_ffmpeg_cpu_seconds_total", "CPU time used by the finished ffmpeg processes.",
+                        function=self.transcoder.get_cpu_time)
+
+        metrics.Counter("ritmo_http_requests_total", "Outbound http requests, e.g. youtube searches.",
+                        function=lambda: self.http_session.requests)
+        metrics.Counter("ritmo_http_connections_total", "Connections opened for the outbound http requests.",
+                        function=lambda: self.http_session.connections_created)
+
+    async def export_metrics(self):
+        """Background task that starts the metrics endpoint and writes the metrics to the metrics file regularly."""
+        await self.wait_until_ready()
+
+        if self.metrics_port is not None:
+            await metrics.REGISTRY.start_http_server(self.metrics_port)
+            print("Serving metrics on port " + str(self.metrics_port))
+
+        if self.metrics_file is not None:
+            await metrics.REGISTRY.write_file_periodically(self.metrics_file, self.metrics_interval)
+
+    async def load_playlist(self, message, playlist_name):
+        """Returns the saved playlist with the given name, informing the user if there is no such playlist."""
+        playlist = self.store.get_playlist(message.guild.id, playlist_name)
+        if playlist is None:
+            await message.channel.send("```There is no playlist with that name.```")
+
+        return playlist
+
+    async def delete_playlist(self, message, playlist_name):
+        if self.store.delete_playlist(message.guild.id, playlist_name):
             await message.add_reaction("\N{THUMBS UP SIGN}")
-        except FileNotFoundError:
+        else:
             await message.channel.send("```There is no playlist with that name.```")
 
-    @staticmethod
-    async def display_tracklist(message):
+    async def display_tracklist(self, message, playlist_name):
         """
         Displays the tracklist of a playlist by sending 25 songs at a time. We are limited to 25 songs due to the
-        character limit on discord messages.
+        character limit on discord messages. Only the songs of the page being sent are read from the store.
         """
-        playlist = await SpotifyPlaylist.load_playlist(message.content[11:], message.guild.id, message.channel)
+        playlist = await self.load_playlist(message, playlist_name)
+        if playlist is None:
+            return
 
         counter = 0
-        while counter < len(playlist.tracklist):
+        while counter < playlist.song_count:
             # Encapsulating the string representation in "```" to put the text in a code block in discord.
             playlist_str = "```"
 
-            playlist_str += playlist.get_tracklist_str(counter, counter + 25)
+            playlist_str += playlist.get_tracklist_str(self.store.get_songs(playlist.id, 25, counter), counter)
 
             # Completing the code block encapsulation.
             playlist_str += "```"
@@ -153,22 +434,19 @@ class Ritmo(discord.Client):
             await message.channel.send(playlist_str)
             counter += 25
 
-    @staticmethod
-    async def display_playlists(message):
+    async def display_playlists(self, message):
         """Displays the currently available playlists for the server."""
         # Encapsulating the string representation in "```" to put the text in a code block in discord.
         playlists_str = "```"
 
-        # Getting the playlist names for the specific server by finding the filenames and removing ".pickle".
-        playlist_names = [playlist_name[:-7] for playlist_name in os.listdir("playlists/" + str(message.guild.id))]
+        playlists = self.store.list_playlists(message.guild.id)
 
         # If the server has no playlists then we inform the user of that.
-        if not playlist_names:
+        if not playlists:
             await message.channel.send("```This server has no playlists.```")
             return
 
-        for counter, playlist_name in enumerate(playlist_names):
-            playlist = await SpotifyPlaylist.load_playlist(playlist_name, message.guild.id, message.channel)
+        for counter, playlist in enumerate(playlists):
             playlists_str += str(counter + 1) + ". " + playlist.get_info_str(verbose=False) + "\n"
 
         # Completing the code block encapsulation.
@@ -176,13 +454,15 @@ class Ritmo(discord.Client):
 
         await message.channel.send(playlists_str)
 
-    @staticmethod
-    async def display_playlist_info(message):
+    async def display_playlist_info(self, message, playlist_name):
         """Displays full information about a playlist."""
+        playlist = await self.load_playlist(message, playlist_name)
+        if playlist is None:
+            return
+
         # Encapsulating the string representation in "```" to put the text in a code block in discord.
         info_str = "```"
 
-        playlist = await SpotifyPlaylist.load_playlist(message.content[6:], message.guild.id, message.channel)
         info_str += playlist.get_info_str()
 
         # Completing the code block encapsulation.
@@ -219,10 +499,39 @@ class Ritmo(discord.Client):
         await message.channel.send(help_str)
 
 
+def create_client(config_dict, client_class=Ritmo, **options):
+    """
+    Creates the bot with the optional settings from the config file.
+
+    :param config_dict: The settings read from the config file.
+    :param client_class: The class of the bot, e.g. the sharded bot run by each worker of launcher.py.
+    :param options: Settings that are used instead of the ones in the config file, e.g. the shards of a worker.
+    :return: The bot, which is started with its run method.
+    """
+    settings = dict(prefetch_depth=config_dict.get("prefetch depth", 3),
+                    max_concurrent_downloads=config_dict.get("max concurrent downloads", 2),
+                    streaming=config_dict.get("streaming", False),
+                    cache_max_bytes=config_dict.get("audio cache size mb", 2048) * 1024 ** 2,
+                    import_parallelism=config_dict.get("import parallelism", 8),
+                    gapless=config_dict.get("gapless", True),
+                    max_transcodes=config_dict.get("max transcodes", 2),
+                    bitrate=config_dict.get("bitrate", 192),
+                    ffmpeg_threads=config_dict.get("ffmpeg threads", 1),
+                    reconnect=config_dict.get("reconnect", True),
+                    metrics_port=config_dict.get("metrics port"),
+                    metrics_file=config_dict.get("metrics file"),
+                    metrics_interval=config_dict.get("metrics interval", 60),
+                    max_connections_per_host=config_dict.get("max connections per host", 8),
+                    target_loudness=config_dict.get("target loudness", -16.0),
+                    resume_sessions=config_dict.get("resume sessions", True))
+    settings.update(options)
+
+    return client_class(**settings)
+
+
 if __name__ == '__main__':
-    client = Ritmo()
+    # Pulling the token and the optional download settings from the config file and using them to set up the bot.
+    config_dict = get_config()
 
-    # Pulling the token from the config file and using it to set up the bot.
-    with open("config.json", "r") as config:
-        config_dict = json.load(config)
-        client.run(config_dict["token"])
+    client = create_client(config_dict)
+    client.run(config_dict["token"])
@@ -0,0 +1,161 @@
+"""
+Module with functionality related to caching youtube search results. Every "!play" and every track of every imported
+playlist needs a youtube search, and many of the searches are repeated, so the results are cached and saved to disk.
+"""
+import re
+import time
+
+from file_lock import SharedJsonFile
+from search_results import SearchResult
+
+
+class SearchCache:
+    """
+    Class representing a persistent cache from search queries to the title and url of the first video found. Searches
+    that found nothing are cached as well, but for a shorter time, so failing searches are not retried on every request.
+    """
+    def __init__(self, path="search_cache.json", ttl=30 * 24 * 60 * 60, negative_ttl=60 * 60, save_interval=60,
+                 load=True, shared=False):
+        """
+        :param path: The path of the json file the cache is saved to.
+        :param ttl: The number of seconds a search result is valid.
+        :param negative_ttl: The number of seconds a search that found nothing is remembered.
+        :param save_interval: The minimum number of seconds between each save of the cache file.
+        :param load: If false the cache file is not loaded until merge is called, e.g. from a background task.
+        :param shared: If true the cache file is shared with other worker processes, see launcher.py, and the searches
+        they saved are merged into the cache every time it is saved.
+        """
+        self.file = SharedJsonFile(path, shared, merge=self.merge_saved)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.save_interval = save_interval
+        self.last_save = 0
+
+        # Dictionary from the normalized query to a dictionary with the result and the time the result expires. The
+        # result is a list with the title and url of the video, or None if the search found nothing. Searches that were
+        # matched by duration also keep the list of candidates with the title, url and duration of each video.
+        self.entries = {}
+
+        # Counters that show how many network round-trips the cache saves.
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+        self.loaded = False
+        if load:
+            self.load()
+
+    @staticmethod
+    def normalize_query(query):
+        """
+        Normalizes the query so queries that would give the same search result map to the same cache entry. The case
+        and whitespace is normalized and the artists in queries of the form "Artist 1, Artist 2 - Song" are sorted.
+
+        :param query: The search query.
+        :return: The normalized query.
+        """
+        query = re.sub(r"\s+", " ", query).strip().lower()
+
+        artists, separator, song = query.partition(" - ")
+        if separator:
+            query = ", ".join(sorted(artist.strip() for artist in artists.split(","))) + " - " + song
+
+        return query
+
+    def load(self):
+        """Loads the cache from the cache file, skipping entries that have expired."""
+        self.merge(self.read())
+
+    def read(self):
+        """Reads the entries that have not expired from the cache file without changing the cache."""
+        entries = self.file.read({})
+
+        now = time.time()
+        return {query: entry for query, entry in entries.items() if entry["expires"] > now}
+
+    def merge(self, entries):
+        """Adds the entries read from the cache file, keeping the results of the searches done since the bot started."""
+        entries.update(self.entries)
+        self.entries = entries
+        self.loaded = True
+
+    def save(self):
+        """
+        Saves the cache to the cache file on a thread, so the event loop is not blocked while the file is written. The
+        searches other workers saved are merged into the cache if the file is shared.
+        """
+        # Saving before the cache file has been loaded would drop the entries that have not been loaded yet.
+        if not self.loaded:
+            return
+
+        self.file.save_in_background(self.prune, self.merge if self.file.shared else None)
+        self.last_save = time.time()
+
+    async def close(self):
+        """Saves the cache and waits until the cache file has been written, e.g. when the bot is closed."""
+        self.save()
+        await self.file.flush()
+
+    def prune(self):
+        """
+        Removes the expired entries from the cache, so they are neither kept in memory nor saved.
+
+        :return: A copy of the entries that are left, which can be saved on a thread.
+        """
+        now = time.time()
+        self.entries = {query: entry for query, entry in self.entries.items() if entry["expires"] > now}
+
+        return dict(self.entries)
+
+    @staticmethod
+    def merge_saved(entries, saved_entries):
+        """Adds the searches other workers saved that have not expired, keeping the searches of this process."""
+        now = time.time()
+        merged_entries = {query: entry for query, entry in saved_entries.items() if entry["expires"] > now}
+        merged_entries.update(entries)
+
+        return merged_entries
+
+    def get(self, query):
+        """
+        Returns the cache entry of the query, or None if the query is not cached or the entry has expired.
+
+        :param query: The search query.
+        :return: A dictionary where "result" is a tuple with the title and url of the video, or None if the search
+        found nothing, and "candidates" is a list of SearchResults, or None if the candidates were not cached.
+        """
+        normalized_query = self.normalize_query(query)
+        entry = self.entries.get(normalized_query)
+
+        if entry is None or entry["expires"] <= time.time():
+            self.entries.pop(normalized_query, None)
+            self.misses += 1
+            return None
+
+        if entry["result"] is None:
+            self.negative_hits += 1
+            return {"result": None, "candidates": None}
+
+        self.hits += 1
+        candidates = entry.get("candidates")
+        return {"result": tuple(entry["result"]),
+                "candidates": [SearchResult(*candidate) for candidate in candidates] if candidates else None}
+
+    def put(self, query, result, candidates=None):
+        """
+        Caches the result of the search.
+
+        :param query: The search query.
+        :param result: A tuple with the title and url of the video, or None if the search found nothing.
+        :param candidates: The SearchResults of the search, if the search returned several videos.
+        """
+        ttl = self.ttl if result is not None else self.negative_ttl
+        entry = {"result": result, "expires": time.time() + ttl}
+        if candidates:
+            entry["candidates"] = [list(candidate) for candidate in candidates]
+
+        self.entries[self.normalize_query(query)] = entry
+
+        # The cache is saved at most once per save interval since imports of large playlists add many entries at once.
+        if time.time() - self.last_save > self.save_interval:
+            self.save()
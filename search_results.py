@@ -0,0 +1,184 @@
+"""
+Module with functionality related to extracting the videos from a youtube search results page. Only the first few
+results are needed, so the page is parsed as a stream that stops at the last needed result instead of building a tree of
+the whole page. Pages where the results are embedded as "ytInitialData" json are read from the json instead.
+"""
+import json
+
+from collections import namedtuple
+from html.parser import HTMLParser
+
+# A video found by a search. The duration is in seconds, or None if the page did not contain the duration.
+SearchResult = namedtuple("SearchResult", ["title", "url", "duration"])
+
+INITIAL_DATA_MARKERS = ("var ytInitialData = ", 'window["ytInitialData"] = ')
+
+
+class StopParsing(Exception):
+    """Raised by the parser to stop parsing once enough results have been found."""
+
+
+class SearchResultParser(HTMLParser):
+    """
+    Parser of the search results page that collects the videos of the first results. Each result contains a thumbnail
+    with the duration of the video followed by a link with the CSS class "yt-uix-tile-link" that has the title and url
+    of the video. Some results only show the duration in the description after the link.
+    """
+    def __init__(self, max_results):
+        """
+        :param max_results: The number of results after which the parsing stops.
+        """
+        super().__init__()
+        self.max_results = max_results
+        self.results = []
+
+        # The duration of the result that is being parsed, the tag whose text is currently being read, if any, and the
+        # parts of its text. The text can be split over several calls of handle_data, so it is parsed at the end tag.
+        self.duration = None
+        self.reading = None
+        self.text = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in ("a", "span"):
+            return
+
+        attrs = dict(attrs)
+        classes = (attrs.get("class") or "").split()
+
+        if tag == "span" and ("video-time" in classes or "accessible-description" in classes):
+            self.reading = "video-time" if "video-time" in classes else "accessible-description"
+            self.text = []
+        elif tag == "a" and "yt-uix-tile-link" in classes and (attrs.get("href") or "").startswith("/watch"):
+            self.results.append(SearchResult(attrs.get("title"), "https://www.youtube.com" + attrs["href"],
+                                             self.duration))
+            self.duration = None
+
+    def handle_data(self, data):
+        if self.reading is not None:
+            self.text.append(data)
+
+    def handle_endtag(self, tag):
+        if tag != "span" or self.reading is None:
+            return
+
+        text = "".join(self.text)
+        if self.reading == "video-time":
+            self.duration = parse_duration(text.strip())
+        elif self.results and self.results[-1].duration is None and "Duration:" in text:
+            # The description has the format " - Duration: 3:32.".
+            duration = parse_duration(text.split("Duration:", 1)[1].strip().rstrip("."))
+            self.results[-1] = self.results[-1]._replace(duration=duration)
+
+        # The description is the last part of a result, so the parsing can stop after the description of the last
+        # needed result.
+        if self.reading == "accessible-description" and len(self.results) >= self.max_results:
+            raise StopParsing()
+
+        self.reading = None
+
+
+def pick_closest_duration(results, expected_duration, tolerance=10, relative_tolerance=0.05):
+    """
+    Picks the search result that matches the expected duration, so long music videos and hour long loops are skipped
+    in favour of the song itself. The highest ranked result within the tolerance is picked since youtube ranks the most
+    relevant videos first, and if no result is within the tolerance the result with the closest duration is picked.
+
+    :param results: The SearchResults in the order youtube ranked them.
+    :param expected_duration: The expected duration in seconds, e.g. the duration of the song on spotify.
+    :param tolerance: The number of seconds the duration of a result can differ from the expected duration.
+    :param relative_tolerance: The fraction of the expected duration that the duration of a result can differ by, used
+    if it is larger than the tolerance in seconds.
+    :return: The SearchResult that matches the expected duration best.
+    """
+    tolerance = max(tolerance, expected_duration * relative_tolerance)
+    timed_results = [result for result in results if result.duration is not None]
+
+    for result in timed_results:
+        if abs(result.duration - expected_duration) <= tolerance:
+            return result
+
+    if not timed_results:
+        return results[0]
+
+    return min(timed_results, key=lambda result: abs(result.duration - expected_duration))
+
+
+def parse_duration(duration_str):
+    """
+    Converts a duration of the format "3:32" or "1:02:11" to seconds.
+
+    :return: The number of seconds, or None if the string is not a duration.
+    """
+    seconds = 0
+    for part in duration_str.split(":"):
+        if not part.isdigit():
+            return None
+        seconds = seconds * 60 + int(part)
+
+    return seconds
+
+
+def extract_search_results(html, max_results=5):
+    """
+    Extracts the first videos from a youtube search results page, in the order youtube ranked them.
+
+    :param html: The html of the search results page, either as bytes or as a string.
+    :param max_results: The maximum number of results that are returned.
+    :return: A list of SearchResults, which is empty if the page contains no videos.
+    """
+    if isinstance(html, bytes):
+        html = html.decode("utf-8", errors="replace")
+
+    for marker in INITIAL_DATA_MARKERS:
+        if marker in html:
+            return extract_initial_data_results(html, marker, max_results)
+
+    # The whole page is fed at once, since the parser stops by itself after the last needed result.
+    parser = SearchResultParser(max_results)
+    try:
+        parser.feed(html)
+        parser.close()
+    except StopParsing:
+        pass
+
+    # Results without a description are only cut off here, since the parser stops at descriptions.
+    return parser.results[:max_results]
+
+
+def extract_initial_data_results(html, marker, max_results):
+    """Extracts the first videos from the "ytInitialData" json that is embedded in newer search results pages."""
+    start = html.index(marker) + len(marker)
+
+    try:
+        initial_data, _end = json.JSONDecoder().raw_decode(html, start)
+    except ValueError:
+        return []
+
+    results = []
+    for video_renderer in iter_video_renderers(initial_data):
+        video_id = video_renderer.get("videoId")
+        if video_id is None:
+            continue
+
+        title_runs = video_renderer.get("title", {}).get("runs") or [{}]
+        duration_str = video_renderer.get("lengthText", {}).get("simpleText", "")
+
+        results.append(SearchResult(title_runs[0].get("text"), "https://www.youtube.com/watch?v=" + video_id,
+                                    parse_duration(duration_str) if duration_str else None))
+        if len(results) >= max_results:
+            break
+
+    return results
+
+
+def iter_video_renderers(value):
+    """Yields every "videoRenderer" object in the json value in document order, which is the order of the results."""
+    if isinstance(value, dict):
+        for key, child in value.items():
+            if key == "videoRenderer" and isinstance(child, dict):
+                yield child
+            else:
+                yield from iter_video_renderers(child)
+    elif isinstance(value, list):
+        for child in value:
+            yield from iter_video_renderers(child)
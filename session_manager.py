@@ -0,0 +1,116 @@
+"""
+Module with functionality related to keeping track of the playback sessions of the servers that Ritmo is used in. Each
+server gets its own song queue and player so the servers are completely independent of each other.
+"""
+import asyncio
+import time
+
+from song_queue import SongQueue
+
+
+class GuildSession:
+    """Class representing the playback state of a single server, consisting of a song queue and a player."""
+    def __init__(self, guild_id, pipeline, prefetch_depth, max_concurrent_downloads, journal=None):
+        self.guild_id = guild_id
+        self.song_queue = SongQueue(pipeline, prefetch_depth, max_concurrent_downloads, journal, guild_id)
+        self.player = None
+
+        # Monotonic timestamp of the last command that used the session, used to evict sessions that are not in use.
+        self.last_active = time.monotonic()
+
+    def touch(self):
+        """Marks the session as active right now."""
+        self.last_active = time.monotonic()
+
+    def is_idle(self, idle_timeout):
+        """
+        Returns true if nothing is playing in the session and it has not been used for longer than the idle timeout.
+
+        :param idle_timeout: The number of seconds the session should be unused before it is considered idle.
+        """
+        if self.player is not None and self.player.is_active():
+            return False
+
+        return time.monotonic() - self.last_active > idle_timeout
+
+    async def close(self):
+        """
+        Disconnects the player of the session from the voice channel if it is connected and empties the song queue so
+        the queued songs no longer hold references in the audio cache.
+        """
+        self.song_queue.clear()
+
+        if self.player is not None:
+            await self.player.disconnect()
+            self.player = None
+
+
+class SessionManager:
+    """
+    Class that owns a session for each server. Sessions are created the first time a server uses a playback command
+    and are evicted again when they have been idle for a while, so memory and voice connections are only held by
+    servers that actually use the bot.
+    """
+    def __init__(self, pipeline, prefetch_depth=3, max_concurrent_downloads=2, idle_timeout=600, check_interval=60,
+                 journal=None):
+        """
+        :param pipeline: The download pipeline shared by the song queues of every session.
+        :param prefetch_depth: The number of songs at the front of each queue that are downloaded before they are played.
+        :param max_concurrent_downloads: The maximum number of songs that are downloaded at once for each queue.
+        :param idle_timeout: The number of seconds a session can be unused before it is evicted.
+        :param check_interval: The number of seconds between each check for idle sessions.
+        :param journal: The journal the changes to the queues are recorded in, or None if the queues are not persisted.
+        """
+        self.pipeline = pipeline
+        self.prefetch_depth = prefetch_depth
+        self.max_concurrent_downloads = max_concurrent_downloads
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.journal = journal
+
+        # Dictionary from the server id to the session of that server.
+        self.sessions = {}
+
+    def get(self, guild_id):
+        """
+        Returns the session of the server with the given id, creating it if it does not already exist.
+
+        :param guild_id: The id of the server that the session belongs to.
+        :return: The session of the server.
+        """
+        session = self.sessions.get(guild_id)
+        if session is None:
+            session = GuildSession(guild_id, self.pipeline, self.prefetch_depth, self.max_concurrent_downloads,
+                                   self.journal)
+            self.sessions[guild_id] = session
+
+        session.touch()
+        return session
+
+    def peek(self, guild_id):
+        """Returns the session of the server with the given id without creating it, or None if there is none."""
+        return self.sessions.get(guild_id)
+
+    async def remove(self, guild_id):
+        """Removes the session of the server with the given id and disconnects it from voice if it is connected."""
+        session = self.sessions.pop(guild_id, None)
+        if session is not None:
+            await session.close()
+
+            # The session is gone, so it should not be resumed when the bot restarts.
+            if self.journal is not None:
+                self.journal.record(guild_id, "close")
+
+    async def evict_idle_sessions(self):
+        """Runs forever, periodically removing the sessions that have been idle for longer than the idle timeout."""
+        while True:
+            await asyncio.sleep(self.check_interval)
+
+            idle_guild_ids = [guild_id for guild_id, session in self.sessions.items()
+                              if session.is_idle(self.idle_timeout)]
+
+            for guild_id in idle_guild_ids:
+                await self.remove(guild_id)
+
+    def __len__(self):
+        return len(self.sessions)
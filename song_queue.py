@@ -1,83 +1,347 @@
-import youtube
-import time
-import os
+import asyncio
+import metrics
 import random
+import transcoder
+import youtube
+
+from collections import Counter, deque
+from itertools import islice
+
+
+class Track:
+    """Class representing a queued song. Slots keep the memory use low for queues with thousands of songs."""
+    __slots__ = ("title", "url", "video_id")
+
+    def __init__(self, title, url):
+        """
+        :param title: The title of the song.
+        :param url: The youtube url of the song.
+        """
+        self.title = title
+        self.url = url
+
+        # The video id is extracted once since it is used as the key of the song in the downloads and audio cache.
+        self.video_id = youtube.get_video_id(url)
+
+    def __iter__(self):
+        """Makes it possible to unpack the track as a (title, url) pair, like the tuples used by the playlists."""
+        return iter((self.title, self.url))
 
 
 class SongQueue:
     """Class representing a queue containing songs."""
 
-    def __init__(self):
-        # Contains songs, each represented by a tuple consisting of the song title and song url.
-        self.queue = []
+    def __init__(self, pipeline, prefetch_depth=3, max_concurrent_downloads=2, journal=None, guild_id=None):
+        """
+        :param pipeline: The download pipeline used to download the songs without blocking the event loop.
+        :param prefetch_depth: The number of songs at the front of the queue that are downloaded before they are played.
+        :param max_concurrent_downloads: The maximum number of songs from this queue that are downloaded at once.
+        :param journal: The journal the changes to the queue are recorded in, or None if the queue is not persisted.
+        :param guild_id: The id of the server that the queue belongs to, used as the key of the queue in the journal.
+        """
+        self.pipeline = pipeline
+        self.prefetch_depth = prefetch_depth
+        self.max_concurrent_downloads = max_concurrent_downloads
+        self.journal = journal
+        self.guild_id = guild_id
+
+        # Contains the queued songs as Track objects. A deque makes it O(1) to pop the next song.
+        self.queue = deque()
+
+        # Songs that are queued after the songs in the queue but not turned into Track objects yet, e.g. a large saved
+        # playlist. Each element is a list with an iterator of (title, url) pairs and the number of songs it has left.
+        # The songs are moved into the queue a chunk at a time as the front of the queue is played.
+        self.pending = deque()
+        self.pending_count = 0
+
+        # The number of times each video id is in the queue, used for O(1) membership checks.
+        self.queued_video_ids = Counter()
 
-        # We maintain a downloaded queue to keep track of the songs in the queue which are downloaded.
-        # The purpose of this is to download songs before they are to be played to increase responsiveness.
-        self.downloaded_queue = []
+        # We download the songs in the prefetch window before they are to be played to increase responsiveness. This
+        # dictionary maps the video id of each song in the window to the task that downloads it. A finished task
+        # resolves to the filename of the song, or to the audio stream of the song when streaming.
+        self.downloads = {}
+
+        # The song that was popped last. It is kept in the window until it is done playing.
+        self.playing = None
+
+        # Every queued song holds a reference in the audio cache so its file is not evicted before it is played.
+        self.cache = pipeline.cache
 
     def push_song(self, title_url):
         """
-        Adding a song to the queue. Also downloading the song if needed.
+        Adding a song to the queue. Also starting the download of the song if it is in the prefetch window.
 
         :param title_url: A tuple consisting of a song title and the youtube url to the song.
         :return: None
         """
+        self.record("push", songs=[list(title_url)])
+
+        # Songs queued behind pending songs have to wait for them to keep the order.
+        if self.pending:
+            self.add_pending(iter([title_url]), 1)
+            return
+
+        track = Track(*title_url)
+
         # Adding the song to the normal queue.
-        self.queue.append(title_url)
+        self.queue.append(track)
+        self.queued_video_ids[track.video_id] += 1
+        self.cache.acquire(track.video_id)
 
-        # If there are still two or less songs in the queue we download it and add the filename to the downloaded songs.
-        if len(self.queue) <= 2:
-            song_file = youtube.download_mp3(title_url[1], "audio_files/")
-            self.downloaded_queue.append(song_file)
+        # Songs pushed behind a full window can not change the window.
+        if len(self.queue) <= self.prefetch_depth:
+            self.schedule_prefetch()
 
-    def pop_song(self):
+    def extend(self, songs):
         """
-        Removing the first song in the queue and popping the song filename from the downloaded queue.
+        Adding every song to the queue in one operation. The prefetch window is only updated once.
 
-        :return: The filename of the song that is first in the queue.
+        :param songs: Iterable of tuples consisting of a song title and the youtube url to the song.
         """
-        del self.queue[0]
-        # If the queue contains songs but the downloaded queue is empty we know that we are currently downloading and we
-        # therefore wait for the download to finish.
-        while self.queue and not self.downloaded_queue:
-            time.sleep(0.5)
-        return self.downloaded_queue.pop(0)
+        songs = list(songs)
+        if self.journal is not None:
+            self.record("push", songs=[list(title_url) for title_url in songs])
 
-    def update_downloaded_queue(self):
+        if self.pending:
+            self.add_pending(iter(songs), len(songs))
+            return
+
+        tracks = [Track(*title_url) for title_url in songs]
+
+        self.queue.extend(tracks)
+        for track in tracks:
+            self.queued_video_ids[track.video_id] += 1
+            self.cache.acquire(track.video_id)
+
+        self.schedule_prefetch()
+
+    def extend_lazy(self, songs, count, playlist_id=None, offset=0):
         """
-        Updating the queue containing downloaded songs if there are any songs in the normal queue that are not
-        downloaded yet.
+        Adding the songs to the queue without creating them up front. The songs are taken from the iterator a chunk at
+        a time when they get close to the front of the queue, so queueing a playlist with thousands of songs is O(1).
+        Pending songs do not hold references in the audio cache until they are moved into the queue.
+
+        :param songs: Iterator of tuples consisting of a song title and the youtube url to the song, e.g. a cursor over
+        a saved playlist.
+        :param count: The number of songs the iterator yields.
+        :param playlist_id: The id of the saved playlist the songs are read from, if any. The journal then only records
+        the playlist instead of every song in it.
+        :param offset: The number of songs of the saved playlist that the iterator skips.
         """
-        if len(self.queue) >= 2:
-            song_file = youtube.download_mp3(self.queue[1][1], "audio_files/")
-            self.downloaded_queue.append(song_file)
+        if count <= 0:
+            return
+
+        if playlist_id is not None:
+            self.record("playlist", id=playlist_id, offset=offset, count=count)
+        elif self.journal is not None:
+            songs = list(songs)
+            self.record("push", songs=[list(title_url) for title_url in songs])
+            songs = iter(songs)
+
+        self.add_pending(songs, count)
+
+    def add_pending(self, songs, count):
+        """Adds the songs from the iterator after the songs in the queue and the songs that are already pending."""
+        self.pending.append([songs, count])
+        self.pending_count += count
+
+        self.schedule_prefetch()
+
+    def materialize(self, count):
+        """
+        Moves pending songs into the queue until the queue contains at least the given number of songs or there are no
+        pending songs left.
+
+        :param count: The number of songs the queue should contain.
+        """
+        while len(self.queue) < count and self.pending:
+            segment = self.pending[0]
+            chunk = list(islice(segment[0], max(count - len(self.queue), 16)))
+
+            for title_url in chunk:
+                track = Track(*title_url)
+                self.queue.append(track)
+                self.queued_video_ids[track.video_id] += 1
+                self.cache.acquire(track.video_id)
+
+            segment[1] -= len(chunk)
+            self.pending_count -= len(chunk)
+
+            # The iterator is done when it has no songs left, or if it ended earlier than expected.
+            if segment[1] <= 0 or not chunk:
+                self.pending.popleft()
+                self.pending_count -= segment[1]
+
+    async def pop_song(self):
+        """
+        Removing the first song in the queue and waiting for its download to finish.
+
+        :return: A tuple consisting of the Track that was first in the queue and either its filename or audio stream.
+        """
+        # The previously popped song is released if it was never reported as done, e.g. because it could not be
+        # downloaded, so it does not hold its reference in the audio cache forever.
+        if self.playing is not None:
+            self.song_done()
+
+        self.materialize(1)
+        track = self.queue.popleft()
+        self.remove_queued_video_id(track.video_id)
+        self.playing = track
+        self.record("pop", song=[track.title, track.url])
+
+        # The song should already be downloading, but if the window is empty or the concurrency limit was reached we
+        # start the download right away since the song is needed now. Either way it is transcoded before prefetches.
+        if track.video_id not in self.downloads:
+            self.start_download(track, transcoder.PLAYBACK)
+        else:
+            self.pipeline.prioritize(track.url)
+
+        # Moving the window forward, which also releases the previously played song.
+        self.schedule_prefetch()
+
+        # If the song is still downloading we wait for the download to finish without blocking the event loop.
+        with metrics.QUEUE_WAIT.time():
+            source = await asyncio.shield(self.downloads[track.video_id])
+
+        return track, source
+
+    def peek(self):
+        """Returns the Track that is first in the queue without removing it, or None if the queue is empty."""
+        self.materialize(1)
+
+        return self.queue[0] if self.queue else None
+
+    def remove_queued_video_id(self, video_id):
+        """Decrements the membership count of the video id, removing it when no queued song has the id."""
+        self.queued_video_ids[video_id] -= 1
+        if self.queued_video_ids[video_id] <= 0:
+            del self.queued_video_ids[video_id]
+
+    def song_done(self):
+        """Called when the popped song is done playing, which releases its reference in the audio cache."""
+        if self.playing is not None:
+            self.cache.release(self.playing.video_id)
+            self.playing = None
+            self.record("done")
+
+        self.schedule_prefetch()
+
+    def clear(self):
+        """Removes every song from the queue, stops their downloads and releases their references in the cache."""
+        self.song_done()
+
+        for track in self.queue:
+            self.cache.release(track.video_id)
+        self.queue.clear()
+        self.queued_video_ids.clear()
+
+        self.pending.clear()
+        self.pending_count = 0
+        self.record("clear")
+
+        self.schedule_prefetch()
+
+    def get_prefetch_window(self):
+        """Returns the songs that should be downloaded by video id, in the order they will be played."""
+        window = {}
+        if self.playing is not None:
+            window[self.playing.video_id] = self.playing
+
+        self.materialize(self.prefetch_depth)
+
+        for track in islice(self.queue, self.prefetch_depth):
+            window.setdefault(track.video_id, track)
+
+        return window
+
+    def schedule_prefetch(self):
+        """
+        Brings the downloads in line with the current prefetch window. Downloads for songs that are no longer in the
+        window are cancelled, and new downloads are started in the order the songs will be played until the
+        concurrency limit is reached. Called every time the front of the queue changes.
+        """
+        window = self.get_prefetch_window()
+
+        # Cancelling the downloads for the songs that fell out of the window, e.g. due to a shuffle or a skip.
+        for video_id in [video_id for video_id in self.downloads if video_id not in window]:
+            self.discard_download(self.downloads.pop(video_id))
+
+        active_downloads = sum(1 for download in self.downloads.values() if not download.done())
+
+        # Starting downloads with the songs that will be played first until the concurrency limit is reached.
+        for video_id, track in window.items():
+            if active_downloads >= self.max_concurrent_downloads:
+                break
+
+            if video_id not in self.downloads:
+                self.start_download(track)
+                active_downloads += 1
+
+    def start_download(self, track, priority=transcoder.PREFETCH):
+        """Starts downloading the song in the background with the given transcoding priority."""
+        download = self.pipeline.schedule_download(track.url, priority)
+        download.add_done_callback(self.on_download_done)
+
+        self.downloads[track.video_id] = download
+
+    def on_download_done(self, download):
+        """Called when a download is done, which frees up a slot for the next song in the window."""
+        # Retrieving the exception so failed downloads are not reported as unhandled. They are handled in pop_song.
+        if not download.cancelled() and download.exception():
+            print("Could not download song: " + str(download.exception()))
+
+        self.schedule_prefetch()
+
+    @staticmethod
+    def discard_download(download):
+        """Stops the download if it is still running. Finished downloads are kept in the audio cache."""
+        if not download.done():
+            download.cancel()
 
     def shuffle(self):
-        """Shuffles the song queue, randomizing the order of the songs."""
-        shuffle_queue = self.queue
-        self.queue = []
+        """
+        Shuffles the song queue, randomizing the order of the songs. The tracks are reordered in place, so the
+        downloads of songs that are still in the window after the shuffle are kept.
+        """
+        # Every pending song has to be created to take part in the shuffle.
+        self.materialize(len(self))
+
+        tracks = list(self.queue)
+        random.shuffle(tracks)
+
+        self.queue.clear()
+        self.queue.extend(tracks)
+
+        # The new order is recorded in full since it can not be derived from the records before it.
+        if self.journal is not None:
+            self.record("shuffle", songs=[[track.title, track.url] for track in tracks])
+
+        self.schedule_prefetch()
 
-        # Removing the songs from the audio files folder that were next on the queue before the shuffle.
-        for file in self.downloaded_queue:
-            os.remove(file)
+    def record(self, op, **fields):
+        """Records the change to the queue in the journal if the queue is persisted."""
+        if self.journal is not None:
+            self.journal.record(self.guild_id, op, **fields)
 
-        # Shuffling the queue in place.
-        random.shuffle(shuffle_queue)
+    def __contains__(self, video_id):
+        """Returns true if a song with the video id is in the queue. Pending songs are not included."""
+        return video_id in self.queued_video_ids
 
-        # Adding the songs back to the song queue.
-        for song in shuffle_queue:
-            self.push_song(song)
+    def __len__(self):
+        return len(self.queue) + self.pending_count
 
     def __str__(self):
         """String representation of the entire song queue."""
         # Encapsulating the string representation in "```" to put the text in a code block in discord.
-        queue_str = "```Song queue (" + str(len(self.queue)) + " songs):\n"
+        queue_str = "```Song queue (" + str(len(self)) + " songs):\n"
 
         # If there are any songs in the queue we list the song names in a numbered list.
-        if self.queue:
-            for counter, song in enumerate(self.queue[:10]):
-                queue_str += str(counter + 1) + ". " + song[0] + "\n"
-            if len(self.queue) > 10:
+        if self:
+            self.materialize(10)
+            for counter, track in enumerate(islice(self.queue, 10)):
+                queue_str += str(counter + 1) + ". " + track.title + "\n"
+            if len(self) > 10:
                 queue_str += "..."
         else:
             queue_str += "The queue is empty."
@@ -2,113 +2,172 @@
 Module with functions related to retrieving playlist information from spotify. For more information on the spotify
 objects used in this module visit https://developer.spotify.com/documentation/web-api/reference/playlists/get-playlist/.
 """
-import spotipy
-import json
-import pickle
-import pathlib
-import youtube
-from spotipy.oauth2 import SpotifyClientCredentials
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from config import get_config
+from itertools import islice
+
+# The Spotify object shared by every playlist, created on first use.
+_spotify_client = None
+_spotify_client_lock = threading.Lock()
+
+
+def get_spotify_client(max_connections=8):
+    """
+    Returns the Spotify object shared by the whole process, setting it up from the config file the first time. Sharing
+    the object means the access token is only fetched again when it expires, and the connections to the spotify api are
+    kept alive between requests instead of being opened for every playlist. Spotipy is imported here since it is slow
+    to import and not needed until the first playlist is created.
+
+    :param max_connections: The maximum number of connections to the spotify api. Requests beyond the limit wait for a
+    free connection.
+    :return: The shared Spotify object.
+    """
+    global _spotify_client
+
+    with _spotify_client_lock:
+        if _spotify_client is None:
+            import spotipy
+
+            from requests import Session
+            from requests.adapters import HTTPAdapter
+            from spotipy.oauth2 import SpotifyClientCredentials
+
+            # Getting the api client credentials from the config file and using them to set up a Spotify object.
+            config_dict = get_config()
+
+            session = Session()
+            session.mount("https://", HTTPAdapter(pool_maxsize=max_connections, pool_block=True))
+
+            credentials_manager = SpotifyClientCredentials(client_id=config_dict["spotify client id"],
+                                                           client_secret=config_dict["spotify client secret"])
+            _spotify_client = spotipy.Spotify(client_credentials_manager=credentials_manager, requests_session=session)
+
+        return _spotify_client
 
 
 class SpotifyPlaylist:
-    def __init__(self, playlist_uri, server_id):
-        # Getting the api client credentials from the config file and using them to set up a Spotify object.
-        with open("config.json", "r") as config:
-            config_dict = json.load(config)
-            self.sp = spotipy.Spotify(client_credentials_manager=
-                                      SpotifyClientCredentials(client_id=config_dict["spotify client id"],
-                                                               client_secret=config_dict["spotify client secret"]))
+    """
+    Class representing a spotify playlist that is saved to a server. Creating the object only retrieves the playlist
+    from spotify, the songs are found on youtube afterwards by a PlaylistImport.
+    """
+    def __init__(self, playlist_uri, server_id, sp=None):
+        """
+        :param playlist_uri: The spotify URI of the playlist.
+        :param server_id: The id of the server that the playlist is saved to.
+        :param sp: The Spotify object used to retrieve the playlist. If None the Spotify object shared by the process is
+        used.
+        """
+        self.sp = sp if sp is not None else get_spotify_client()
+        self.uri = playlist_uri
+        self.server_id = server_id
         self.playlist = self.sp.playlist(playlist_uri)
 
         self.name = self.playlist["name"]
         self.description = self.playlist["description"]
         self.duration_ms = 0
 
-        # Each song consists of a pair (song_title, song_url).
-        self.tracklist = self.get_tracklist(self.get_search_queries())
+        self.track_count = self.playlist["tracks"]["total"]
 
-        self.folder = "playlists/" + str(server_id) + "/"
+        # Dictionary from the position of each song in the playlist to the (song_title, song_url) pair found on youtube,
+        # or None if the song could not be found. Filled in while the playlist is imported.
+        self.resolved_tracks = {}
 
-        # Creating the playlists folder if it does not already exist.
-        pathlib.Path(self.folder).mkdir(parents=True, exist_ok=True)
+        # Dictionary from the position of each resolved song to a tuple with the duration of the song on spotify and
+        # the duration of the chosen youtube video in milliseconds, saved so the choice can be checked later.
+        self.track_durations = {}
+        self.complete = False
 
-        self.filepath = self.folder + self.name + ".pickle"
-        self.save_playlist()
-
-    def get_info_str(self, verbose=True):
+    def save_playlist(self, store, positions=()):
         """
-        Returns a prettified string containing information about the playlist.
+        Saving the information about the playlist and the songs at the given positions to the playlist store.
 
-        :param verbose: Bool that decides whether or not to add the description to the info string.
+        :param store: The PlaylistStore the playlist is saved to.
+        :param positions: The positions of the resolved songs that should be saved.
         """
-        # Converting the duration from ms to hours and minutes.
-        duration_mins = int((self.duration_ms / (1000 * 60)) % 60)
-        duration_hours = int((self.duration_ms / (1000 * 60 * 60)) % 24)
-
-        info_str = self.name + " - " + str(len(self.tracklist)) + " songs - " + str(duration_hours) + " hr " + \
-                   str(duration_mins) + " min"
-        if verbose:
-            info_str += "\n\n" + self.description
+        tracks = [(position,) + (self.resolved_tracks[position] or (None, None)) +
+                  self.track_durations.get(position, (None, None)) for position in positions]
 
-        return info_str
+        store.save_playlist(self.server_id, self.name, self.uri, self.description, self.duration_ms, self.track_count,
+                            self.complete, tracks)
 
-    def get_tracklist_str(self, start_index, end_index):
+    def iter_playlist_tracks(self, max_concurrent_pages=4):
         """
-        Creates a prettified string containing the songs from the start index to the end index.
+        Yields every playlist track object in the playlist. Spotify returns at most 100 tracks per page, so the pages
+        following the first page are fetched concurrently, a bounded number of pages ahead of the page being consumed.
+        This keeps the memory use bounded for playlists with thousands of tracks.
 
-        :param start_index: The index of the first song in the string.
-        :param end_index: The index of the last song in the string.
-        :return: The prettified string containing the songs from the start index to the end index.
+        :param max_concurrent_pages: The maximum number of pages that are fetched ahead at the same time.
         """
-        songs_str = ""
-        for counter, song in enumerate(self.tracklist[start_index:end_index]):
-            songs_str += str(counter + start_index + 1) + ". " + song[0] + "\n"
+        first_page = self.playlist["tracks"]
+        yield from first_page["items"]
+
+        # The offsets of the remaining pages are known up front since the first page contains the total track count.
+        limit = first_page["limit"]
+        offsets = iter(range(first_page["offset"] + len(first_page["items"]), first_page["total"], limit))
+
+        with ThreadPoolExecutor(max_workers=max_concurrent_pages) as executor:
+            pending_pages = deque(executor.submit(self.fetch_page, offset, limit)
+                                  for offset in islice(offsets, max_concurrent_pages))
+
+            while pending_pages:
+                page = pending_pages.popleft().result()
+
+                # Starting the fetch of the next page before the current page is consumed.
+                next_offset = next(offsets, None)
+                if next_offset is not None:
+                    pending_pages.append(executor.submit(self.fetch_page, next_offset, limit))
 
-        return songs_str
+                yield from page["items"]
 
-    def save_playlist(self):
-        """Saving a pickle file that contains all information about the playlist."""
-        with open(self.filepath, "wb") as f:
-            pickle.dump(self, f)
+    def fetch_page(self, offset, limit):
+        """Fetches the page of playlist track objects starting at the offset."""
+        return self.sp.playlist_tracks(self.uri, limit=limit, offset=offset)
 
-    def get_search_queries(self):
+    def iter_search_queries(self):
         """
         Extracts every song from the playlist together with the list of artists that made the song to obtain high
-        quality search queries that can be used to find the songs on youtube.
+        quality search queries that can be used to find the songs on youtube. The duration of the playlist is updated
+        while the songs are extracted.
 
-        :return: A string containing the song and every artist that made the song.
+        :return: A generator of tuples with the position of the song in the playlist, a string containing the song and
+        every artist that made the song, and the duration of the song in milliseconds. The string and the duration are
+        None for tracks that are no longer available on spotify.
         """
-        artists_songs = []
+        # The duration saved by an interrupted import is kept until the songs have been counted past it, so saving the
+        # playlist while it is resumed does not reset its duration.
+        saved_duration_ms = self.duration_ms
+        duration_ms = 0
 
-        # Iterating through the playlist track objects inside the paging object.
-        for playlist_track in self.playlist["tracks"]["items"]:
+        # Iterating through the playlist track objects inside the paging objects.
+        for position, playlist_track in enumerate(self.iter_playlist_tracks()):
             # Getting the track itself from the playlist track object.
             track = playlist_track["track"]
 
+            if track is None:
+                yield position, None, None
+                continue
+
             # Extracting the list of artists and track name and creating the corresponding string.
             artists_song_str = ", ".join([artists["name"] for artists in track["artists"]]) + " - " + track["name"]
 
-            artists_songs.append(artists_song_str)
-
             # Adding the duration of the track to the total duration of the playlist.
-            self.duration_ms += track["duration_ms"]
+            duration_ms += track["duration_ms"]
+            self.duration_ms = max(duration_ms, saved_duration_ms)
 
-        return artists_songs
+            yield position, artists_song_str, track["duration_ms"]
 
-    @staticmethod
-    def get_tracklist(search_queries):
-        """
-        Searches for each song on youtube to find the URL of the song.
+        self.duration_ms = duration_ms
 
-        :return: A list of tuples with the format: (song title, youtube URL).
+    def resume_from(self, saved_playlist, resolved_tracks):
         """
-        return [youtube.get_video_title_url(search_query) for search_query in search_queries]
-
-    @staticmethod
-    async def load_playlist(playlist_name, server_id, channel):
-        try:
-            with open("playlists/" + str(server_id) + "/" + playlist_name + ".pickle", "rb") as f:
-                return pickle.load(f)
-        except FileNotFoundError:
-            await channel.send("```There is no playlist with that name.```")
+        Reuses the songs found by a previous import of the same playlist that was interrupted.
 
+        :param saved_playlist: The SavedPlaylist that was saved by the interrupted import.
+        :param resolved_tracks: The songs that were resolved by the interrupted import, by position.
+        """
+        if saved_playlist.uri == self.uri and not saved_playlist.complete:
+            self.resolved_tracks = {position: title_url for position, title_url in resolved_tracks.items()
+                                    if position < self.track_count}
+            self.duration_ms = saved_playlist.duration_ms
@@ -0,0 +1,203 @@
+"""
+Module with functionality related to scheduling the ffmpeg processes that transcode audio. Converting downloaded songs to
+mp3 uses a full CPU core per song, so the number of transcodes running at the same time is bounded for the whole bot,
+and songs that are about to be played are transcoded before songs that are only prefetched.
+"""
+import asyncio
+import discord
+import heapq
+import itertools
+import youtube
+
+try:
+    import resource
+except ImportError:
+    # The resource module is only available on unix, elsewhere the CPU time of the ffmpeg processes is not reported.
+    resource = None
+
+# The priorities of the transcodes. Lower values are started first.
+PLAYBACK = 0
+PREFETCH = 1
+
+
+class Transcoder:
+    """
+    Class that bounds the number of concurrent transcodes with a priority semaphore and creates the audio sources that
+    are played in the voice channels using the configured ffmpeg options. Waiting transcodes are started in the order of
+    their priority and then in the order they were requested.
+    """
+    def __init__(self, max_transcodes=2, bitrate=192, threads=1, reconnect=True):
+        """
+        :param max_transcodes: The maximum number of transcodes that can run at the same time.
+        :param bitrate: The bitrate in kbps of the mp3 files and of the audio that is encoded to opus.
+        :param threads: The number of threads each ffmpeg process is allowed to use.
+        :param reconnect: If true ffmpeg reconnects to audio streams that are dropped by youtube.
+        """
+        self.max_transcodes = max_transcodes
+        self.bitrate = bitrate
+        self.threads = threads
+        self.reconnect = reconnect
+
+        # Heap of the waiting transcodes, each a list with the format: [priority, sequence number, future, key]. The
+        # sequence number keeps transcodes with the same priority in the order they were requested.
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.active = 0
+
+        # The number of transcodes that have been done and the CPU time used by child processes when the bot started.
+        self.completed = 0
+        self.start_cpu_time = self.get_children_cpu_time()
+
+    async def acquire(self, priority=PREFETCH, key=None):
+        """
+        Waits until a transcode can be started.
+
+        :param priority: The priority of the transcode, either PLAYBACK or PREFETCH.
+        :param key: Key used to promote the transcode while it is waiting, e.g. the video id of the song.
+        """
+        if self.active < self.max_transcodes and not self.waiting:
+            self.active += 1
+            return
+
+        entry = [priority, next(self.sequence), asyncio.get_event_loop().create_future(), key]
+        heapq.heappush(self.waiting, entry)
+
+        try:
+            await entry[2]
+        except asyncio.CancelledError:
+            # If the slot was handed over at the same time as the cancellation it is passed on to the next transcode.
+            if entry[2].done() and not entry[2].cancelled():
+                self.release()
+                raise
+
+            # The entry is already gone if release popped it after it was cancelled.
+            if entry in self.waiting:
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+
+            # Transcodes that queued up behind the cancelled entry while a slot was free are started now.
+            self.start_waiting()
+            raise
+
+    def release(self):
+        """Marks a transcode as done and hands its slot to the waiting transcode with the highest priority."""
+        while self.waiting:
+            _priority, _sequence, future, _key = heapq.heappop(self.waiting)
+            if not future.done():
+                future.set_result(None)
+                return
+
+        self.active -= 1
+
+    def start_waiting(self):
+        """Hands the free slots to the waiting transcodes with the highest priority."""
+        while self.active < self.max_transcodes and self.waiting:
+            _priority, _sequence, future, _key = heapq.heappop(self.waiting)
+            if not future.done():
+                self.active += 1
+                future.set_result(None)
+
+    def promote(self, key):
+        """Gives the waiting transcode with the given key playback priority, e.g. when its song is about to be played."""
+        for entry in self.waiting:
+            if entry[3] == key and entry[0] != PLAYBACK:
+                entry[0] = PLAYBACK
+                heapq.heapify(self.waiting)
+                return
+
+    async def run(self, executor, function, *args, priority=PREFETCH, key=None):
+        """
+        Runs the blocking transcode function on the executor once a transcode can be started.
+
+        :param executor: The executor the function is run on.
+        :param function: The function that starts the ffmpeg process and waits for it to finish.
+        :param args: The arguments of the function.
+        :param priority: The priority of the transcode, either PLAYBACK or PREFETCH.
+        :param key: Key used to promote the transcode while it is waiting, e.g. the video id of the song.
+        :return: The return value of the function.
+        """
+        await self.acquire(priority, key)
+        return await asyncio.shield(self.start(executor, function, *args))
+
+    def start(self, executor, function, *args):
+        """
+        Runs the blocking transcode function on the executor in a slot that was acquired. The function keeps running on
+        the executor if the transcode is cancelled, so the slot is released when the function is done rather than when
+        the transcode stops waiting for it.
+
+        :param executor: The executor the function is run on.
+        :param function: The function that starts the ffmpeg process and waits for it to finish.
+        :param args: The arguments of the function.
+        :return: The future of the return value of the function.
+        """
+        try:
+            future = asyncio.get_event_loop().run_in_executor(executor, function, *args)
+        except Exception:
+            self.release()
+            raise
+
+        future.add_done_callback(self.on_done)
+        return future
+
+    def on_done(self, future):
+        """Called when the function of a running transcode is done, which releases its slot."""
+        # Retrieving the exception so the failures of transcodes that nothing waits for anymore are not reported as
+        # unhandled. The transcodes that are still waited for raise the exception where they are awaited.
+        if not future.cancelled():
+            future.exception()
+
+        self.completed += 1
+        self.release()
+
+    def create_audio_source(self, source, gain=None, start=None):
+        """
+        Creates the audio source that is played in the voice channel. Audio streams are passed to ffmpeg directly and
+        opus streams are sent to discord without re-encoding.
+
+        :param source: Either the filename of a downloaded song or the audio stream of a song.
+        :param gain: The gain in dB applied to a downloaded song to normalise its loudness, or None to play it as it is.
+        :param start: The number of seconds into the song to start playing from, or None to play it from the start.
+        :return: The audio source that can be played by the voice client.
+        :raises discord.ClientException: If ffmpeg could not be started.
+        """
+        options = "-threads " + str(self.threads)
+
+        # Seeking before the input makes ffmpeg skip to the position without decoding the audio before it.
+        seek_options = "-ss " + str(round(start, 2)) if start else None
+
+        if not isinstance(source, youtube.AudioStream):
+            # A fixed volume filter costs next to nothing since ffmpeg decodes the file to PCM anyway.
+            if gain:
+                options += " -af volume=" + str(gain) + "dB"
+
+            return discord.FFmpegPCMAudio(source, before_options=seek_options, options=options)
+
+        before_options = "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5" if self.reconnect else None
+        if seek_options is not None:
+            before_options = seek_options + " " + before_options if before_options else seek_options
+
+        # Opus passthrough requires a version of discord.py with FFmpegOpusAudio, otherwise the audio is decoded to PCM.
+        if hasattr(discord, "FFmpegOpusAudio"):
+            codec = "copy" if source.codec == "opus" else None
+            return discord.FFmpegOpusAudio(source.url, bitrate=self.bitrate, codec=codec,
+                                           before_options=before_options, options=options)
+
+        return discord.FFmpegPCMAudio(source.url, before_options=before_options, options=options)
+
+    @staticmethod
+    def get_children_cpu_time():
+        """Returns the user and system CPU time in seconds used by the finished child processes, e.g. ffmpeg."""
+        if resource is None:
+            return None
+
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return usage.ru_utime + usage.ru_stime
+
+    def get_cpu_time(self):
+        """Returns the CPU time in seconds used by the finished ffmpeg processes since the bot started."""
+        cpu_time = self.get_children_cpu_time()
+        return cpu_time - self.start_cpu_time if cpu_time is not None else None
+
+    def get_queue_depth(self):
+        """Returns the number of transcodes that are waiting to be started."""
+        return len(self.waiting)
@@ -1,91 +1,238 @@
 """
 Module with functions related to finding and downloading videos from youtube.
 """
-import urllib.request
-import youtube_dl
-from bs4 import BeautifulSoup
+import aiohttp
+import asyncio
+import urllib.parse
+from collections import namedtuple
+from file_lock import remove_file
 from pathlib import Path
+from search_results import extract_search_results
+import metrics
 import os
+import subprocess
+import time
 
 
-def get_video_title_url(video_name):
+class VideoNotFoundError(Exception):
+    """Raised when a youtube search does not find a video."""
+
+
+class SearchFailedError(Exception):
+    """Raised when a youtube search fails because youtube could not be reached, e.g. during a network outage."""
+
+
+# Direct url to the audio stream of a youtube video together with the codec of the audio, e.g. "opus".
+AudioStream = namedtuple("AudioStream", ["url", "codec"])
+
+
+async def get_video_title_url(video_name, http_session, max_attempts=3, backoff=0.5, executor=None):
     """
     Searches for the video on youtube and returns the title and url of the first video found.
 
     :param video_name: The name of the video that we search for.
+    :param http_session: The HttpSession used to request the search results page.
+    :param max_attempts: The maximum number of times the search is attempted before giving up.
+    :param backoff: The number of seconds to wait before the first retry. The wait is doubled for every retry.
+    :param executor: The executor the search results page is parsed on, or None to use the default executor.
     :return: The title and URL of the first video found when searching for the given video name.
+    :raises VideoNotFoundError: If youtube did not return any videos for the search.
+    :raises SearchFailedError: If every attempt failed to reach youtube.
+    """
+    result = (await search_videos(video_name, http_session, 1, max_attempts, backoff, executor))[0]
+    return result.title, result.url
+
+
+async def search_videos(video_name, http_session, max_results=5, max_attempts=3, backoff=0.5, executor=None):
+    """
+    Searches for the video on youtube and returns the first videos found, in the order youtube ranked them. The page is
+    requested through the shared connection pool and parsed on the executor so the event loop is not blocked.
+
+    :param video_name: The name of the video that we search for.
+    :param http_session: The HttpSession used to request the search results page.
+    :param max_results: The maximum number of videos that are returned.
+    :param max_attempts: The maximum number of times the search is attempted before giving up.
+    :param backoff: The number of seconds to wait before the first retry. The wait is doubled for every retry.
+    :param executor: The executor the search results page is parsed on, or None to use the default executor.
+    :return: A non-empty list of SearchResults with the title, URL and duration in seconds of each video.
+    :raises VideoNotFoundError: If youtube did not return any videos for the search.
+    :raises SearchFailedError: If every attempt failed to reach youtube.
     """
     # Parsing the given video name into a youtube search URL.
     query = urllib.parse.quote(video_name)
     url = "https://www.youtube.com/results?search_query=" + query
 
-    # Requesting and saving the html from the page given when opening the above URL.
-    response = urllib.request.urlopen(url)
-    html = response.read()
+    # Searches where every attempt failed to reach youtube are counted as errors rather than videos not found.
+    start = time.perf_counter()
+    result = "error"
 
-    # Creating a html parser we can use to parse through the html code from the youtube page.
-    soup = BeautifulSoup(html, 'html.parser')
+    for attempt in range(max_attempts):
+        # Waiting before each retry, doubling the wait every time so a struggling youtube is not hammered.
+        if attempt > 0:
+            print("Could not find a URL for: " + video_name + "\nTrying again")
+            await asyncio.sleep(backoff * 2 ** (attempt - 1))
 
-    # Parsing through the html and searching for the first video element on the search result page, signified by the
-    # CSS class "yt-uix-tile-link".
-    video = soup.find(class_='yt-uix-tile-link')
+        # Requesting and saving the html from the page given when opening the above URL.
+        try:
+            html = await http_session.get_bytes(url)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            continue
 
-    # Wrapping in a try-except to handle the rare cases where an error causes "video" to be None. Since the problem is
-    # not correlated with the video name we simply call the function again with the same parameter.
-    try:
-        return video["title"], "https://www.youtube.com" + str(video["href"])
-    except TypeError:
-        print("Could not find a URL for: " + video_name + "\nTrying again")
-        return get_video_title_url(video_name)
+        result = "not_found"
+
+        # Parsing the page only until the needed results have been found, instead of parsing the whole page.
+        loop = asyncio.get_event_loop()
+        results = await loop.run_in_executor(executor, extract_search_results, html, max_results)
+
+        # In rare cases an error causes the page to have no results. Since the problem is not correlated with the video
+        # name we simply try again with the same search.
+        if results:
+            metrics.SEARCH_DURATION.observe(time.perf_counter() - start)
+            metrics.SEARCHES.inc(result="found")
+            return results
+
+    metrics.SEARCH_DURATION.observe(time.perf_counter() - start)
+    metrics.SEARCHES.inc(result=result)
+
+    # A search that never reached youtube says nothing about the video, so it is not reported as a video not found.
+    if result == "error":
+        raise SearchFailedError("Could not reach youtube to search for: " + video_name)
+
+    raise VideoNotFoundError("Could not find a URL for: " + video_name)
+
+
+def get_video_id(url):
+    """
+    Extracts the id of the video from a youtube url without contacting youtube.
+
+    :param url: The youtube url of the video, e.g. "https://www.youtube.com/watch?v=dQw4w9WgXcQ".
+    :return: The id of the video, or the url itself if it does not contain an id.
+    """
+    # Fast path for the urls returned by the youtube searches, which is the most common case.
+    if url.startswith("https://www.youtube.com/watch?v=") and "&" not in url:
+        return url[32:]
+
+    parsed_url = urllib.parse.urlparse(url)
+    video_ids = urllib.parse.parse_qs(parsed_url.query).get("v")
+
+    if video_ids:
+        return video_ids[0]
 
+    # Short urls of the form "https://youtu.be/dQw4w9WgXcQ" contain the id as the path.
+    if parsed_url.netloc.endswith("youtu.be") and parsed_url.path.strip("/"):
+        return parsed_url.path.strip("/")
 
-def download_mp3(url, save_folder):
+    return url
+
+
+def download_audio(url, save_folder):
     """
-    Downloads the youtube video from the url as an mp3 file and saves it to the given folder. If the video already
-    exists in the folder it is not re-downloaded.
+    Downloads the audio of the youtube video to the given folder in the format youtube serves it in. The audio is not
+    converted, so the download only waits for the network and can run without holding a transcoder slot, see
+    convert_to_mp3. If the mp3 file of the video already exists in the folder nothing is downloaded.
 
     :param url: The youtube url of the video from which the audio will be downloaded.
-    :param save_folder: The folder to which the mp3 file will be saved.
-    :return: Returns the file name of the video that was downloaded.
+    :param save_folder: The folder to which the audio will be saved.
+    :return: A tuple with the file name of the mp3 file, which is named after the id of the video, and the file name of
+    the downloaded audio that has to be converted to it, or None if the mp3 file already exists.
     """
+    # Youtube_dl is imported on first use since importing its extractors takes a long time, which would slow down the
+    # startup of the bot.
+    import youtube_dl
+
     # Creating the save folder if it does not already exist.
     Path(save_folder).mkdir(parents=True, exist_ok=True)
 
-    # Setting the options for the youtube downloader.
+    # Setting the options for the youtube downloader. The audio is downloaded under a name unique to the process, so
+    # another worker sharing the folder can download the same video at the same time.
     ydl_opts = {
         "format": "bestaudio/best",
         'noplaylist': True,
         'nocheckcertificate': True,
         'cachedir': False,
-        "outtmpl": save_folder + "%(id)s.%(title)s.%(ext)s",
-        "postprocessors": [{
-            "key": "FFmpegExtractAudio",
-            "preferredcodec": "mp3",
-            "preferredquality": "192",
-        }],
+        "outtmpl": save_folder + "%(id)s." + str(os.getpid()) + ".%(ext)s",
     }
 
     # Downloading the audio from the given url using the above specified options.
-    with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=False)
+    start = time.perf_counter()
+    try:
+        with youtube_dl.YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(url, download=False)
+
+            filepath = save_folder + info["id"] + ".mp3"
 
-        filepath = save_folder + info["id"] + "." + info["title"] + ".mp3"
+            # If the file does not already exist in the download folder we download it.
+            if os.path.isfile(filepath):
+                metrics.DOWNLOADS.inc(result="existing")
+                return filepath, None
 
-        # If the file does not already exist in the download folder we download it.
-        if not os.path.isfile(filepath):
             ydl.download([url])
+            downloaded_path = ydl.prepare_filename(info)
+    except Exception:
+        metrics.DOWNLOADS.inc(result="error")
+        raise
 
-        return filepath
+    metrics.DOWNLOAD_DURATION.observe(time.perf_counter() - start)
 
+    return filepath, downloaded_path
 
-def get_youtube_video(video_name, save_folder):
+
+def convert_to_mp3(downloaded_path, filepath, bitrate=192, threads=1):
+    """
+    Converts the downloaded audio to an mp3 file with ffmpeg and removes the downloaded audio. The mp3 file is written
+    under a name unique to the process and renamed when it is done, so a file in the folder is always complete.
+
+    :param downloaded_path: The file name of the downloaded audio, see download_audio.
+    :param filepath: The file name of the mp3 file.
+    :param bitrate: The bitrate of the mp3 file in kbps.
+    :param threads: The number of threads ffmpeg is allowed to use.
+    :return: The file name of the mp3 file.
+    :raises OSError: If ffmpeg could not be started.
+    :raises ValueError: If ffmpeg could not convert the audio.
     """
-    Searches youtube for the video name and downloads the audio from the first video found.
+    tmp_path = filepath + "." + str(os.getpid()) + ".tmp"
+    command = ["ffmpeg", "-hide_banner", "-nostats", "-loglevel", "error", "-y", "-threads", str(threads),
+               "-i", downloaded_path, "-vn", "-codec:a", "libmp3lame", "-b:a", str(bitrate) + "k", "-f", "mp3",
+               tmp_path]
+    try:
+        process = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            raise ValueError("Could not convert " + downloaded_path + " to mp3: " +
+                             process.stderr.decode("utf-8", errors="replace")[-200:].strip())
+
+        os.replace(tmp_path, filepath)
+    except Exception:
+        metrics.DOWNLOADS.inc(result="error")
+        remove_file(tmp_path)
+        raise
+    finally:
+        remove_file(downloaded_path)
+
+    metrics.DOWNLOAD_BYTES.inc(os.path.getsize(filepath))
+    metrics.DOWNLOADS.inc(result="downloaded")
+
+    return filepath
 
-    :param video_name: The search query that will be used to search for the video on youtube.
-    :param save_folder: The folder to which the mp3 file will be saved.
-    :return: Returns the file name of the video that was downloaded.
+
+def get_audio_stream(url):
+    """
+    Resolves the direct url to the audio stream of the youtube video without downloading anything. Opus streams are
+    preferred since they can be sent to discord without re-encoding the audio.
+
+    :param url: The youtube url of the video from which the audio will be streamed.
+    :return: An AudioStream with the direct url and codec of the audio stream.
     """
-    url = get_video_title_url(video_name)
+    import youtube_dl
+
+    ydl_opts = {
+        "format": "bestaudio[acodec=opus]/bestaudio/best",
+        'noplaylist': True,
+        'nocheckcertificate': True,
+        'cachedir': False,
+        'quiet': True,
+    }
+
+    with youtube_dl.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=False)
 
-    return download_mp3(url, save_folder)
+        return AudioStream(info["url"], info.get("acodec"))